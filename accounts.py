@@ -0,0 +1,245 @@
+import fcntl
+import json
+import re
+import os
+
+import logging
+
+try:
+	from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+	Fernet = None
+
+"""
+accounts - login credentials of the booking site per account.
+
+	Every Telegram user has an account named after its id (account_name()),
+	set with /setlogin, and may add named accounts ('<id>:<name>', e.g. of
+	family members). Sessions of a user are reserved with its account;
+	sessions without an owner and sessions of the operators (operator_users)
+	without credentials use the default account of browser_utils (Account
+	None). Other users need credentials: /addsession refuses them, and a
+	session whose owner lost its credentials is not reserved (MissingCredentials,
+	the owner is warned). A session with several accounts
+	(Session.accounts) is reserved by all of them at once (fan-out, see
+	reservation_service), session_accounts() resolves them.
+
+	Credentials are stored in accounts_file, encrypted (Fernet of the
+	cryptography package) with the key of the environment variable
+	accounts_key_env or of accounts_key_file (created on the first use,
+	readable by the owner only). Without the cryptography package
+	credentials cannot be stored and every session uses the default account.
+
+"""
+
+logger = logging.getLogger(name='accounts')
+
+accounts_file = 'accounts.enc'
+accounts_key_file = 'accounts.key'
+accounts_key_env = 'RESERVATION_ACCOUNTS_KEY'
+operator_users = [] # Telegram ids of the operators of the bot, their sessions may use the default account
+
+
+class MissingCredentials(Exception):
+	"""
+		The owner of a session has no credentials and may not use the default account
+	"""
+	pass
+
+
+class Account:
+	"""
+		Description:
+
+			Login credentials of the booking site.
+
+		Fields:
+
+			name     : string : name of the account (account_name() of its user and name)
+			username : string : login / mail
+			password : string : passwd
+	"""
+
+	__slots__ = ('name', 'username', 'password')
+
+	def __init__(self, name, username, password):
+		self.name = name
+		self.username = username
+		self.password = password
+
+	def __repr__(self):
+		return 'Account({!r}, {!r})'.format(self.name, self.username) # never the password
+
+
+def account_name(user, name=None):
+	"""
+		Name of the account of the Telegram user (None - the default account), of its account
+		name if given
+	"""
+	if user is None:
+		return None
+	return str(user) if name is None else '{}:{}'.format(user, name)
+
+
+def account_label(account_name_str):
+	"""
+		Name of an account as shown to its user: its own name or 'me' for the account of the user
+	"""
+	if account_name_str is None:
+		return 'default'
+	return account_name_str.split(':', 1)[1] if ':' in account_name_str else 'me'
+
+
+def account_file_suffix(account):
+	"""
+		Part of the file names of per-account files (cookie cache), '' for the default account
+	"""
+	return '' if account is None else '.' + re.sub(r'[^A-Za-z0-9_-]', '_', account.name)
+
+
+def fernet_key(key_file, key_env):
+	"""
+		Key of the environment variable key_env, otherwise of key_file (generated on the first use)
+	"""
+	key = os.environ.get(key_env)
+	if key:
+		return key.encode('ascii')
+
+	key = Fernet.generate_key()
+	try:
+		fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+	except FileExistsError:
+		with open(key_file, 'rb') as f:
+			return f.read().strip()
+
+	with os.fdopen(fd, 'wb') as f:
+		f.write(key)
+	return key
+
+
+class AccountStore:
+	"""
+		Description:
+
+			Encrypted file with the credentials of the accounts: {name : {'username', 'password'}}.
+	"""
+
+	def __init__(self, file=accounts_file, key_file=accounts_key_file):
+		self.file = file
+		self.key_file = key_file
+		self.enabled = Fernet is not None
+
+	def _fernet(self):
+		return Fernet(fernet_key(self.key_file, accounts_key_env))
+
+	def _load(self):
+		if not self.enabled:
+			return {}
+		try:
+			with open(self.file, 'rb') as f:
+				return json.loads(self._fernet().decrypt(f.read()).decode('utf-8'))
+		except FileNotFoundError:
+			return {}
+		except (InvalidToken, ValueError) as err:
+			logger.error('Accounts file {} is unreadable: {!r}'.format(self.file, err))
+			return {}
+
+	def _save(self, records):
+		token = self._fernet().encrypt(json.dumps(records).encode('utf-8'))
+		tmp_file = '{}.{}.tmp'.format(self.file, os.getpid())
+		fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(token)
+		os.replace(tmp_file, self.file)
+
+	def _update(self, change):
+		with open(self.file + '.lock', 'a') as lock: # concurrent updates keep each other's accounts
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			records = self._load()
+			change(records)
+			self._save(records)
+
+	def get(self, name):
+		"""
+			Output:
+				Account or None (no such account, name None - the default account)
+		"""
+		if name is None:
+			return None
+		record = self._load().get(name)
+		return Account(name, record['username'], record['password']) if record is not None else None
+
+	def set(self, name, username, password):
+		"""
+			Store credentials of the account name, raises RuntimeError without cryptography
+		"""
+		if not self.enabled:
+			raise RuntimeError('cryptography is not installed, credentials cannot be stored')
+		self._update(lambda records: records.__setitem__(name, {'username' : username, 'password' : password}))
+
+	def delete(self, name):
+		if self.enabled:
+			self._update(lambda records: records.pop(name, None))
+
+	def names(self, user=None):
+		"""
+			Names of the stored accounts, of the user only if given
+		"""
+		names = sorted(self._load())
+		if user is None:
+			return names
+		return [name for name in names if name == str(user) or name.startswith('{}:'.format(user))]
+
+
+def is_operator(user):
+	return str(user) in [str(operator) for operator in operator_users]
+
+
+def may_reserve(user, store=None):
+	"""
+		True if sessions of user can be reserved: it has credentials or it is an operator
+	"""
+	return (is_operator(user) or (store or AccountStore()).get(account_name(user)) is not None)
+
+
+def session_account(session, store=None):
+	"""
+		Account of the owner of session, None - the default account (sessions without an owner
+		and of the operators); raises MissingCredentials for other owners without credentials
+	"""
+	name = account_name(session.user)
+	if name is None:
+		return None
+	account = (store or AccountStore()).get(name)
+	if account is None:
+		if not is_operator(session.user):
+			raise MissingCredentials('user {} has no credentials'.format(session.user))
+		logger.info('Operator {} has no credentials, the default account is used.'.format(session.user))
+	return account
+
+
+def session_accounts(session, store=None):
+	"""
+		Description:
+
+			Accounts reserving session: its fan-out accounts (Session.accounts) which have
+			credentials, otherwise the account of its owner.
+
+		Output:
+
+			list of Account (None - the default account), never empty, without duplicates;
+			raises MissingCredentials (session_account)
+	"""
+	if not session.accounts:
+		return [session_account(session, store)]
+
+	store = store or AccountStore()
+	accounts = []
+	for name in session.accounts:
+		account = store.get(name)
+		if account is None:
+			logger.warning('Account {} of session {} has no credentials, it is skipped.'.format(name, session))
+		elif all(other.name != account.name for other in accounts):
+			accounts.append(account)
+
+	return accounts if len(accounts) > 0 else [session_account(session, store)]
@@ -0,0 +1,318 @@
+from multiprocessing import Process, Queue
+import subprocess
+import argparse
+import queue
+import json
+import time
+
+import mock_booking_server
+from mock_booking_server import start_mock_server
+from clock_sync import server_fire_timestamp
+from http_engine import HttpReservationEngine, http_reservation_attempts, ENGINE_SELENIUM, ENGINE_HTTP
+from retry_policy import RetryPolicy
+from precise_timer import sleep_until
+from racing import run_race
+from latency_stats import percentile, PHASE_FIRST_LOAD, PHASE_RELOAD
+from opening_detector import detector_modes
+
+import logging
+
+"""
+benchmark - time-to-click of the reservation path against the local mock booking site.
+
+	Every run arms the mock server (mock_booking_server) to open registration
+	lead_t (s) from now and runs a reservation against it with one of the engines:
+
+	* selenium    - reservation_process with the selenium engine (headless Chrome)
+	* http        - reservation_process with the http engine (Chrome for the login)
+	* http_direct - clock sync, precise timer and racing HTTP attempts without a
+	                browser (cookie of the mock login)
+
+	Reported per engine: success rate and distribution of the click delay (arrival
+	of the first confirmed request w.r.t. the actual opening on the server clock)
+	and of the first request, for the browser engines also the load time of the
+	reservation page per reload. With several browser profiles (--profiles, see
+	browser_utils) the browser engines run with each of them ('selenium:lean').
+	The JSON report (--output) carries the commit and the parameters, --compare
+	prints the differences to an older report.
+
+	Usage:
+		python benchmark.py --runs 20 --engines http_direct,http --latency 0.02 --skew 0.3 --output bench.json
+		python benchmark.py --runs 20 --engines selenium --profiles full,lean --latency 0.02
+		python benchmark.py --runs 20 --compare bench.json
+
+"""
+
+logger = logging.getLogger(name='benchmark')
+
+ENGINE_HTTP_DIRECT = 'http_direct'
+benchmark_engines = (ENGINE_SELENIUM, ENGINE_HTTP, ENGINE_HTTP_DIRECT)
+process_timeout_t = 120.0 # reservation_process runs longer than lead_t + retry_budget_t + this are killed
+events_check_t = 0.1
+
+
+def benchmark_configuration(config_file, server, lead):
+	with open(config_file, 'r', encoding='utf-8') as f:
+		configuration = json.load(f)
+
+	configuration.update({
+		'browser_delay_t'   : min(configuration['browser_delay_t'], max(lead - 1.0, 0.0)),
+		'rehearsal_t'       : min(configuration['rehearsal_t'], max(lead - 1.0, 0.0)),
+		'http_reserve_url'  : server.url + '/reserve',
+		'http_success_text' : mock_booking_server.confirmed_text,
+		'page_full_text'    : mock_booking_server.sold_out_text,
+		'clock_sync_url'    : ''
+	})
+	return configuration
+
+
+def mock_browser_login(server):
+	"""
+		Point the login and the reserve button of browser_utils to the mock site and the
+		cookie cache to its own file (module globals, inherited by the forked reservation
+		processes), the cookies of the mock site never get into the cache of the service
+	"""
+	import browser_utils # selenium is needed for the browser engines only
+	import cookie_cache
+
+	cookie_cache.cookie_cache_file = 'cookies.benchmark.cache'
+	cookie_cache.CookieCache(cookie_cache.cookie_cache_file).clear() # cookies of the mock site of a previous run
+
+	browser_utils.login_url = server.url + '/login'
+	browser_utils.login_username_id = 'username'
+	browser_utils.login_username = 'benchmark'
+	browser_utils.login_password_id = 'password'
+	browser_utils.login_password = 'benchmark'
+	browser_utils.login_button_name = 'login'
+	browser_utils.reserve_button_name = mock_booking_server.reserve_button_name
+
+
+def http_direct_reservation(opening, url, configuration):
+	fire_timestamp = server_fire_timestamp(opening, url, configuration)
+
+	cookies = [{'name' : 'session', 'value' : 'mock', 'path' : '/'}]
+	engines = [HttpReservationEngine(configuration['http_reserve_url'], cookies,
+		method='POST', success_text=configuration['http_success_text'], full_text=configuration['page_full_text'])
+		for i in range(max(1, configuration['race_attempts_n']))]
+	try:
+		for engine in engines:
+			engine.connect()
+
+		sleep_until(fire_timestamp)
+		policies = [RetryPolicy.from_configuration(configuration) for engine in engines]
+		run_race([lambda race, engine=engine, policy=policy: http_reservation_attempts(engine, policy, race)
+			for engine, policy in zip(engines, policies)], configuration['race_stagger_t'])
+	finally:
+		for engine in engines:
+			engine.close()
+
+
+def process_events(proc, events, timeout):
+	"""
+		Latency events of the reservation process proc until it exits, it is killed after timeout (s)
+	"""
+	collected = []
+	deadline = time.monotonic() + timeout
+	while True:
+		try:
+			collected.append(events.get(timeout=events_check_t)) # drained meanwhile, the process never blocks on it
+			continue
+		except queue.Empty:
+			pass
+
+		if not proc.is_alive():
+			break
+		if (time.monotonic() >= deadline):
+			logger.warning('Reservation process {} timed out.'.format(proc.pid))
+			proc.terminate()
+			deadline = float('inf')
+
+	proc.join()
+	return collected
+
+
+def benchmark_run(server, engine, configuration, lead, late, sold_out_after):
+	"""
+		Description:
+
+			One reservation against server opening in lead (s).
+
+		Output:
+
+			{'success', 'click_delay', 'first_delay', 'first_load', 'reloads'} (delays in s w.r.t. the actual
+			opening, None if no request; load times (s) of the reservation page in the browser)
+	"""
+
+	opening = time.time() + server.skew + lead
+	server.script(opening, late, sold_out_after)
+	url = server.url + '/'
+	events = []
+
+	if (engine == ENGINE_HTTP_DIRECT):
+		http_direct_reservation(opening, url, configuration)
+	else:
+		from reservation_process import reservation_process
+
+		events_queue = Queue()
+		proc = Process(target=reservation_process, args=(opening, url, configuration, None, engine, events_queue))
+		proc.start()
+		events = process_events(proc, events_queue, lead + configuration['retry_budget_t'] + process_timeout_t)
+
+	actual_opening = server.actual_opening
+	requests = list(server.requests)
+	reservations = list(server.reservations)
+	first_loads = [event['duration'] for event in events if event['phase'] == PHASE_FIRST_LOAD and event['ok']]
+
+	return {
+		'success'     : len(reservations) > 0,
+		'click_delay' : (reservations[0] - actual_opening) if (len(reservations) > 0) else None,
+		'first_delay' : (requests[0][0] - actual_opening) if (len(requests) > 0) else None,
+		'first_load'  : first_loads[-1] if (len(first_loads) > 0) else None,
+		'reloads'     : [event['duration'] for event in events if event['phase'] == PHASE_RELOAD and event['ok']]
+	}
+
+
+def distribution(values):
+	if (len(values) == 0):
+		return None
+	values = sorted(values)
+	summary = {'n' : len(values), 'min' : values[0], 'max' : values[-1]}
+	for p in (50, 95, 99):
+		summary['p{}'.format(p)] = percentile(values, p)
+	return summary
+
+
+def engine_report(runs):
+	clicks = [run['click_delay'] for run in runs if run['click_delay'] is not None]
+	firsts = [run['first_delay'] for run in runs if run['first_delay'] is not None]
+	return {
+		'runs'         : len(runs),
+		'success_rate' : sum(run['success'] for run in runs) / len(runs),
+		'click_delay'  : distribution(clicks),
+		'first_delay'  : distribution(firsts),
+		'first_load'   : distribution([run['first_load'] for run in runs if run.get('first_load') is not None]),
+		'reload'       : distribution([reload for run in runs for reload in run.get('reloads', [])])
+	}
+
+
+def current_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def ms(value):
+	return '-' if value is None else '{:.2f}'.format(value * 1000.0)
+
+
+def print_report(report, baseline=None):
+	print('Commit {}, parameters {}'.format(report['commit'], report['parameters']))
+	if baseline is not None:
+		print('Baseline commit {}, parameters {}'.format(baseline['commit'], baseline['parameters']))
+
+	print('{:16} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>11} {:>11} {:>11}'.format('engine', 'success', 'p50 ms',
+		'p95 ms', 'p99 ms', 'min ms', 'max ms', 'first p50', 'reload p50', 'reload p95'))
+	for engine, result in report['engines'].items():
+		click = result['click_delay'] or {}
+		first = result['first_delay'] or {}
+		reload = result.get('reload') or {}
+		print('{:16} {:>8.0%} {:>9} {:>9} {:>9} {:>9} {:>9} {:>11} {:>11} {:>11}'.format(engine, result['success_rate'],
+			ms(click.get('p50')), ms(click.get('p95')), ms(click.get('p99')), ms(click.get('min')),
+			ms(click.get('max')), ms(first.get('p50')), ms(reload.get('p50')), ms(reload.get('p95'))))
+
+		if (baseline is not None and engine in baseline['engines']):
+			old = baseline['engines'][engine]
+			old_click = old['click_delay'] or {}
+			old_reload = old.get('reload') or {}
+			delta = '-' if (click.get('p50') is None or old_click.get('p50') is None) else \
+				'{:+.2f}'.format((click['p50'] - old_click['p50']) * 1000.0)
+			reload_delta = '-' if (reload.get('p50') is None or old_reload.get('p50') is None) else \
+				'{:+.2f}'.format((reload['p50'] - old_reload['p50']) * 1000.0)
+			print('{:16} {:>+8.0%} {:>9} {:>9} {:>9} {:>9} {:>9} {:>11} {:>11}'.format('  vs base',
+				result['success_rate'] - old['success_rate'], delta, '', '', '', '', '', reload_delta))
+
+
+def run_benchmark(engines, runs, config_file, lead, latency, skew, late, sold_out_after, detector=None, profiles=None):
+
+	server = start_mock_server(skew=skew, latency=latency)
+	if any(engine != ENGINE_HTTP_DIRECT for engine in engines):
+		mock_browser_login(server)
+	configuration = benchmark_configuration(config_file, server, lead)
+	if detector is not None:
+		configuration['detector_mode'] = detector
+	profiles = profiles or [configuration['browser_profile']]
+
+	report = {
+		'commit'     : current_commit(),
+		'time'       : time.time(),
+		'parameters' : {'runs' : runs, 'lead_t' : lead, 'latency_t' : latency, 'skew_t' : skew, 'late_t' : late,
+			'sold_out_after_t' : sold_out_after, 'config' : config_file, 'detector' : configuration['detector_mode'],
+			'profiles' : profiles},
+		'engines'    : {}
+	}
+
+	try:
+		for engine in engines:
+			for profile in (profiles if engine != ENGINE_HTTP_DIRECT else [None]):
+				label = engine if (profile is None or len(profiles) == 1) else '{}:{}'.format(engine, profile)
+				profile_configuration = dict(configuration, browser_profile=profile or configuration['browser_profile'])
+				results = []
+				for i in range(runs):
+					result = benchmark_run(server, engine, profile_configuration, lead, late, sold_out_after)
+					logger.info('Run {} of {}: {}'.format(i, label, result))
+					results.append(result)
+				report['engines'][label] = engine_report(results)
+	finally:
+		server.shutdown()
+		server.server_close()
+
+	return report
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark of the reservation path against the local mock booking site.')
+	parser.add_argument('--engines', default=ENGINE_HTTP_DIRECT, help='comma separated, of: ' + ', '.join(benchmark_engines))
+	parser.add_argument('--runs', type=int, default=10)
+	parser.add_argument('--config', default='default.config')
+	parser.add_argument('--lead', type=float, default=15.0, help='registration opens this long (s) after a run starts (clock sync has to fit)')
+	parser.add_argument('--latency', type=float, default=0.0, help='delay of every response of the mock site (s)')
+	parser.add_argument('--skew', type=float, default=0.0, help='clock skew of the mock site (s)')
+	parser.add_argument('--late', type=float, default=0.0, help='actual opening is late by (s)')
+	parser.add_argument('--sold-out-after', type=float, default=None, help='sold out after (s) from the actual opening')
+	parser.add_argument('--detector', default=None, choices=detector_modes, help='opening detector of the selenium engine '
+		'(default - of the configuration)')
+	parser.add_argument('--profiles', default=None, help='comma separated browser profiles of the browser engines, of: '
+		'full, lean (default - of the configuration)')
+	parser.add_argument('--output', default=None, help='write the JSON report to this file')
+	parser.add_argument('--compare', default=None, help='JSON report of a baseline run')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+	engines = args.engines.split(',')
+	for engine in engines:
+		if engine not in benchmark_engines:
+			parser.error('unknown engine {}'.format(engine))
+
+	profiles = None
+	if args.profiles is not None:
+		from browser_utils import browser_profiles # selenium is needed for the browser engines only
+		profiles = args.profiles.split(',')
+		for profile in profiles:
+			if profile not in browser_profiles:
+				parser.error('unknown browser profile {}'.format(profile))
+
+	report = run_benchmark(engines, args.runs, args.config, args.lead, args.latency, args.skew, args.late,
+		args.sold_out_after, args.detector, profiles)
+
+	baseline = None
+	if args.compare is not None:
+		with open(args.compare, 'r', encoding='utf-8') as f:
+			baseline = json.load(f)
+
+	print_report(report, baseline)
+
+	if args.output is not None:
+		with open(args.output, 'w', encoding='utf-8') as f:
+			json.dump(report, f, indent=4)
@@ -0,0 +1,375 @@
+from multiprocessing.managers import BaseManager
+from browser_utils import launch_browser, browser_login, site_hosts, host_allowed, url_host, PROFILE_LEAN
+
+import itertools
+import threading
+import time
+import os
+
+import logging
+
+"""
+browser_pool - pool of launched and logged in headless Chrome instances.
+
+	The pool runs in its own manager process (start_browser_pool()) and keeps
+	browser_pool_n instances launched and authenticated on the booking site.
+	A background thread health-checks idle instances every browser_check_t (s)
+	and replaces dead or older than browser_max_age_t (s) ones.
+
+	Reservation subprocesses lease an instance through the proxy of the pool,
+	attach to it (browser_utils.attach_browser) and release it afterwards, so
+	the critical path starts from an already logged in browser. A lease records
+	the PID of its subprocess; leases of subprocesses which died without a
+	release (SIGKILL) are taken back by the health-checks.
+
+	With the lean browser profile an instance resolves only the hosts of the
+	booking site it was launched with. The service announces the host of every
+	session it spawns a worker for (allow_hosts), idle instances without a new
+	host are replaced, and a lease gets only an instance allowing the host of
+	its session.
+
+"""
+
+logger = logging.getLogger(name='browser_pool')
+
+
+def process_alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		return True # PID of another user's process
+
+	return True
+
+
+class BrowserInstance:
+
+	def __init__(self, browser, hosts=None):
+		self.browser = browser
+		self.hosts = hosts # hosts it resolves (lean profile), None - all
+		self.created = time.time()
+		self.lease_id = None
+		self.owner = None # PID of the leaseholder
+
+	def age(self):
+		return time.time() - self.created
+
+	def allows(self, host):
+		return (self.hosts is None or host is None or host_allowed(host, self.hosts))
+
+
+class BrowserPool:
+	"""
+		Description:
+
+			Pool of size logged in Chrome instances.
+
+		Input:
+
+			size          : number of instances kept launched
+			check_period  : period (s) of health-checks of idle instances
+			max_age       : instances older than max_age (s) are replaced
+			configuration : configuration of the service (browser_profile of the instances)
+	"""
+
+	def __init__(self, size, check_period, max_age, configuration):
+		self.size = size
+		self.check_period = check_period
+		self.max_age = max_age
+		self.configuration = configuration
+		self.lean = (configuration['browser_profile'] == PROFILE_LEAN)
+
+		self._hosts = site_hosts(configuration) # hosts of the sessions, resolved by new lean instances
+		self._hosts_changed = False
+		self._idle = []
+		self._leased = {} # lease_id -> BrowserInstance
+		self._launching = 0
+		self._lease_ids = itertools.count(1)
+		self._cond = threading.Condition()
+		self._stopped = False
+
+		self._stats = {
+			'leases'          : 0,
+			'lease_timeouts'  : 0,
+			'lease_wait_sum'  : 0.0,
+			'lease_wait_max'  : 0.0,
+			'lease_age_sum'   : 0.0,
+			'launched'        : 0,
+			'launch_failures' : 0,
+			'replaced'        : 0,
+			'reclaimed'       : 0
+		}
+
+		self._thread = threading.Thread(target=self._maintain, name='browser_pool', daemon=True)
+		self._thread.start()
+
+	def allow_hosts(self, urls):
+		"""
+			Lean profile: add the hosts of urls (sessions) to the hosts of new instances, idle
+			instances without them are replaced
+		"""
+		if not self.lean:
+			return
+		with self._cond:
+			hosts = [url_host(url) for url in urls]
+			hosts = [host for host in hosts if host is not None and not host_allowed(host, self._hosts)]
+			if (len(hosts) > 0):
+				self._hosts.extend(sorted(set(hosts)))
+				self._hosts_changed = True
+				self._cond.notify_all()
+				logger.info('Browser pool allows hosts {}, idle browsers are replaced.'.format(', '.join(hosts)))
+
+	def _idle_index(self, host):
+		for i, instance in enumerate(self._idle):
+			if instance.allows(host):
+				return i
+		return None
+
+	def lease(self, timeout, url_str=None, owner=None):
+		"""
+			Description:
+
+				Lease an idle logged in instance allowing the host of url_str, waiting at most timeout (s).
+				owner - PID of the leaseholder, the lease is taken back once it is dead.
+
+			Output:
+
+				lease (dict with lease_id, executor_url, session_id, capabilities, age, wait) or None on timeout
+		"""
+
+		host = url_host(url_str)
+		start = time.monotonic()
+		with self._cond:
+			while (self._idle_index(host) is None and not self._stopped):
+				remaining = timeout - (time.monotonic() - start)
+				if (remaining <= 0.0):
+					self._stats['lease_timeouts'] += 1
+					logger.warning('No idle browser within {} s.'.format(timeout))
+					return None
+				self._cond.wait(remaining)
+
+			if self._stopped:
+				return None
+
+			instance = self._idle.pop(self._idle_index(host))
+			instance.lease_id = next(self._lease_ids)
+			instance.owner = owner
+			self._leased[instance.lease_id] = instance
+
+			wait = time.monotonic() - start
+			self._stats['leases'] += 1
+			self._stats['lease_wait_sum'] += wait
+			self._stats['lease_wait_max'] = max(self._stats['lease_wait_max'], wait)
+			self._stats['lease_age_sum'] += instance.age()
+			self._cond.notify_all()
+
+		logger.info('Browser leased: lease {}, wait {:.3f} s, age {:.1f} s.'.format(instance.lease_id, wait, instance.age()))
+
+		return {
+			'lease_id'     : instance.lease_id,
+			'executor_url' : instance.browser.command_executor._url,
+			'session_id'   : instance.browser.session_id,
+			'capabilities' : {'pageLoadStrategy' : instance.browser.capabilities.get('pageLoadStrategy')},
+			'age'          : instance.age(),
+			'wait'         : wait
+		}
+
+	def release(self, lease_id, healthy=True):
+		"""
+			Return the leased instance to the pool, unhealthy instances are replaced
+		"""
+		with self._cond:
+			instance = self._leased.pop(lease_id, None)
+			if instance is None:
+				return
+			instance.lease_id = None
+			instance.owner = None
+
+		if healthy:
+			healthy = self._check(instance)
+
+		with self._cond:
+			if (healthy and not self._stopped):
+				self._idle.append(instance)
+				self._cond.notify_all()
+				return
+
+		self._quit(instance)
+		with self._cond:
+			self._stats['replaced'] += 1
+			self._cond.notify_all()
+
+	def stats(self):
+		"""
+			Lease and instance metrics of the pool
+		"""
+		with self._cond:
+			stats = dict(self._stats)
+			stats['idle'] = len(self._idle)
+			stats['leased'] = len(self._leased)
+			stats['idle_ages'] = [round(instance.age(), 1) for instance in self._idle]
+			leases = max(stats['leases'], 1)
+			stats['lease_wait_avg'] = stats.pop('lease_wait_sum') / leases
+			stats['lease_age_avg'] = stats.pop('lease_age_sum') / leases
+
+		return stats
+
+	def close(self):
+		with self._cond:
+			self._stopped = True
+			instances = self._idle + list(self._leased.values())
+			self._idle = []
+			self._leased = {}
+			self._cond.notify_all()
+
+		for instance in instances:
+			self._quit(instance)
+
+	def _maintain(self):
+		"""
+			Keep size instances launched, health-check idle ones every check_period
+		"""
+		last_check = time.monotonic()
+		while True:
+			with self._cond:
+				if self._stopped:
+					return
+				missing = self.size - len(self._idle) - len(self._leased) - self._launching
+				if (missing > 0):
+					self._launching += 1
+
+			if (missing > 0):
+				instance = self._launch()
+				with self._cond:
+					self._launching -= 1
+					if (instance is not None and not self._stopped):
+						self._idle.append(instance)
+						self._cond.notify_all()
+						instance = None
+				if instance is not None:
+					self._quit(instance)
+				continue
+
+			with self._cond:
+				hosts_changed, self._hosts_changed = self._hosts_changed, False
+			if (hosts_changed or time.monotonic() - last_check >= self.check_period):
+				self._reclaim_leases()
+				self._check_idle()
+				last_check = time.monotonic()
+				logger.debug('Browser pool stats: {}'.format(self.stats()))
+
+			with self._cond:
+				if not self._hosts_changed:
+					self._cond.wait(self.check_period)
+
+	def _launch(self):
+		with self._cond:
+			hosts = list(self._hosts)
+		try:
+			browser = launch_browser(self.configuration, hosts=hosts)
+			browser_login(browser)
+		except Exception as err:
+			logger.error('Failed to launch and log in a browser: {}'.format(err))
+			with self._cond:
+				self._stats['launch_failures'] += 1
+			time.sleep(self.check_period)
+			return None
+
+		with self._cond:
+			self._stats['launched'] += 1
+		logger.info('Browser launched and logged in, session {}.'.format(browser.session_id))
+
+		return BrowserInstance(browser, hosts if self.lean else None)
+
+	def _reclaim_leases(self):
+		"""
+			Release the leases whose leaseholder process is dead
+		"""
+		with self._cond:
+			orphaned = [lease_id for lease_id, instance in self._leased.items()
+				if instance.owner is not None and not process_alive(instance.owner)]
+
+		for lease_id in orphaned:
+			logger.warning('Leaseholder of lease {} is dead, the browser is taken back.'.format(lease_id))
+			self.release(lease_id)
+			with self._cond:
+				self._stats['reclaimed'] += 1
+
+	def _check_idle(self):
+		with self._cond:
+			instances = self._idle
+			self._idle = []
+			hosts = list(self._hosts)
+
+		for instance in instances:
+			current = (instance.hosts is None or all(host in instance.hosts for host in hosts))
+			if (current and instance.age() < self.max_age and self._check(instance)):
+				with self._cond:
+					self._idle.append(instance)
+					self._cond.notify_all()
+			else:
+				logger.info('Browser session {} is replaced, age {:.1f} s.'.format(instance.browser.session_id, instance.age()))
+				self._quit(instance)
+				with self._cond:
+					self._stats['replaced'] += 1
+
+	def _check(self, instance):
+		try:
+			instance.browser.execute_script('return 1')
+		except Exception as err:
+			logger.warning('Browser session {} failed health-check: {}'.format(instance.browser.session_id, err))
+			return False
+
+		return True
+
+	def _quit(self, instance):
+		try:
+			instance.browser.quit()
+		except Exception as err:
+			logger.warning('Failed to quit browser session {}: {}'.format(instance.browser.session_id, err))
+
+
+class BrowserPoolManager(BaseManager):
+	pass
+
+_browser_pool = None
+
+def _get_browser_pool(size, check_period, max_age, configuration):
+	# called in the manager process, the pool is a singleton there
+	global _browser_pool
+	if _browser_pool is None:
+		_browser_pool = BrowserPool(size, check_period, max_age, configuration)
+	return _browser_pool
+
+BrowserPoolManager.register('get_browser_pool', callable=_get_browser_pool)
+
+
+def start_browser_pool(configuration):
+	"""
+		Description:
+
+			Start the manager process of the browser pool.
+
+		Output:
+
+			manager, pool - manager (to shutdown) and proxy of the pool (picklable, passed to
+			the reservation subprocesses); None, None if browser_pool_n is 0
+	"""
+
+	if (configuration['browser_pool_n'] <= 0):
+		return None, None
+
+	manager = BrowserPoolManager()
+	manager.start()
+	pool = manager.get_browser_pool(configuration['browser_pool_n'],
+		configuration['browser_check_t'], configuration['browser_max_age_t'], configuration)
+
+	return manager, pool
+
+
+def stop_browser_pool(manager, pool):
+	if manager is not None:
+		pool.close()
+		manager.shutdown()
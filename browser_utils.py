@@ -0,0 +1,231 @@
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from selenium.webdriver.remote.webdriver import WebDriver as RemoteWebDriver
+from opening_detector import reserve_finder_script
+from urllib.parse import urlsplit
+import fnmatch
+import time
+
+"""
+browser_utils - launching, login and attaching of Chrome instances for the reservations.
+
+	Browsers are launched with the browser_profile of the configuration:
+
+	* full - headless Chrome loading the pages with all their resources
+	* lean - reloads cost the document only: images are disabled, requests of
+	         stylesheets, fonts and images (lean_blocked_urls) are blocked
+	         (Network.setBlockedURLs of the DevTools protocol), hosts other than
+	         the booking site (host of login_url, of the session url and
+	         lean_hosts) do not resolve, extensions and background networking
+	         are disabled. Pages load with the lean_page_load strategy: eager
+	         (get() returns at DOMContentLoaded, without waiting for scripts
+	         and frames) or none (get() returns at once, load_page() waits until
+	         the document is parsed or `reserve` button is there).
+
+"""
+
+# login page of the booking site and its elements
+login_url = '' # login page
+login_username_id = '' # id of login / email field
+login_username = '' # login / mail of the default account
+login_password_id = '' # id of passwd field
+login_password = '' # passwd of the default account
+login_button_name = '' # name of login button
+
+# reservation page of the booking site
+reserve_button_name = '' # name of `reserve` button (should be the only one on the page)
+reserve_button_xpath = '' # xpath of `reserve` button, tried if it is not found by its name (empty - none)
+
+_reserve_locator = None # locator which found `reserve` button last (see locate_reserve_button)
+
+PROFILE_FULL, PROFILE_LEAN = 'full', 'lean'
+browser_profiles = (PROFILE_FULL, PROFILE_LEAN)
+PAGE_LOAD_NORMAL, PAGE_LOAD_EAGER, PAGE_LOAD_NONE = 'normal', 'eager', 'none'
+
+# resources blocked by the lean profile (url patterns of Network.setBlockedURLs, only * is a
+# wildcard, match the whole url: with and without a query or a fragment, e.g. style.css?v=3)
+lean_blocked_extensions = ('css', 'woff', 'woff2', 'ttf', 'otf', 'eot',
+	'png', 'jpg', 'jpeg', 'gif', 'webp', 'svg', 'ico')
+lean_blocked_urls = [pattern.format(extension) for extension in lean_blocked_extensions
+	for pattern in ('*.{}', '*.{}?*', '*.{}#*')]
+page_ready_t = 10.0 # maximal wait (s) for the document with the none page load strategy
+page_ready_check_t = 0.01
+
+# the document loaded (not the one before the navigation) is parsed or has `reserve` button
+page_ready_script = reserve_finder_script + """
+return !document.__reservationStale && (document.readyState !== 'loading' || findReserve(arguments[0]) !== null);
+"""
+stale_page_script = 'document.__reservationStale = true;'
+
+
+def chrome_options(profile=PROFILE_FULL, page_load=PAGE_LOAD_EAGER, hosts=()):
+	"""
+		Options of a headless Chrome instance of profile (hosts - hosts of the booking site for
+		the lean profile, others do not resolve; empty - no host is blocked)
+	"""
+	options = webdriver.ChromeOptions()
+	options.add_argument('--headless')
+	options.add_argument('--no-sandbox')
+
+	if (profile == PROFILE_LEAN):
+		options.add_argument('--blink-settings=imagesEnabled=false')
+		options.add_argument('--disable-extensions')
+		options.add_argument('--disable-background-networking')
+		options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images' : 2})
+		if (len(hosts) > 0):
+			options.add_argument('--host-resolver-rules=MAP * ~NOTFOUND, {}'.format(
+				', '.join('EXCLUDE ' + host for host in hosts)))
+		options.set_capability('pageLoadStrategy', page_load)
+
+	return options
+
+
+def url_host(url_str):
+	return urlsplit(url_str).hostname if url_str else None
+
+
+def site_hosts(configuration, url_str=None, hosts=()):
+	"""
+		Hosts of the booking site: lean_hosts (comma separated), hosts of login_url and url_str, hosts
+	"""
+	site = [host.strip() for host in configuration['lean_hosts'].split(',') if len(host.strip()) > 0]
+	for host in [url_host(login_url), url_host(url_str)] + list(hosts):
+		if (host is not None and host not in site):
+			site.append(host)
+	return site
+
+
+def host_allowed(host, hosts):
+	"""
+		True if host matches one of hosts (site_hosts(), wildcards *.example.com)
+	"""
+	return any(fnmatch.fnmatch(host, pattern) for pattern in hosts)
+
+
+def browser_options(configuration, url_str=None, hosts=()):
+	"""
+		chrome_options() of the browser_profile of the configuration for the session url_str (and hosts)
+	"""
+	return chrome_options(configuration['browser_profile'], configuration['lean_page_load'],
+		site_hosts(configuration, url_str, hosts))
+
+
+def launch_browser(configuration, url_str=None, hosts=()):
+	"""
+		Launch Chrome with the browser_profile of the configuration for the session url_str (and the
+		sessions of hosts); the only place browsers are launched
+	"""
+	browser = webdriver.Chrome(options=browser_options(configuration, url_str, hosts))
+	if (configuration['browser_profile'] == PROFILE_LEAN):
+		try:
+			browser.execute_cdp_cmd('Network.enable', {})
+			browser.execute_cdp_cmd('Network.setBlockedURLs', {'urls' : lean_blocked_urls})
+		except Exception:
+			browser.quit()
+			raise
+	return browser
+
+
+def load_page(browser, url_str, timeout=page_ready_t):
+	"""
+		Load url_str in browser; with the none page load strategy wait up to timeout (s) until
+		the document is parsed or has `reserve` button (raises TimeoutException)
+	"""
+	if (browser.capabilities.get('pageLoadStrategy') != PAGE_LOAD_NONE):
+		browser.get(url_str)
+		return
+
+	browser.execute_script(stale_page_script) # get() may return before the navigation replaces the document
+	browser.get(url_str)
+	locators = [list(locator) for locator in reserve_button_locators()]
+	deadline = time.monotonic() + timeout
+	while not browser.execute_script(page_ready_script, locators):
+		if (time.monotonic() >= deadline):
+			raise TimeoutException('{} is not loaded within {} s'.format(url_str, timeout))
+		time.sleep(page_ready_check_t)
+
+
+def browser_login(browser, account=None):
+	"""
+		Log in on the booking site in browser with account (accounts.Account, None - the default account)
+	"""
+
+	# input login and password in the fields
+	load_page(browser, login_url) # loging page
+	username = browser.find_element_by_id(login_username_id) # find login / email
+	username.send_keys(login_username if account is None else account.username) # type login / mail
+	passw = browser.find_element_by_id(login_password_id) # find passwd
+	passw.send_keys(login_password if account is None else account.password) # type passwd
+
+	# click login button
+	loginButton = browser.find_element_by_name(login_button_name) # find button
+	loginButton.click()
+
+
+def reserve_button_locators():
+	"""
+		Locators (by, value) of `reserve` button, the cached one first
+	"""
+	locators = [(By.NAME, reserve_button_name)]
+	if (len(reserve_button_xpath) > 0):
+		locators.append((By.XPATH, reserve_button_xpath))
+	if _reserve_locator in locators:
+		locators.remove(_reserve_locator)
+		locators.insert(0, _reserve_locator)
+	return locators
+
+
+def locate_reserve_button(browser):
+	"""
+		Locator of `reserve` button on the loaded reservation page, cached for find_reserve_button
+		(None - not found)
+	"""
+	global _reserve_locator
+
+	for locator in reserve_button_locators():
+		if (len(browser.find_elements(*locator)) > 0):
+			_reserve_locator = locator
+			return locator
+	return None
+
+
+def find_reserve_button(browser):
+	"""
+		Find `reserve` button on the loaded reservation page (raises NoSuchElementException)
+	"""
+	locators = reserve_button_locators()
+	for locator in locators[:-1]:
+		try:
+			return browser.find_element(*locator)
+		except NoSuchElementException:
+			continue
+	return browser.find_element(*locators[-1])
+
+
+class AttachedBrowser(RemoteWebDriver):
+	"""
+		Description:
+
+			WebDriver attached to an already running browser session (launched in
+			another process, e.g. by the browser pool) instead of starting a new one.
+			quit() must not be called on it - the owner of the session quits it.
+	"""
+
+	def __init__(self, executor_url, session_id, capabilities=None):
+		self._attached_session_id = session_id
+		self._attached_capabilities = capabilities or {}
+		super().__init__(command_executor=executor_url, desired_capabilities={})
+
+	def start_session(self, *args, **kwargs):
+		# do not create a new session, reuse the existing one
+		self.session_id = self._attached_session_id
+		self.w3c = True
+		self.capabilities = dict(self._attached_capabilities)
+
+
+def attach_browser(lease):
+	"""
+		Attach to the browser session described by the lease of the browser pool
+	"""
+	return AttachedBrowser(lease['executor_url'], lease['session_id'], lease.get('capabilities'))
@@ -1,57 +1,304 @@
-from datetime import datetime
-from sessions_utils import get_sessions_list, put_sessions_list
+import bisect
+import threading
+from session import Session
+from virtual_clock import get_clock
+from sessions_store import get_store
 import validators
 
-CHECK_SESS_CORRECT, CHECK_SESS_DATE_ERR_BAD_FORMAT, CHECK_SESS_ERR_DATE_PASSED, CHECK_SESS_ERR_DATE_DELAY = range(4) # list of error codes
+CHECK_SESS_CORRECT, CHECK_SESS_ERR_BAD_FORMAT, CHECK_SESS_ERR_DATE_PASSED, CHECK_SESS_ERR_DATE_DELAY = range(4) # list of error codes
 
 datetime_format = '%d/%m/%Y %H:%M'
 min_delay_time_sec = 300 # timedelay between two events cannot be less than 5 minutes
+CHANGE_ADD, CHANGE_REMOVE = 'add', 'remove' # changes logged by SessionIndex
+max_changes_n = 1024 # the log keeps at least half of this
 
-def check_new_datetime(datetime_str, sessions_file):
+
+class SessionIndex:
 	"""
-	Description:
-		Check if new datetime is a valid: 
-	
-		1. Registration moment is later than 'now' (cannot register in the past)
-		2. New date is at least 5 mins separated from other dates
+		Description:
+
+			Sorted in-memory index of registration timestamps of sessions_file, of
+			all sessions and of the queue of every user (Session.user). Since the
+			sessions of a user never overlap closer than min_delay_time_sec, a new
+			timestamp conflicts only with its two neighbours at the insertion point
+			in the queue of its user, found by bisection in O(log n).
 
+			The index is rebuilt only when the generation of the storage changed
+			(session added or removed by another process). It is shared by the
+			threads of the bot, find_conflict() + insert() of one new session are
+			done under lock.
+
+			Own changes are numbered by version and logged (changes_since()), so
+			the reservation scheduler follows them in O(log n) per change; a rebuild
+			makes it resynchronize with the whole list.
 	"""
 
-	# 1. Check that date is later than 'now'
+	def __init__(self, sessions_file):
+		self.sessions_file = sessions_file
+		self._store = get_store(sessions_file)
+		self._generation = None
+		self._timestamps = []
+		self._sessions = []
+		self._users = {} # user -> (timestamps, sessions) of its queue
+		self.version = 0
+		self._changes = [] # (version, change, session) of the versions after _log_start
+		self._log_start = 0
+		self.lock = threading.RLock()
+
+	def refresh(self):
+		with self.lock:
+			generation = self._store.generation()
+			if (generation != self._generation or generation is None):
+				self._sessions = self._store.load()
+				self._timestamps = [session.timestamp for session in self._sessions]
+				self._users = {}
+				for session in self._sessions:
+					timestamps, sessions = self._queue(session.user)
+					timestamps.append(session.timestamp)
+					sessions.append(session)
+				self._generation = generation
+
+				self.version += 1
+				self._changes = []
+				self._log_start = self.version
+
+	def _queue(self, user):
+		return self._users.setdefault(user, ([], []))
+
+	def find_conflict(self, timestamp, user=None):
+		"""
+			Output:
+
+				position, session
+				position - insertion point of timestamp in the queue of user (None - all sessions)
+				session  - session of the queue closer than min_delay_time_sec or None
+		"""
+		with self.lock:
+			timestamps, sessions = (self._timestamps, self._sessions) if user is None else self._users.get(user, ([], []))
+			position = bisect.bisect_left(timestamps, timestamp)
+			for neighbour in (position - 1, position):
+				if (0 <= neighbour < len(timestamps)):
+					if (abs(timestamps[neighbour] - timestamp) < min_delay_time_sec):
+						return position, sessions[neighbour]
+
+		return position, None
+
+	def insert(self, session):
+		"""
+			Insert session after it was stored
+		"""
+		with self.lock:
+			for timestamps, sessions in ((self._timestamps, self._sessions), self._queue(session.user)):
+				position = bisect.bisect_right(timestamps, session.timestamp)
+				timestamps.insert(position, session.timestamp)
+				sessions.insert(position, session)
+			self._log(CHANGE_ADD, session)
+			self._own_write_done()
+
+	def remove(self, session):
+		"""
+			Remove session after it was deleted from the storage
+		"""
+		with self.lock:
+			for timestamps, sessions in ((self._timestamps, self._sessions), self._queue(session.user)):
+				position = bisect.bisect_left(timestamps, session.timestamp)
+				while (position < len(sessions) and sessions[position].timestamp == session.timestamp):
+					if (sessions[position] == session):
+						del timestamps[position]
+						del sessions[position]
+						break
+					position += 1
+			self._log(CHANGE_REMOVE, session)
+			self._own_write_done()
+
+	def pop_before(self, timestamp):
+		"""
+			Remove sessions earlier than timestamp, after they were removed from the storage
+		"""
+		with self.lock:
+			position = bisect.bisect_left(self._timestamps, timestamp)
+			popped = self._sessions[:position]
+			del self._timestamps[:position]
+			del self._sessions[:position]
+
+			counts = {}
+			for session in popped:
+				counts[session.user] = counts.get(session.user, 0) + 1
+				self._log(CHANGE_REMOVE, session)
+			for user, count in counts.items(): # the earliest sessions of each queue
+				timestamps, sessions = self._queue(user)
+				del timestamps[:count]
+				del sessions[:count]
 
-	new_datetime = None
+			self._own_write_done()
+
+	def _log(self, change, session):
+		self.version += 1
+		self._changes.append((self.version, change, session))
+		if (len(self._changes) > max_changes_n):
+			dropped = len(self._changes) - max_changes_n // 2
+			self._log_start = self._changes[dropped - 1][0]
+			del self._changes[:dropped]
+
+	def changes_since(self, version):
+		"""
+			Output:
+
+				version, changes, sessions
+				changes  - list of (change, session) after version, None if the index was
+				           rebuilt (or the log trimmed) since version, then sessions is a
+				           copy of all sessions (otherwise None)
+		"""
+		with self.lock:
+			if (version is None or version < self._log_start):
+				return self.version, None, list(self._sessions)
+			return self.version, [(change, session) for _, change, session in self._changes[version - self._log_start:]], None
+
+	def _own_write_done(self):
+		# keep the index if nobody else wrote to the storage meanwhile,
+		# otherwise it is reloaded on the next refresh()
+		expected = self._store.own_write_generation(self._generation)
+		if (expected is not None and expected == self._store.generation()):
+			self._generation = expected
+		else:
+			self._generation = None
+
+	def sessions(self):
+		"""
+			Indexed sessions sorted by timestamp (do not modify)
+		"""
+		return self._sessions
+
+	def user_sessions(self, user):
+		"""
+			Indexed sessions of user sorted by timestamp (do not modify)
+		"""
+		return self._users.get(user, ([], []))[1]
+
+
+_indices = {}
+
+def get_session_index(sessions_file):
+	"""
+		Get (cached) up to date SessionIndex of sessions_file
+	"""
+	index = _indices.get(sessions_file)
+	if index is None:
+		index = SessionIndex(sessions_file)
+		_indices[sessions_file] = index
+
+	index.refresh()
+	return index
+
+
+def parse_new_datetime(datetime_str, now):
+	"""
+		Parse datetime_str and check that it is later than now (epoch)
+
+		Output:
+			err_code, err_msg, new_timestamp (None on error)
+	"""
 
 	try:
-		new_datetime = datetime.strptime(datetime_str, datetime_format)
+		new_timestamp = Session.from_datetime_str(datetime_str, '').timestamp
 	except ValueError:
 		err_code = CHECK_SESS_ERR_BAD_FORMAT
 		err_msg = 'CHECK_SESS_ERR_BAD_FORMAT: date {} is of bad format.'.format(datetime_str)
-		return err_code, err_msg
+		return err_code, err_msg, None
 
-	now = datetime.now()
-	if (new_datetime < now):
+	if (new_timestamp < now):
 		err_code = CHECK_SESS_ERR_DATE_PASSED
 		err_msg = 'CHECK_SESS_ERR_DATE_PASSED: date {} is too late.'.format(datetime_str)
+		return err_code, err_msg, None
+
+	return CHECK_SESS_CORRECT, '', new_timestamp
+
+
+def delay_error(datetime_str, session):
+	err_code = CHECK_SESS_ERR_DATE_DELAY
+	err_msg = 'CHECK_SESS_ERR_DATE_DELAY: date {} is too close to already existing session on {}.'.format(datetime_str, session.datetime_str)
+	return err_code, err_msg
+
+
+def check_new_datetime(datetime_str, sessions_file, user=None):
+	"""
+	Description:
+		Check if new datetime is a valid:
+
+		1. Registration moment is later than 'now' (cannot register in the past)
+		2. New date is at least 5 mins separated from other dates (of the queue of user,
+		   None - of all sessions)
+
+	"""
+
+	# 1. Check that date is later than 'now'
+
+	err_code, err_msg, new_timestamp = parse_new_datetime(datetime_str, get_clock().time())
+	if (err_code > 0):
 		return err_code, err_msg
 
-	# 2. Read session-list from file
+	# 2. Look up the neighbours of the new date in the index of sessions_file
 
-	sessions_list = get_sessions_list(sessions_file)
-	for session in sessions_list:
-		session_datetime = datetime.strptime(session['datetime'], datetime_format)
-		delay_sec = abs((session_datetime - new_datetime).total_seconds())
-		if (delay_sec < min_delay_time_sec):
-			err_code = CHECK_SESS_ERR_DATE_DELAY
-			err_msg = 'CHECK_SESS_ERR_DATE_DELAY: date {} is too close to already existing session on {}.'.format(datetime_str, session['datetime'])
-			return err_code, err_msg
+	position, session = get_session_index(sessions_file).find_conflict(new_timestamp, user)
+	if session is not None:
+		return delay_error(datetime_str, session)
 
 	return CHECK_SESS_CORRECT, ''
 
 
+def check_new_datetimes(datetime_str_list, sessions_file, user=None):
+	"""
+	Description:
+		Check a batch of new datetimes as check_new_datetime does, and also against
+		each other (earlier valid candidate wins). Candidates are sorted once and
+		merged with the stored sessions in a single pass.
+
+	Output:
+		list of err_code, err_msg for each element of datetime_str_list
+	"""
+
+	results = [None] * len(datetime_str_list)
+	candidates = []
+	now = get_clock().time()
+
+	for i, datetime_str in enumerate(datetime_str_list):
+		err_code, err_msg, new_timestamp = parse_new_datetime(datetime_str, now)
+		if (err_code > 0):
+			results[i] = (err_code, err_msg)
+		else:
+			candidates.append((new_timestamp, i))
+
+	candidates.sort()
+	index = get_session_index(sessions_file)
+	stored = index.sessions() if user is None else index.user_sessions(user)
+	stored_pos = 0
+	last_accepted = None
+
+	for new_timestamp, i in candidates:
+		# advance to the first stored session not earlier than the candidate
+		while (stored_pos < len(stored) and stored[stored_pos].timestamp < new_timestamp):
+			stored_pos += 1
+
+		conflict = None
+		for neighbour in (stored_pos - 1, stored_pos):
+			if (0 <= neighbour < len(stored) and abs(stored[neighbour].timestamp - new_timestamp) < min_delay_time_sec):
+				conflict = stored[neighbour]
+		if (conflict is None and last_accepted is not None and new_timestamp - last_accepted.timestamp < min_delay_time_sec):
+			conflict = last_accepted
+
+		if conflict is not None:
+			results[i] = delay_error(datetime_str_list[i], conflict)
+		else:
+			results[i] = (CHECK_SESS_CORRECT, '')
+			last_accepted = Session(new_timestamp, '')
+
+	return results
+
+
 def check_new_url(url_str):
 	"""
-		Function checks correct correctness of the url (only syntax) 
-		using validators library.  
+		Function checks correct correctness of the url (only syntax)
+		using validators library.
 	"""
 
-	return validators.url(url_str)
\ No newline at end of file
+	return validators.url(url_str)
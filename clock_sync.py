@@ -0,0 +1,243 @@
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import http.client
+import math
+import time
+from precise_timer import sleep_until
+
+import logging
+
+"""
+clock_sync - estimation of the clock offset of the booking server.
+
+	offset = server time - local time, rtt = round trip time of a request.
+	A request sent at local time t reaches the server at server time
+	t + rtt / 2 + offset, so to be there at the opening moment it has to be
+	sent at fire_timestamp() = opening - offset - rtt / 2.
+
+	Two sources of the server time are supported (clock_sync_mode):
+
+	* 'date'  - HTTP Date header of HEAD requests (1 s resolution). Each sample
+	            bounds the offset to (date - t_received, date + 1 - t_sent); the
+	            bounds of all samples are intersected and next samples are timed
+	            to hit the expected second boundary of the server, so every
+	            sample halves the uncertainty down to the rtt.
+	* 'epoch' - time endpoint answering with the epoch time (float) in the body.
+	            The sample with the minimal rtt is used (NTP clock filter).
+
+	Samples with rtt much larger than the minimal one are dropped in both modes.
+
+	The connection of the clock may be opened in advance and kept alive (the
+	rehearsal of the reservation, see rehearsal), the synchronization then
+	reuses it. Without a synchronization the rtt measured by the rehearsal, if
+	any, is still compensated.
+
+"""
+
+logger = logging.getLogger(name='clock_sync')
+
+rtt_filter_factor = 2.0 # samples with rtt > rtt_filter_factor * minimal rtt + rtt_filter_slack_t are dropped
+rtt_filter_slack_t = 0.005
+request_timeout_t = 5.0
+
+
+class ClockSample:
+
+	__slots__ = ('sent', 'received', 'server_time')
+
+	def __init__(self, sent, received, server_time):
+		self.sent = sent
+		self.received = received
+		self.server_time = server_time
+
+	@property
+	def rtt(self):
+		return self.received - self.sent
+
+
+class ClockEstimate:
+
+	__slots__ = ('offset', 'rtt', 'uncertainty', 'samples_n')
+
+	def __init__(self, offset, rtt, uncertainty, samples_n):
+		self.offset = offset
+		self.rtt = rtt
+		self.uncertainty = uncertainty
+		self.samples_n = samples_n
+
+	def fire_timestamp(self, opening_timestamp):
+		"""
+			Local epoch when a request has to be sent to reach the server at opening_timestamp
+		"""
+		return opening_timestamp - self.offset - self.rtt / 2.0
+
+	def __repr__(self):
+		return 'ClockEstimate(offset={:.4f} s, rtt={:.4f} s, uncertainty={:.4f} s, samples={})'.format(
+			self.offset, self.rtt, self.uncertainty, self.samples_n)
+
+
+class ServerClock:
+	"""
+		Description:
+
+			Keep-alive connection to url used to sample the server time.
+	"""
+
+	def __init__(self, url, mode='date'):
+		parts = urlsplit(url)
+		self.mode = mode
+		self.host = parts.hostname
+		self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+		self.path = parts.path or '/'
+		if parts.query:
+			self.path += '?' + parts.query
+
+		if (parts.scheme == 'https'):
+			self._conn = http.client.HTTPSConnection(parts.hostname, parts.port, timeout=request_timeout_t)
+		else:
+			self._conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=request_timeout_t)
+
+	def connect(self):
+		self._conn.connect()
+
+	def ping(self):
+		"""
+			Round trip time (s) of a HEAD request, keeps the connection alive
+		"""
+		sent = time.time()
+		self._conn.request('HEAD', self.path, headers={'Cache-Control' : 'no-cache'})
+		self._conn.getresponse().read()
+		return time.time() - sent
+
+	def sample(self):
+		method = 'HEAD' if (self.mode == 'date') else 'GET'
+		sent = time.time()
+		self._conn.request(method, self.path, headers={'Cache-Control' : 'no-cache'})
+		response = self._conn.getresponse()
+		body = response.read()
+		received = time.time()
+
+		if (self.mode == 'date'):
+			date_header = response.getheader('Date')
+			if date_header is None:
+				raise ValueError('response has no Date header')
+			server_time = parsedate_to_datetime(date_header).timestamp()
+		else:
+			server_time = float(body.decode('ascii').strip())
+
+		return ClockSample(sent, received, server_time)
+
+	def close(self):
+		self._conn.close()
+
+
+def estimate_from_epoch_samples(samples):
+	"""
+		Offset of the sample with the minimal rtt, server time is taken at the midpoint of the request
+	"""
+	best = min(samples, key=lambda sample: sample.rtt)
+	offset = best.server_time - (best.sent + best.received) / 2.0
+	return ClockEstimate(offset, best.rtt, best.rtt / 2.0, len(samples))
+
+
+def date_sample_bounds(sample):
+	"""
+		Bounds of the offset given by a sample with the server time truncated to seconds
+	"""
+	return sample.server_time - sample.received, sample.server_time + 1.0 - sample.sent
+
+
+def estimate_from_date_samples(samples):
+	"""
+		Intersect offset bounds of the samples, inconsistent samples (empty intersection) restart it
+	"""
+	low, high = -math.inf, math.inf
+	for sample in samples:
+		sample_low, sample_high = date_sample_bounds(sample)
+		if (max(low, sample_low) > min(high, sample_high)):
+			low, high = sample_low, sample_high
+		else:
+			low, high = max(low, sample_low), min(high, sample_high)
+
+	rtt = min(sample.rtt for sample in samples)
+	return ClockEstimate((low + high) / 2.0, rtt, (high - low) / 2.0, len(samples))
+
+
+def filter_samples(samples):
+	min_rtt = min(sample.rtt for sample in samples)
+	return [sample for sample in samples if sample.rtt <= rtt_filter_factor * min_rtt + rtt_filter_slack_t]
+
+
+def estimate_clock_offset(url, samples_n=8, mode='date', clock=None):
+	"""
+		Description:
+
+			Estimate the offset and rtt of the server of url with samples_n requests
+			over a single keep-alive connection (first request only opens it), of
+			clock (ServerClock of url in mode, opened in advance and left open) if given.
+
+		Output:
+
+			ClockEstimate
+	"""
+
+	own_clock = clock is None
+	clock = clock or ServerClock(url, mode)
+	samples = []
+	try:
+		try:
+			clock.sample() # connect (DNS, TCP, TLS), not used
+		except (http.client.RemoteDisconnected, ConnectionError):
+			if own_clock:
+				raise
+			clock.close() # connection kept in advance was closed by the server, reopen
+			clock.sample()
+
+		for i in range(samples_n):
+			if (mode == 'date' and len(samples) > 0):
+				# send the next request so that it reaches the server at the
+				# expected second boundary of the server time
+				estimate = estimate_from_date_samples(filter_samples(samples))
+				arrival = time.time() + estimate.rtt / 2.0 + estimate.offset
+				boundary = math.floor(arrival) + 1.0
+				sleep_until(boundary - estimate.offset - estimate.rtt / 2.0)
+
+			samples.append(clock.sample())
+	finally:
+		if own_clock:
+			clock.close()
+
+	samples = filter_samples(samples)
+	if (mode == 'date'):
+		estimate = estimate_from_date_samples(samples)
+	else:
+		estimate = estimate_from_epoch_samples(samples)
+
+	logger.info('Clock of {}: {}'.format(url, estimate))
+	return estimate
+
+
+def server_fire_timestamp(opening_timestamp, url, configuration, clock=None, rtt=None):
+	"""
+		Description:
+
+			Local epoch to fire the reservation for opening_timestamp of the server of url
+			(or of clock_sync_url, if it is set), synchronized over clock (ServerClock kept
+			alive in advance) if given. Without clock synchronization (clock_sync_mode 'none')
+			or if it fails, opening_timestamp itself, minus rtt / 2 if the rtt (s) is known.
+	"""
+
+	local_fire_timestamp = opening_timestamp - (rtt / 2.0 if rtt is not None else 0.0)
+
+	mode = configuration['clock_sync_mode']
+	if (mode == 'none'):
+		return local_fire_timestamp
+
+	sync_url = configuration['clock_sync_url'] or url
+	try:
+		estimate = estimate_clock_offset(sync_url, configuration['clock_sync_samples_n'], mode, clock)
+	except (OSError, ValueError, http.client.HTTPException) as err:
+		logger.warning('Clock synchronization with {} failed, local clock is used: {}'.format(sync_url, err))
+		return local_fire_timestamp
+
+	return estimate.fire_timestamp(opening_timestamp)
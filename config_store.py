@@ -0,0 +1,158 @@
+import threading
+import fcntl
+import json
+import os
+
+import logging
+
+"""
+config_store - cached configuration shared by the bot, the service and its workers.
+
+	ConfigStore parses the JSON configuration once and serves it from memory;
+	before each use it stats the file and reparses it only when the file was
+	replaced or modified (inode, size, mtime in ns). Keys missing from the
+	user configuration (e.g. added by a newer version) are taken from the
+	default configuration.
+
+	Writes (set_value, reset) go to a temporary file which replaces the
+	configuration atomically, so readers in other processes never parse a
+	partial file. Only the keys of the user are written, never the comments
+	(keys starting with '__') or defaults of the keys the user did not set.
+
+	A running reservation worker rereads the keys of live_keys during its
+	attempts (retry_policy.RetryPolicy with live configuration), so a /configset
+	of e.g. reload_delay_t or page_reload_n applies to an attempt in progress.
+	Other keys apply from the next pass of the service or the next worker.
+
+"""
+
+logger = logging.getLogger(name='config_store')
+
+config_file_default = 'default.config'
+live_keys = ('reload_delay_t', 'page_reload_n', 'retry_budget_t', 'retry_backoff_t', 'retry_backoff_max_t')
+
+
+def without_comments(configuration):
+	"""
+		configuration without the comments (keys starting with '__')
+	"""
+	return {key : value for key, value in configuration.items() if not key.startswith('__')}
+
+
+def file_version(config_file):
+	stat = os.stat(config_file)
+	return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ConfigStore:
+	"""
+		Description:
+
+			Cached configuration of config_file with the defaults of default_file (None - no defaults).
+	"""
+
+	def __init__(self, config_file, default_file=None):
+		self.config_file = config_file
+		self.default_file = default_file
+		self.reads = 0
+		self._lock = threading.Lock()
+		self._versions = None
+		self._configuration = None
+
+	def _read(self, config_file):
+		self.reads += 1
+		with open(config_file, 'r', encoding='utf-8') as f:
+			return json.load(f)
+
+	def load(self):
+		"""
+			Output:
+				configuration dict (a copy), raises FileNotFoundError / ValueError
+		"""
+		with self._lock:
+			files = [self.config_file] + ([self.default_file] if self.default_file is not None else [])
+			versions = [file_version(config_file) for config_file in files]
+
+			if (versions != self._versions):
+				configuration = {}
+				if self.default_file is not None:
+					configuration.update(self._read(self.default_file))
+				configuration.update(self._read(self.config_file))
+				self._configuration, self._versions = configuration, versions
+				logger.debug('Configuration {} (re)loaded.'.format(self.config_file))
+
+			return dict(self._configuration)
+
+	def live(self):
+		"""
+			Current values of live_keys
+		"""
+		configuration = self.load()
+		return {key : configuration[key] for key in live_keys if key in configuration}
+
+	def defaults(self):
+		return self._read(self.default_file)
+
+	def write(self, configuration):
+		"""
+			Replace config_file with configuration atomically
+		"""
+		directory = os.path.dirname(os.path.abspath(self.config_file))
+		tmp_file = os.path.join(directory, '.{}.{}.tmp'.format(os.path.basename(self.config_file), os.getpid()))
+		try:
+			with open(tmp_file, 'w', encoding='utf-8') as f:
+				json.dump(configuration, f, indent=4)
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tmp_file, self.config_file)
+		finally:
+			if os.path.exists(tmp_file):
+				os.remove(tmp_file)
+
+	def set_value(self, key, value):
+		"""
+			Description:
+
+				Set key to value (a string, converted to the type of the key in the configuration).
+
+			Output:
+
+				converted value, raises KeyError (unknown key) or ValueError (bad type)
+		"""
+		with open(self.config_file + '.lock', 'a') as lock: # concurrent /configset keep each other's keys
+			fcntl.flock(lock, fcntl.LOCK_EX)
+
+			configuration = self.load()
+			if (key.startswith('__') or key not in configuration):
+				raise KeyError(key)
+			current = configuration[key]
+			if isinstance(current, bool):
+				if value.lower() not in ('true', 'false', '1', '0'):
+					raise ValueError(value)
+				converted = value.lower() in ('true', '1')
+			else:
+				converted = type(current)(value)
+
+			configuration = without_comments(self._read(self.config_file)) # keys of the user only
+			configuration[key] = converted
+			self.write(configuration)
+			return converted
+
+	def reset(self):
+		self.write(without_comments(self.defaults()))
+
+
+_stores = {}
+
+
+def get_config_store(config_file, default_file=config_file_default):
+	"""
+		Cached store of config_file (per process and file), default_file fills the missing keys
+	"""
+	key = (os.getpid(), os.path.abspath(config_file))
+	store = _stores.get(key)
+	if store is None:
+		store = ConfigStore(config_file, default_file if (default_file is not None and
+			os.path.abspath(default_file) != os.path.abspath(config_file)) else None)
+		_stores[key] = store
+	return store
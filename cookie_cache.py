@@ -0,0 +1,260 @@
+import selenium
+from browser_utils import launch_browser, browser_login, load_page
+from http_engine import cookie_header
+from accounts import fernet_key, account_file_suffix
+from urllib.parse import urlsplit
+import http.client
+import threading
+import json
+import time
+import os
+
+import logging
+
+try:
+	from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+	Fernet = None
+
+"""
+cookie_cache - encrypted cache of the authentication cookies of the booking site.
+
+	A full login (browser_login) costs several round trips on the path to the
+	opening. After a full login the cookies of the browser are stored in
+	cookie_cache_file, encrypted (Fernet of the cryptography package) with the
+	key of the environment variable cookie_key_env or of cookie_key_file
+	(created on the first use, readable by the owner only). Without the
+	cryptography package the cache is disabled and every reservation logs in.
+
+	Before use the cached cookies are validated cheaply: not older than
+	cookie_max_age_t, not expired, and, if cookie_check_url is set, a single
+	GET of it with the cookies answers 200 (no redirect to the login) with
+	cookie_check_text in the body. Valid cookies are injected into the browser;
+	if they are invalid or some of them cannot be injected for the page (cookies
+	of another host) the full login is done and cached. The service refreshes the
+	cache of the default account in the background every cookie_refresh_t (s)
+	(CookieRefresher). Every account has its own cache (account_cache_file()).
+
+"""
+
+logger = logging.getLogger(name='cookie_cache')
+
+cookie_cache_file = 'cookies.cache'
+cookie_key_file = 'cookies.key'
+cookie_key_env = 'RESERVATION_COOKIE_KEY'
+check_timeout_t = 5.0
+
+
+def cache_key(key_file=cookie_key_file):
+	return fernet_key(key_file, cookie_key_env)
+
+
+def account_cache_file(account):
+	"""
+		Cookie cache of account (accounts.Account, None - the default account)
+	"""
+	root, extension = os.path.splitext(cookie_cache_file)
+	return root + account_file_suffix(account) + extension
+
+
+class CookieCache:
+	"""
+		Description:
+
+			Encrypted file with the cookies of the last full login: {'cookies', 'saved', 'login_t'},
+			login_t - duration (s) of that login.
+	"""
+
+	def __init__(self, file=cookie_cache_file, key_file=cookie_key_file):
+		self.file = file
+		self.key_file = key_file
+		self.enabled = Fernet is not None
+		if not self.enabled:
+			logger.warning('cryptography is not installed, cookie cache is disabled.')
+
+	def _fernet(self):
+		return Fernet(cache_key(self.key_file))
+
+	def load(self):
+		"""
+			Output:
+				cached record or None (no cache, cache of another key, corrupted)
+		"""
+		if not self.enabled:
+			return None
+		try:
+			with open(self.file, 'rb') as f:
+				return json.loads(self._fernet().decrypt(f.read()).decode('utf-8'))
+		except FileNotFoundError:
+			return None
+		except (InvalidToken, ValueError) as err:
+			logger.warning('Cookie cache {} is unreadable: {!r}'.format(self.file, err))
+			return None
+
+	def save(self, cookies, login_t):
+		if not self.enabled:
+			return
+		record = {'cookies' : cookies, 'saved' : time.time(), 'login_t' : login_t}
+		token = self._fernet().encrypt(json.dumps(record).encode('utf-8'))
+
+		tmp_file = '{}.{}.tmp'.format(self.file, os.getpid())
+		fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(token)
+		os.replace(tmp_file, self.file) # readers never see a partial cache
+
+	def clear(self):
+		try:
+			os.remove(self.file)
+		except FileNotFoundError:
+			pass
+
+	def valid_record(self, configuration):
+		"""
+			Cached record if its cookies pass the cheap validation, otherwise None
+		"""
+		record = self.load()
+		if record is None:
+			return None
+
+		now = time.time()
+		if (now - record['saved'] > configuration['cookie_max_age_t']):
+			return None
+		if any(cookie['expiry'] < now for cookie in record['cookies'] if 'expiry' in cookie):
+			return None
+
+		if (len(configuration['cookie_check_url']) > 0):
+			try:
+				if not check_cookies(configuration['cookie_check_url'], record['cookies'],
+						configuration['cookie_check_text']):
+					return None
+			except (OSError, http.client.HTTPException) as err:
+				logger.warning('Cookie check failed: {}'.format(err))
+				return None
+
+		return record
+
+
+def check_cookies(check_url, cookies, check_text=''):
+	"""
+		GET check_url with cookies: True if it answers 200 with check_text (a login redirect is 3xx)
+	"""
+	parts = urlsplit(check_url)
+	path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+	if (parts.scheme == 'https'):
+		conn = http.client.HTTPSConnection(parts.hostname, parts.port, timeout=check_timeout_t)
+	else:
+		conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=check_timeout_t)
+	try:
+		conn.request('GET', path, headers={'Cookie' : cookie_header(cookies, parts.hostname, path)})
+		response = conn.getresponse()
+		body = response.read().decode('utf-8', errors='replace')
+	finally:
+		conn.close()
+
+	return (response.status == 200 and check_text in body)
+
+
+def inject_cookies(browser, url_str, cookies):
+	"""
+		Load url_str (WebDriver sets cookies only for the domain of the loaded page) and add cookies,
+		returns the number of injected cookies
+	"""
+	load_page(browser, url_str)
+	injected = 0
+	for cookie in cookies:
+		cookie = {key : value for key, value in cookie.items() if key in ('name', 'value', 'path', 'domain', 'secure', 'expiry')}
+		try:
+			browser.add_cookie(cookie)
+			injected += 1
+		except selenium.common.exceptions.WebDriverException as err: # cookie of another domain
+			logger.warning('Cookie {} is not injected for {}: {}'.format(cookie['name'], url_str, err))
+
+	return injected
+
+
+def cookie_login(browser, url_str, configuration, cache=None, account=None):
+	"""
+		Description:
+
+			Log in browser for url_str with account (None - the default account):
+			with its cached cookies if they are valid and all of them are injected,
+			otherwise with the full login (its cookies are cached).
+
+		Output:
+
+			True if the cached cookies were used
+	"""
+
+	cache = cache or CookieCache(account_cache_file(account))
+	start = time.monotonic()
+
+	record = cache.valid_record(configuration)
+	if record is not None:
+		try:
+			injected = inject_cookies(browser, url_str, record['cookies'])
+			if (injected == 0 or injected < len(record['cookies'])):
+				logger.warning('{} of {} cached cookies are injected for {}, full login.'.format(injected,
+					len(record['cookies']), url_str))
+			else:
+				cookie_t = time.monotonic() - start
+				logger.info('Logged in with cached cookies in {:.3f} s, {:.3f} s saved w.r.t. the full login.'.format(
+					cookie_t, record['login_t'] - cookie_t))
+				return True
+		except selenium.common.exceptions.WebDriverException as err:
+			logger.warning('Cached cookies are not injected, full login: {}'.format(err))
+
+	login_start = time.monotonic()
+	browser_login(browser, account)
+	login_t = time.monotonic() - login_start
+	cache.save(browser.get_cookies(), login_t)
+	logger.info('Full login in {:.3f} s (cache check {:.3f} s), cookies cached.'.format(login_t, login_start - start))
+
+	return False
+
+
+class CookieRefresher:
+	"""
+		Description:
+
+			Background thread of the service keeping the cookie cache valid: every
+			period (s) the cache is validated and refreshed with a full login in a
+			headless browser if it is invalid or older than period.
+	"""
+
+	def __init__(self, configuration, cache=None):
+		self.configuration = configuration
+		self.period = configuration['cookie_refresh_t']
+		self.cache = cache or CookieCache()
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._run, name='cookie-refresher', daemon=True)
+
+	def start(self):
+		if (self.cache.enabled and self.period > 0):
+			self._thread.start()
+		return self
+
+	def _run(self):
+		while not self._stopped.is_set():
+			record = self.cache.valid_record(self.configuration)
+			if (record is None or time.time() - record['saved'] >= self.period):
+				self.refresh()
+			self._stopped.wait(self.period)
+
+	def refresh(self):
+		browser = None
+		try:
+			browser = launch_browser(self.configuration)
+			start = time.monotonic()
+			browser_login(browser)
+			self.cache.save(browser.get_cookies(), time.monotonic() - start)
+			logger.info('Cookie cache refreshed.')
+		except Exception as err:
+			logger.error('Cookie cache refresh failed: {}'.format(err))
+		finally:
+			if browser is not None:
+				browser.quit()
+
+	def stop(self):
+		self._stopped.set()
@@ -0,0 +1,244 @@
+from urllib.parse import urlsplit
+from retry_policy import http_page_state, PAGE_CONFIRMED, PAGE_ERROR, PAGE_FULL
+from latency_stats import PhaseTimer, PHASE_HTTP_ATTEMPT
+import http.client
+import select
+import time
+
+import logging
+
+"""
+http_engine - direct HTTP reservation engine.
+
+	Reuses the cookies of the logged in browser and submits the reservation
+	request (http_reserve_method to http_reserve_url with the http_reserve_data
+	body) over a keep-alive connection opened in advance, instead of loading
+	the page and clicking through WebDriver. Response is a success if its status
+	is 2xx and it contains http_success_text (if it is set), the other responses
+	are classified for the retry policy (retry_policy.http_page_state).
+
+	A connection closed by the server while idle is reopened before the
+	request is written. A request lost after it was written (reset, no
+	response) is repeated at once only for idempotent methods. Otherwise the
+	server may have booked it already: the next attempt first checks check_url
+	with a GET and submits the request again only if the page is neither
+	confirmed nor full.
+
+	Selenium remains the fallback: reservation_process switches to it if the
+	HTTP attempts fail.
+
+"""
+
+logger = logging.getLogger(name='http_engine')
+
+request_timeout_t = 5.0
+ENGINE_SELENIUM, ENGINE_HTTP = 'selenium', 'http'
+engines = (ENGINE_SELENIUM, ENGINE_HTTP)
+idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+def domain_matches(host, cookie_domain):
+	cookie_domain = cookie_domain.lstrip('.')
+	return (host == cookie_domain or host.endswith('.' + cookie_domain))
+
+
+def cookie_header(cookies, host, path):
+	"""
+		Cookie header for host and path from cookies in the WebDriver format (browser.get_cookies())
+	"""
+	pairs = []
+	for cookie in cookies:
+		if ('domain' in cookie and not domain_matches(host, cookie['domain'])):
+			continue
+		if not path.startswith(cookie.get('path', '/')):
+			continue
+		pairs.append('{}={}'.format(cookie['name'], cookie['value']))
+
+	return '; '.join(pairs)
+
+
+def connection_dropped(conn):
+	"""
+		True if the idle keep-alive connection conn (http.client) is closed or closed by the server
+	"""
+	if conn.sock is None:
+		return True
+	readable, writable, failed = select.select([conn.sock], [], [], 0.0)
+	return len(readable) > 0 # end of stream (or an unexpected response) on an idle connection
+
+
+class HttpReservationEngine:
+	"""
+		Description:
+
+			Keep-alive connection to the booking site submitting the reservation request.
+
+		Input:
+
+			reserve_url  : url of the reservation request
+			cookies      : cookies of the logged in browser (browser.get_cookies())
+			method       : HTTP method of the request
+			data         : body of the request (urlencoded form), '' - no body
+			success_text : text in the response body that confirms the reservation
+			full_text    : text in the response body telling there are no places left
+			check_url    : page checked with a GET after a lost request (None - reserve_url)
+	"""
+
+	def __init__(self, reserve_url, cookies, method='POST', data='', success_text='', full_text='', check_url=None):
+		parts = urlsplit(reserve_url)
+		self.scheme = parts.scheme
+		self.host = parts.hostname
+		self.port = parts.port
+		self.path = parts.path or '/'
+		if parts.query:
+			self.path += '?' + parts.query
+
+		self.method = method.upper()
+		self.data = data.encode('utf-8')
+		self.success_text = success_text
+		self.full_text = full_text
+		self.headers = {
+			'Cookie'     : cookie_header(cookies, self.host, self.path),
+			'Connection' : 'keep-alive'
+		}
+		if (len(self.data) > 0):
+			self.headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+		check_parts = urlsplit(check_url) if check_url else parts
+		self.check_path = (check_parts.path or '/') + ('?' + check_parts.query if check_parts.query else '')
+		if (check_parts.hostname != self.host or check_parts.port != self.port):
+			logger.warning('Check url {} is not on the host of the reservation request, it is not used.'.format(check_url))
+			self.check_path = None
+
+		self._conn = None
+		self._lost = False # a written request got no response, the server may have handled it
+
+	def connect(self):
+		"""
+			Open the connection in advance (DNS, TCP, TLS are off the critical path)
+		"""
+		if (self.scheme == 'https'):
+			self._conn = http.client.HTTPSConnection(self.host, self.port, timeout=request_timeout_t)
+		else:
+			self._conn = http.client.HTTPConnection(self.host, self.port, timeout=request_timeout_t)
+		self._conn.connect()
+
+	def attempt(self):
+		"""
+			Description:
+
+				Submit the reservation request once. A connection closed by the
+				server while idle is reopened first. A request lost after it was
+				written is repeated at once for an idempotent method only, otherwise
+				the error is raised and the next attempt checks check_url first.
+
+			Output:
+
+				page state (retry_policy), status, body, Retry-After (s) or None
+		"""
+		if (self._conn is None or connection_dropped(self._conn)):
+			self.connect()
+
+		if self._lost:
+			checked = self._check()
+			if checked is not None:
+				return checked
+
+		try:
+			response = self._request(self.method, self.path, self.data or None)
+		except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+			self.connect()
+			if (self.method not in idempotent_methods):
+				self._lost = True
+				raise # may have been booked, never resent blindly
+			response = self._request(self.method, self.path, self.data or None)
+
+		self._lost = False
+		return self._response_state(response)
+
+	def _check(self):
+		"""
+			State of check_url after a lost request: (state, status, body, retry_after) if the lost
+			request was confirmed or there are no places left, None - the request is submitted again
+		"""
+		if self.check_path is None:
+			return None
+
+		response = self._request('GET', self.check_path, None)
+		checked = self._response_state(response)
+		logger.info('Page {} after a lost reservation request: status {}, {}.'.format(self.check_path,
+			checked[1], checked[0]))
+		if (checked[0] == PAGE_FULL or (checked[0] == PAGE_CONFIRMED and len(self.success_text) > 0)):
+			return checked # without success_text any 2xx page would look confirmed
+
+		self._lost = False
+		return None
+
+	def _response_state(self, response):
+		body = response.read().decode('utf-8', errors='replace')
+		state = http_page_state(response.status, body, self.success_text, self.full_text)
+
+		retry_after = response.getheader('Retry-After')
+		try:
+			retry_after = float(retry_after) if retry_after is not None else None
+		except ValueError:
+			retry_after = None # HTTP date form is not used by booking sites
+
+		return state, response.status, body, retry_after
+
+	def _request(self, method, path, body):
+		self._conn.request(method, path, body=body, headers=self.headers)
+		return self._conn.getresponse()
+
+	def close(self):
+		if self._conn is not None:
+			self._conn.close()
+			self._conn = None
+
+
+def http_engine_from_configuration(url_str, cookies, configuration):
+	return HttpReservationEngine(configuration['http_reserve_url'] or url_str, cookies,
+		method=configuration['http_reserve_method'],
+		data=configuration['http_reserve_data'],
+		success_text=configuration['http_success_text'],
+		full_text=configuration['page_full_text'],
+		check_url=url_str)
+
+
+def http_reservation_attempts(engine, policy, race=None, timer=None):
+	"""
+		Description:
+
+			Submit the reservation request while policy (retry_policy.RetryPolicy) retries,
+			stops early when the race (racing.Race) is over. Attempts are timed with
+			timer (latency_stats.PhaseTimer).
+
+		Output:
+
+			True if the reservation was confirmed
+	"""
+
+	timer = timer or PhaseTimer()
+
+	while True:
+		if (race is not None and race.over()):
+			return False
+
+		start = time.monotonic()
+		try:
+			state, status, body, retry_after = engine.attempt()
+		except (OSError, http.client.HTTPException) as err:
+			logger.warning('HTTP reservation attempt {} failed: {}'.format(len(policy.timeline), err))
+			state, status, retry_after = PAGE_ERROR, None, None
+
+		duration = time.monotonic() - start
+		timer.record(PHASE_HTTP_ATTEMPT, duration, state != PAGE_ERROR)
+		logger.info('HTTP reservation attempt {}: status {}, {}, {:.3f} s.'.format(len(policy.timeline), status, state, duration))
+
+		delay = policy.next_delay(state, duration, retry_after)
+		if delay is None:
+			if (state == PAGE_FULL and race is not None):
+				race.stop()
+			return (state == PAGE_CONFIRMED)
+
+		time.sleep(delay)
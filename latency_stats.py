@@ -0,0 +1,330 @@
+from contextlib import contextmanager
+from collections import deque
+from functools import wraps
+import multiprocessing
+import bisect
+import threading
+import queue
+import json
+import math
+import os
+import time
+
+import logging
+
+"""
+latency_stats - per-phase latency of the reservation subprocesses.
+
+	A reservation subprocess times its phases (display start, Chrome launch,
+	login, page loads, find-element, click, ...) with a PhaseTimer and sends
+	every timing as an event to the service over a multiprocessing queue. The
+	service appends the events (tagged with the session) to the latency file
+	next to the file of passed sessions (the newest latency_keep_n .. 2 *
+	latency_keep_n of them are kept), the bot aggregates them into latency
+	histograms with p50/p95/p99 per phase (/stats). Events of a reservation
+	made by several accounts at once (fan-out) carry the account, its outcome
+	is the PHASE_RESULT event (reservation_results(), /results). A rehearsal
+	which found problems (PHASE_REHEARSAL with problems in its detail) is also
+	kept as an alert, the bot forwards alerts to the users.
+
+	HandlerMetrics keeps the same kind of in-memory statistics of the handlers
+	of the bot (/botstats).
+
+"""
+
+logger = logging.getLogger(name='latency_stats')
+
+PHASE_DISPLAY_START = 'display_start'
+PHASE_CHROME_LAUNCH = 'chrome_launch'
+PHASE_LOGIN = 'login'
+PHASE_LEASE = 'browser_lease'
+PHASE_CLOCK_SYNC = 'clock_sync'
+PHASE_FIRST_LOAD = 'first_page_load'
+PHASE_RELOAD = 'reload'
+PHASE_FIND_ELEMENT = 'find_element'
+PHASE_CLICK = 'click'
+PHASE_HTTP_ATTEMPT = 'http_attempt'
+PHASE_SCREENSHOT = 'screenshot'
+PHASE_FIRING_ERROR = 'firing_error' # lateness of the firing (>= 0, the timer never fires early), not a duration
+PHASE_RESULT = 'result' # outcome of the reservation (ok - booked), duration from the firing moment
+PHASE_REHEARSAL = 'rehearsal' # rehearsal before the opening (ok - no problems), see rehearsal
+PHASE_DNS = 'dns_resolve'
+PHASE_CONNECT = 'connect' # TCP and TLS handshakes
+PHASE_RTT = 'rtt' # minimal round trip time to the site, measured by the rehearsal
+PHASE_DETECT_POLL = 'detect_poll' # poll of the opening detector
+PHASE_DETECTED = 'opening_detected' # delay (s) of the detected opening from the firing moment, not a duration
+PHASE_SKIPPED = 'skipped' # reservation not started by the service (problems in the detail), not a duration
+
+percentiles = (50, 95, 99)
+progress_keep_t = 86400 # last events of reservations are kept this long (s)
+alerts_keep_n = 256 # last alerts kept by the service
+latency_keep_n = 50000 # newest events kept in the latency file, compacted when it has twice as many
+histogram_buckets_t = tuple(0.001 * 2 ** i for i in range(16)) # 1 ms .. 32 s
+
+
+def latency_file(sessions_passed_file):
+	"""
+		Latency file next to the file of passed sessions (sessions_passed.db -> sessions_passed.latency)
+	"""
+	return os.path.splitext(sessions_passed_file)[0] + '.latency'
+
+
+class PhaseTimer:
+	"""
+		Description:
+
+			Times phases of the reservation of one session, events go to the events
+			queue (None - only logged).
+
+		Input:
+
+			events    : multiprocessing.Queue of the service or None
+			timestamp : registration timestamp of the session
+			url       : url of the session
+			account   : name of the account making the reservation (None - the default account)
+	"""
+
+	def __init__(self, events=None, timestamp=None, url=None, account=None):
+		self.events = events
+		self.timestamp = timestamp
+		self.url = url
+		self.account = account
+
+	@contextmanager
+	def phase(self, name):
+		start = time.monotonic()
+		ok = False
+		try:
+			yield
+			ok = True
+		finally:
+			self.record(name, time.monotonic() - start, ok)
+
+	def record(self, name, duration, ok=True, detail=None):
+		event = {
+			'session' : self.timestamp,
+			'url'     : self.url,
+			'phase'   : name,
+			'time'    : time.time(),
+			'duration': duration,
+			'ok'      : ok,
+			'account' : self.account
+		}
+		if detail is not None:
+			event['detail'] = detail
+		logger.debug('Phase {} of {}{}: {:.4f} s{}.'.format(name, self.url,
+			'' if self.account is None else ' ({})'.format(self.account), duration, '' if ok else ' (failed)'))
+
+		if self.events is not None:
+			try:
+				self.events.put_nowait(event)
+			except (queue.Full, OSError, ValueError) as err: # never delay the reservation
+				logger.warning('Latency event of {} is lost: {}'.format(name, err))
+
+
+class LatencyRecorder:
+	"""
+		Description:
+
+			Service side: receives events of the reservation subprocesses (events queue)
+			and appends them to file (JSON lines) in a background thread; file is compacted
+			to the newest latency_keep_n events when it has twice as many. The last event
+			of every reservation is kept in progress ((session, url, account) -> event),
+			the last alerts_keep_n events with problems in alerts.
+	"""
+
+	def __init__(self, file):
+		self.file = file
+		self.events = multiprocessing.Queue()
+		self.progress = {}
+		self.alerts = deque(maxlen=alerts_keep_n)
+		self._lines = self._count_lines()
+		self._thread = threading.Thread(target=self._run, name='latency-recorder', daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		stopped = False
+		while not stopped:
+			batch = [self.events.get()]
+			try:
+				while True:
+					batch.append(self.events.get_nowait())
+			except queue.Empty:
+				pass
+
+			if None in batch:
+				stopped = True
+				batch = [event for event in batch if event is not None]
+
+			if (len(batch) > 0):
+				for event in batch:
+					self.progress[(event['session'], event['url'], event.get('account'))] = event
+					if event.get('detail', {}).get('problems'):
+						self.alerts.append(event)
+				self._prune_progress()
+				self._append(batch)
+
+	def _prune_progress(self):
+		oldest = time.time() - progress_keep_t
+		for key, event in list(self.progress.items()):
+			if (event['time'] < oldest):
+				del self.progress[key]
+
+	def _count_lines(self):
+		try:
+			with open(self.file, 'rb') as f:
+				return sum(1 for line in f)
+		except OSError:
+			return 0
+
+	def _append(self, batch):
+		try:
+			with open(self.file, 'a', encoding='utf-8') as f:
+				f.write(''.join(json.dumps(event) + '\n' for event in batch))
+		except OSError as err:
+			logger.error('Could not write {} latency events to {}: {}'.format(len(batch), self.file, err))
+			return
+
+		self._lines += len(batch)
+		if (self._lines > 2 * latency_keep_n):
+			self._compact()
+
+	def _compact(self):
+		"""
+			Rewrite the file with its newest latency_keep_n events (the readers see the old
+			or the new file, never a partial one)
+		"""
+		events = load_latency_events(self.file)[-latency_keep_n:]
+		compacted_file = self.file + '.tmp'
+		try:
+			with open(compacted_file, 'w', encoding='utf-8') as f:
+				f.write(''.join(json.dumps(event) + '\n' for event in events))
+			os.replace(compacted_file, self.file)
+		except OSError as err:
+			logger.error('Could not compact the latency file {}: {}'.format(self.file, err))
+			return
+
+		logger.info('Latency file {} compacted from {} to {} events.'.format(self.file, self._lines, len(events)))
+		self._lines = len(events)
+
+	def close(self, timeout=1.0):
+		self.events.put(None)
+		self._thread.join(timeout)
+
+
+def load_latency_events(file):
+	events = []
+	try:
+		with open(file, 'r', encoding='utf-8') as f:
+			for line in f:
+				try:
+					events.append(json.loads(line))
+				except ValueError:
+					continue # line cut by a killed service
+	except FileNotFoundError:
+		pass
+
+	return events
+
+
+def percentile(sorted_values, p):
+	"""
+		Nearest-rank percentile p (0..100] of sorted_values
+	"""
+	rank = max(1, math.ceil(p / 100.0 * len(sorted_values)))
+	return sorted_values[rank - 1]
+
+
+def latency_histograms(events, account=None):
+	"""
+		Description:
+
+			Aggregate latency events per phase (failed phases are skipped), of account only
+			if given.
+
+		Output:
+
+			{phase : {'n', 'p50', 'p95', 'p99', 'max', 'buckets'}}, buckets - counts of
+			durations up to histogram_buckets_t[i] (last one - all the longer ones)
+	"""
+
+	durations = {}
+	for event in events:
+		if (event.get('ok', True) and (account is None or event.get('account') == account)):
+			durations.setdefault(event['phase'], []).append(event['duration'])
+
+	histograms = {}
+	for phase, values in durations.items():
+		values.sort()
+		buckets = [0] * (len(histogram_buckets_t) + 1)
+		for value in values:
+			buckets[bisect.bisect_left(histogram_buckets_t, value)] += 1
+
+		histogram = {'n' : len(values), 'max' : values[-1], 'buckets' : buckets}
+		for p in percentiles:
+			histogram['p{}'.format(p)] = percentile(values, p)
+		histograms[phase] = histogram
+
+	return histograms
+
+
+def reservation_results(events, accounts=None):
+	"""
+		Description:
+
+			Outcome of every reservation per account: the last PHASE_RESULT event of
+			each (session, url, account), of the accounts only if given.
+
+		Output:
+
+			list of result events, oldest session first
+	"""
+
+	results = {}
+	for event in events:
+		if (event['phase'] == PHASE_RESULT and (accounts is None or event.get('account') in accounts)):
+			results[(event['session'], event['url'], event.get('account'))] = event
+
+	return sorted(results.values(), key=lambda event: (event['session'], event.get('account') or ''))
+
+
+class HandlerMetrics:
+	"""
+		Description:
+
+			In-memory latency of named handlers (last max_samples_n per handler),
+			safe to update from several threads.
+	"""
+
+	def __init__(self, max_samples_n=1000):
+		self.max_samples_n = max_samples_n
+		self._lock = threading.Lock()
+		self._events = {}
+
+	def record(self, name, duration, ok=True):
+		with self._lock:
+			events = self._events.get(name)
+			if events is None:
+				events = self._events[name] = deque(maxlen=self.max_samples_n)
+			events.append({'phase' : name, 'duration' : duration, 'ok' : ok})
+
+	def timed(self, func):
+		"""
+			Decorator recording the duration of every call of func under its name
+		"""
+		@wraps(func)
+		def wrapped(*args, **kwargs):
+			start = time.monotonic()
+			ok = False
+			try:
+				result = func(*args, **kwargs)
+				ok = True
+				return result
+			finally:
+				self.record(func.__name__, time.monotonic() - start, ok)
+		return wrapped
+
+	def histograms(self):
+		with self._lock:
+			events = [event for name_events in self._events.values() for event in name_events]
+		return latency_histograms(events)
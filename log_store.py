@@ -0,0 +1,296 @@
+from datetime import datetime
+import logging.handlers
+import logging
+import bisect
+import fcntl
+import time
+import re
+import os
+
+"""
+log_store - rotated log files of the bot and of the service and queries over them.
+
+	setup_logging() writes the log of a process to log_file through
+	SegmentRotatingFileHandler: the file is rotated (log_file.1, log_file.2, ...,
+	at most log_backup_n segments) when it grows over log_max_bytes or its first
+	record is older than log_rotate_t (s). Subprocesses forked by the service
+	write to the same file, rotation is serialized by a lock file and the other
+	processes reopen the new file.
+
+	query_log() returns the last lines_n records (multi-line records, e.g.
+	tracebacks, count as one) matching a time range, a minimal level and a
+	substring. Segments are read backwards from their end in blocks, newest
+	segment first, so a dump costs O(requested records), not O(log size). The
+	end of a time range is found by bisection over the byte offsets of a
+	segment; probed offsets are kept in a sparse offset index per segment
+	(keyed by inode, so it survives renames by rotation).
+
+"""
+
+log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+log_max_bytes = 5 * 1024 * 1024
+log_rotate_t = 7 * 86400
+log_backup_n = 10
+
+read_block_size = 64 * 1024
+index_min_gap = 4 * 1024 # bisection stops on gaps smaller than this (bytes)
+
+levels = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+record_header_re = re.compile(rb'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d{3}) - .*? - (DEBUG|INFO|WARNING|ERROR|CRITICAL) - ')
+
+
+def parse_record_header(line):
+	"""
+		Output:
+			timestamp (epoch), level of a record header line, or None, None for a continuation line
+	"""
+	match = record_header_re.match(line)
+	if match is None:
+		return None, None
+	timestamp = time.mktime(time.strptime(match.group(1).decode('ascii'), '%Y-%m-%d %H:%M:%S'))
+	return timestamp + int(match.group(2)) / 1000.0, match.group(3).decode('ascii')
+
+
+class SegmentRotatingFileHandler(logging.handlers.RotatingFileHandler):
+	"""
+		Description:
+
+			Size and time rotating file handler, safe for processes sharing the file.
+	"""
+
+	def __init__(self, filename, max_bytes=None, rotate_t=None, backup_n=None):
+		super().__init__(filename, mode='a', encoding='utf-8',
+			maxBytes=log_max_bytes if max_bytes is None else max_bytes,
+			backupCount=log_backup_n if backup_n is None else backup_n)
+		self.rotate_t = log_rotate_t if rotate_t is None else rotate_t
+		self._segment = None # (inode, timestamp of its first record)
+
+	def _reopen_if_rotated(self):
+		# another process rotated the file: continue in the new one
+		if self.stream is None:
+			return
+		try:
+			inode = os.stat(self.baseFilename).st_ino
+		except FileNotFoundError:
+			inode = None
+		if (inode != os.fstat(self.stream.fileno()).st_ino):
+			self.stream.close()
+			self.stream = self._open()
+
+	def _segment_start(self):
+		inode = os.fstat(self.stream.fileno()).st_ino
+		if (self._segment is None or self._segment[0] != inode or self._segment[1] is None):
+			with open(self.baseFilename, 'rb') as f:
+				self._segment = (inode, parse_record_header(f.readline())[0])
+		return self._segment[1]
+
+	def shouldRollover(self, record):
+		self._reopen_if_rotated()
+		if super().shouldRollover(record):
+			return True
+
+		if (self.rotate_t > 0 and self.stream is not None):
+			start = self._segment_start()
+			if (start is not None and record.created - start >= self.rotate_t):
+				return True
+
+		return False
+
+	def doRollover(self):
+		with open(self.baseFilename + '.lock', 'a') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			try:
+				inode = os.stat(self.baseFilename).st_ino
+			except FileNotFoundError:
+				inode = None
+
+			if (self.stream is not None and inode != os.fstat(self.stream.fileno()).st_ino):
+				self._reopen_if_rotated() # rotated by another process meanwhile
+			else:
+				super().doRollover()
+				self._segment = None
+
+
+def setup_logging(log_file, level=logging.DEBUG):
+	"""
+		Log of the process (and of its forked subprocesses) to the rotated log_file
+	"""
+	handler = SegmentRotatingFileHandler(log_file)
+	handler.setFormatter(logging.Formatter(log_format))
+	logging.basicConfig(level=level, handlers=[handler])
+
+
+def log_segments(log_file):
+	"""
+		Existing segments of log_file, newest first
+	"""
+	segments = [log_file] if os.path.exists(log_file) else []
+	i = 1
+	while os.path.exists('{}.{}'.format(log_file, i)):
+		segments.append('{}.{}'.format(log_file, i))
+		i += 1
+	return segments
+
+
+def reverse_lines(f, end):
+	"""
+		Lines (bytes, without the line break) of the file f before the offset end, last line first
+	"""
+	position = end
+	tail = b''
+	while (position > 0):
+		size = min(read_block_size, position)
+		position -= size
+		f.seek(position)
+		block = f.read(size) + tail
+		lines = block.split(b'\n')
+		tail = lines[0] # may continue in the previous block
+		for line in reversed(lines[1:]):
+			yield line
+	yield tail
+
+
+def reverse_records(f, end):
+	"""
+		Records (timestamp, level, text) of the file f before the offset end, last record first;
+		lines before the first header of the file form a record without a timestamp
+	"""
+	lines = []
+	for line in reverse_lines(f, end):
+		if (len(line) == 0 and len(lines) == 0):
+			continue # trailing line break
+		lines.append(line)
+		timestamp, level = parse_record_header(line)
+		if timestamp is not None:
+			yield timestamp, level, b'\n'.join(reversed(lines)).decode('utf-8', errors='replace')
+			lines = []
+
+	if (len(lines) > 0):
+		yield None, None, b'\n'.join(reversed(lines)).decode('utf-8', errors='replace')
+
+
+class SegmentIndex:
+	"""
+		Description:
+
+			Sparse offset index of a log segment: probed offset -> (offset, timestamp)
+			of the first record starting at or after it, filled lazily by bisections.
+	"""
+
+	def __init__(self, size):
+		self.size = size
+		self._offsets = []
+		self._records = []
+
+	def grow(self, size):
+		# the active segment only grows: probes which reached its end are stale
+		if (size != self.size):
+			self.size = size
+			kept = [(offset, record) for offset, record in zip(self._offsets, self._records) if record[1] is not None]
+			self._offsets = [offset for offset, record in kept]
+			self._records = [record for offset, record in kept]
+
+	def probe(self, f, offset):
+		i = bisect.bisect_left(self._offsets, offset)
+		if (i < len(self._offsets) and self._offsets[i] == offset):
+			return self._records[i]
+
+		f.seek(offset)
+		if (offset > 0):
+			f.readline() # skip the rest of the line cut by offset
+		record = (self.size, None)
+		while (f.tell() < self.size):
+			record_offset = f.tell()
+			timestamp = parse_record_header(f.readline())[0]
+			if timestamp is not None:
+				record = (record_offset, timestamp)
+				break
+
+		self._offsets.insert(i, offset)
+		self._records.insert(i, record)
+		return record
+
+	def end_offset(self, f, until):
+		"""
+			Offset from which all records of the segment are later than until
+		"""
+		low, high = 0, self.size
+		while (high - low > index_min_gap):
+			middle = (low + high) // 2
+			record_offset, timestamp = self.probe(f, middle)
+			if (timestamp is None or timestamp > until):
+				high = middle
+			else:
+				low = middle
+
+		# records between the probes of low and high are filtered by the reader
+		return self.probe(f, high)[0] if (high < self.size) else self.size
+
+
+_indices = {}
+
+def segment_index(f):
+	stat = os.fstat(f.fileno())
+	key = (stat.st_dev, stat.st_ino)
+	index = _indices.get(key)
+	if index is None:
+		index = SegmentIndex(stat.st_size)
+		_indices[key] = index
+	else:
+		index.grow(stat.st_size)
+	return index
+
+
+def query_log(log_file, lines_n, since=None, until=None, min_level=None, substring=None):
+	"""
+		Description:
+
+			Last lines_n records of log_file (over all its segments) with timestamp in
+			[since, until] (epoch, None - unbounded), level at least min_level (levels)
+			and containing substring.
+
+		Output:
+
+			list of record texts, oldest first
+	"""
+
+	min_level_i = levels.index(min_level) if min_level is not None else 0
+	records = []
+
+	for segment in log_segments(log_file):
+		try:
+			f = open(segment, 'rb')
+		except FileNotFoundError:
+			continue # removed by a rotation meanwhile
+
+		with f:
+			index = segment_index(f)
+			end = index.size if until is None else index.end_offset(f, until)
+
+			for timestamp, level, text in reverse_records(f, end):
+				if timestamp is not None:
+					if (until is not None and timestamp > until):
+						continue
+					if (since is not None and timestamp < since):
+						return list(reversed(records)) # older segments are even older
+				if (min_level_i > 0 and (level is None or levels.index(level) < min_level_i)):
+					continue
+				if (substring is not None and substring not in text):
+					continue
+
+				records.append(text)
+				if (len(records) >= lines_n):
+					return list(reversed(records))
+
+	return list(reversed(records))
+
+
+def parse_log_time(value, now=None):
+	"""
+		Epoch of a relative (30s, 15m, 2h, 1d - before now) or an absolute (dd/mm/yyyy-hh:mm) time,
+		raises ValueError
+	"""
+	units = {'s' : 1, 'm' : 60, 'h' : 3600, 'd' : 86400}
+	if (len(value) > 1 and value[-1] in units and value[:-1].replace('.', '', 1).isdigit()):
+		return (now or time.time()) - float(value[:-1]) * units[value[-1]]
+	return datetime.strptime(value, '%d/%m/%Y-%H:%M').timestamp()
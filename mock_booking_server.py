@@ -0,0 +1,246 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.utils import formatdate
+import argparse
+import hashlib
+import threading
+import socket
+import time
+
+"""
+mock_booking_server - local stub of the booking site for tests and benchmarks.
+
+	Runs offline, its clock can be deliberately skewed (skew, s) w.r.t. the local
+	clock: the skew is applied to the Date header of every response and to the
+	time endpoint.
+
+	Registration opens at a scripted instant (opening, server epoch; None -
+	always open), actually late (s) after it, and is sold out sold_out_after (s)
+	after the actual opening (None - never). Every response is delayed by
+	latency (s): half of it before the request is handled, half after.
+	drop_connections() closes the open keep-alive connections, as a server
+	closing idle connections does.
+
+	GET/HEAD /time  - server epoch time (float) in the body
+	GET /login      - login form (ids username / password, button name login),
+	                  sets the `session` cookie as well
+	POST /login     - sets the `session` cookie and redirects to /
+	POST /reserve   - reservation request: confirmed only with the `session` cookie
+	                  and only while registration is open
+	GET /static/*   - resources of the pages: stylesheet, web font, image and a
+	                  script of a third-party host (localhost instead of 127.0.0.1),
+	                  so that the browser profiles load different amounts
+	GET/HEAD /*     - reservation page: not open yet, form with the button name
+	                  reserve (POST /reserve), or sold out; with an ETag, 304 to a
+	                  request with the same If-None-Match
+
+	Usage:
+		python mock_booking_server.py --port 8000 --skew 0.35 --open-in 60 --latency 0.02
+
+"""
+
+reserve_button_name = 'reserve'
+not_open_text = 'Registration is not open yet'
+confirmed_text = 'Reservation confirmed'
+sold_out_text = 'Sold out'
+
+asset_bytes = 256 * 1024 # size of the font and the image
+
+login_page = ('<html><body><form method="post" action="/login">'
+	'<input id="username" name="username"><input id="password" name="password" type="password">'
+	'<button type="submit" name="login">Login</button></form></body></html>')
+reserve_form = ('<form method="post" action="/reserve">'
+	'<button type="submit" name="' + reserve_button_name + '">Reserve</button></form>')
+page_head = ('<head><link rel="stylesheet" href="/static/style.css">'
+	'<script src="http://localhost:{port}/static/tracker.js"></script></head>')
+static_files = {
+	'/static/style.css'  : ('text/css', '@font-face {font-family: site; src: url(/static/font.woff2);} '
+		'body {font-family: site; background: url(/static/banner.png);}'),
+	'/static/font.woff2' : ('font/woff2', b'\0' * asset_bytes),
+	'/static/banner.png' : ('image/png', b'\0' * asset_bytes),
+	'/static/tracker.js' : ('application/javascript', 'var tracked = true;')
+}
+
+STATE_NOT_OPEN, STATE_OPEN, STATE_SOLD_OUT = range(3)
+
+
+class MockBookingHandler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1' # keep-alive
+	disable_nagle_algorithm = True
+
+	def setup(self):
+		super().setup()
+		with self.server._lock:
+			self.server.connections.add(self.connection)
+
+	def finish(self):
+		with self.server._lock:
+			self.server.connections.discard(self.connection)
+		super().finish()
+
+	def server_time(self):
+		return time.time() + self.server.skew
+
+	def date_time_string(self, timestamp=None):
+		if timestamp is None:
+			timestamp = self.server_time()
+		return formatdate(timestamp, usegmt=True)
+
+	def send_body(self, status, body, content_type='text/plain', headers=()):
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+		if (self.server.latency > 0.0):
+			time.sleep(self.server.latency / 2.0) # response on its way back
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for header in headers:
+			self.send_header(*header)
+		self.end_headers()
+		if (self.command != 'HEAD'):
+			self.wfile.write(body)
+
+	def arrive(self):
+		if (self.server.latency > 0.0):
+			time.sleep(self.server.latency / 2.0) # request on its way to the server
+		return self.server_time()
+
+	def do_GET(self):
+		now = self.arrive()
+		if (self.path == '/time'):
+			self.send_body(200, repr(now))
+		elif (self.path == '/login'):
+			self.send_body(200, login_page, 'text/html', headers=[('Set-Cookie', 'session=mock; Path=/')])
+		elif (self.path in static_files):
+			self.send_body(200, static_files[self.path][1], static_files[self.path][0])
+		else:
+			state = self.server.state(now)
+			if (state == STATE_OPEN):
+				body = reserve_form
+			elif (state == STATE_SOLD_OUT):
+				body = sold_out_text
+			else:
+				body = not_open_text
+			page = '<html>' + page_head.format(port=self.server.server_address[1]) + '<body>' + body + '</body></html>'
+
+			etag = '"{}"'.format(hashlib.sha1(page.encode('utf-8')).hexdigest()[:16])
+			if (self.headers.get('If-None-Match') == etag):
+				self.send_body(304, '', headers=[('ETag', etag)])
+			else:
+				self.send_body(200, page, 'text/html', headers=[('ETag', etag)])
+
+	def do_HEAD(self):
+		self.do_GET()
+
+	def do_POST(self):
+		length = int(self.headers.get('Content-Length', 0))
+		self.rfile.read(length)
+		now = self.arrive()
+
+		if (self.path == '/login'):
+			self.send_body(303, '', headers=[('Set-Cookie', 'session=mock; Path=/'), ('Location', '/')])
+		elif (self.path != '/reserve'):
+			self.send_body(404, 'Not found')
+		elif ('session=' not in self.headers.get('Cookie', '')):
+			self.send_body(403, 'Login required')
+		else:
+			state = self.server.record_request(now)
+			if (state == STATE_OPEN):
+				self.send_body(200, '<html><body>' + confirmed_text + '</body></html>', 'text/html')
+			elif (state == STATE_SOLD_OUT):
+				self.send_body(200, '<html><body>' + sold_out_text + '</body></html>', 'text/html')
+			else:
+				self.send_body(200, '<html><body>' + not_open_text + '</body></html>', 'text/html')
+
+	def log_message(self, format, *args):
+		pass
+
+
+class MockBookingServer(ThreadingHTTPServer):
+
+	daemon_threads = True
+
+	def __init__(self, address, skew=0.0, latency=0.0):
+		super().__init__(address, MockBookingHandler)
+		self.skew = skew
+		self.latency = latency
+		self._lock = threading.Lock()
+		self.connections = set() # sockets of the open connections
+		self.script()
+
+	def script(self, opening=None, late=0.0, sold_out_after=None):
+		"""
+			(Re)arm the registration: announced opening (server epoch, None - always open),
+			actual opening late (s) after it, sold out sold_out_after (s) after the actual
+			opening (None - never). Recorded requests are cleared.
+		"""
+		with self._lock:
+			self.opening = opening
+			self.late = late
+			self.sold_out_after = sold_out_after
+			self.reservations = [] # server times of confirmed reservations
+			self.requests = [] # (server time, state) of all reservation requests
+
+	@property
+	def actual_opening(self):
+		return None if self.opening is None else self.opening + self.late
+
+	def state(self, now):
+		if self.opening is None:
+			return STATE_OPEN
+		if (now < self.actual_opening):
+			return STATE_NOT_OPEN
+		if (self.sold_out_after is not None and now >= self.actual_opening + self.sold_out_after):
+			return STATE_SOLD_OUT
+		return STATE_OPEN
+
+	def record_request(self, now):
+		with self._lock:
+			state = self.state(now)
+			self.requests.append((now, state))
+			if (state == STATE_OPEN):
+				self.reservations.append(now)
+		return state
+
+	def drop_connections(self):
+		"""
+			Close the open connections (the clients see the end of stream)
+		"""
+		with self._lock:
+			connections = list(self.connections)
+		for connection in connections:
+			try:
+				connection.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+
+	@property
+	def url(self):
+		return 'http://{}:{}'.format(*self.server_address)
+
+
+def start_mock_server(port=0, skew=0.0, latency=0.0):
+	"""
+		Start the server on 127.0.0.1:port (0 - any free port) in a daemon thread
+	"""
+	server = MockBookingServer(('127.0.0.1', port), skew=skew, latency=latency)
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	return server
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Local mock of the booking site.')
+	parser.add_argument('--port', type=int, default=8000)
+	parser.add_argument('--skew', type=float, default=0.0, help='server clock skew (s)')
+	parser.add_argument('--latency', type=float, default=0.0, help='delay of every response (s)')
+	parser.add_argument('--open-in', type=float, default=None, help='registration opens in (s), default - always open')
+	parser.add_argument('--late', type=float, default=0.0, help='actual opening is late by (s)')
+	parser.add_argument('--sold-out-after', type=float, default=None, help='sold out after (s) from the actual opening')
+	args = parser.parse_args()
+
+	server = MockBookingServer(('127.0.0.1', args.port), skew=args.skew, latency=args.latency)
+	opening = None if args.open_in is None else time.time() + args.skew + args.open_in
+	server.script(opening, args.late, args.sold_out_after)
+	print('Mock booking server on {} with clock skew {} s, latency {} s'.format(server.url, args.skew, args.latency))
+	server.serve_forever()
@@ -0,0 +1,256 @@
+from urllib.parse import urlsplit
+from http_engine import cookie_header
+from retry_policy import http_page_state, PAGE_NOT_OPEN, PAGE_OPEN, PAGE_ERROR, PAGE_CONFIRMED
+from latency_stats import PhaseTimer, PHASE_DETECT_POLL
+import http.client
+import hashlib
+import time
+
+import logging
+
+"""
+opening_detector - cheap detection of the moment the registration actually opens.
+
+	In the reload mode every attempt of the selenium engine loads the whole
+	reservation page in the browser until `reserve` button is there. Other
+	modes (detector_mode) wait for the opening first and click right after it:
+
+	* http - ChangePoller polls detector_url (empty - the session url; better a
+	         small page or JSON endpoint of the site) over a keep-alive connection
+	         with the cookies of the browser. Polls are conditional
+	         (If-None-Match / If-Modified-Since of the baseline response taken
+	         before the opening), an unchanged resource costs a 304 without a
+	         body. The opening is a response with detector_text, if it is empty
+	         any change of the response body w.r.t. the baseline (set
+	         detector_text for pages with changing content). Then the reload
+	         and click attempts start at once.
+	* dom  - arm_dom_observer() injects a MutationObserver into the page loaded
+	         in the browser, it clicks `reserve` inside the page as soon as the
+	         button appears or is enabled, without a reload. For pages updated
+	         by their own scripts; if nothing is clicked within
+	         detector_timeout_t (s) the reload attempts start.
+
+	Polls are paced by a retry policy (reload_delay_t, back off on errors and
+	throttling, retry_budget_t), they are not bounded by page_reload_n.
+
+"""
+
+logger = logging.getLogger(name='opening_detector')
+
+DETECTOR_RELOAD, DETECTOR_HTTP, DETECTOR_DOM = 'reload', 'http', 'dom'
+detector_modes = (DETECTOR_RELOAD, DETECTOR_HTTP, DETECTOR_DOM)
+request_timeout_t = 5.0
+dom_check_t = 0.02 # period (s) of the checks of the observer in the page
+
+# first enabled element of the locators [by, value] of `reserve` button or null (javascript)
+reserve_finder_script = """
+function findReserve(locators) {
+	for (var i = 0; i < locators.length; i++) {
+		var element = (locators[i][0] === 'name') ? document.getElementsByName(locators[i][1])[0] :
+			document.evaluate(locators[i][1], document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+		if (element && !element.disabled) {
+			return element;
+		}
+	}
+	return null;
+}
+"""
+# clicks `reserve` (first of the locators [by, value] found, enabled) once, on every mutation of the page
+dom_observer_script = reserve_finder_script + """
+var locators = arguments[0];
+function clickReserve() {
+	var element = findReserve(locators);
+	if (window.__reserveClicked || element === null) {
+		return false;
+	}
+	window.__reserveClicked = Date.now();
+	element.click();
+	return true;
+}
+window.__reserveClicked = null;
+if (!clickReserve()) {
+	window.__reserveObserver = new MutationObserver(function() {
+		if (clickReserve()) {
+			window.__reserveObserver.disconnect();
+		}
+	});
+	window.__reserveObserver.observe(document, {childList: true, subtree: true, attributes: true});
+}
+"""
+dom_disarm_script = 'if (window.__reserveObserver) { window.__reserveObserver.disconnect(); }'
+dom_clicked_script = 'return window.__reserveClicked || null;'
+
+
+def body_digest(body):
+	return hashlib.sha1(body).hexdigest()
+
+
+class ChangePoller:
+	"""
+		Description:
+
+			Keep-alive connection polling url with conditional GET requests.
+
+		Input:
+
+			url       : polled url
+			cookies   : cookies of the logged in browser (browser.get_cookies())
+			open_text : text in the response telling the registration is open
+			            ('' - any change of the response w.r.t. the baseline)
+			full_text : text in the response telling there are no places left
+	"""
+
+	def __init__(self, url, cookies, open_text='', full_text=''):
+		parts = urlsplit(url)
+		self.scheme = parts.scheme
+		self.host = parts.hostname
+		self.port = parts.port
+		self.path = parts.path or '/'
+		if parts.query:
+			self.path += '?' + parts.query
+
+		self.open_text = open_text
+		self.full_text = full_text
+		self.headers = {
+			'Cookie'     : cookie_header(cookies, self.host, self.path),
+			'Connection' : 'keep-alive'
+		}
+
+		self._conn = None
+		self._etag = None
+		self._last_modified = None
+		self._digest = None
+
+	def connect(self):
+		if (self.scheme == 'https'):
+			self._conn = http.client.HTTPSConnection(self.host, self.port, timeout=request_timeout_t)
+		else:
+			self._conn = http.client.HTTPConnection(self.host, self.port, timeout=request_timeout_t)
+		self._conn.connect()
+
+	def _get(self, headers):
+		if self._conn is None:
+			self.connect()
+
+		try:
+			self._conn.request('GET', self.path, headers=headers)
+			response = self._conn.getresponse()
+		except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+			self.connect() # closed by the server meanwhile
+			self._conn.request('GET', self.path, headers=headers)
+			response = self._conn.getresponse()
+
+		return response, response.read()
+
+	def _state(self, response, body):
+		if (response.status == 304):
+			return PAGE_NOT_OPEN
+		text = body.decode('utf-8', errors='replace')
+		state = http_page_state(response.status, text, full_text=self.full_text)
+		if (state not in (PAGE_CONFIRMED, PAGE_NOT_OPEN)): # error, throttled or full
+			return state
+		if (response.status >= 300):
+			return PAGE_NOT_OPEN # redirect
+
+		if (len(self.open_text) > 0):
+			return PAGE_OPEN if (self.open_text in text) else PAGE_NOT_OPEN
+		return PAGE_OPEN if (body_digest(body) != self._digest) else PAGE_NOT_OPEN
+
+	def baseline(self):
+		"""
+			Take the response before the opening as the reference of the changes
+
+			Output:
+				page state of the response (open if the registration is open already)
+		"""
+		response, body = self._get(self.headers)
+		self._etag = response.getheader('ETag')
+		self._last_modified = response.getheader('Last-Modified')
+		self._digest = body_digest(body)
+
+		state = self._state(response, body)
+		if (state == PAGE_OPEN and len(self.open_text) == 0):
+			return PAGE_NOT_OPEN # the baseline itself is not a change
+		return state
+
+	def poll(self):
+		"""
+			Output:
+				page state (retry_policy, open - the registration opened), Retry-After (s) or None
+		"""
+		headers = dict(self.headers)
+		if self._etag is not None:
+			headers['If-None-Match'] = self._etag
+		if self._last_modified is not None:
+			headers['If-Modified-Since'] = self._last_modified
+
+		response, body = self._get(headers)
+		retry_after = response.getheader('Retry-After')
+		try:
+			retry_after = float(retry_after) if retry_after is not None else None
+		except ValueError:
+			retry_after = None
+
+		return self._state(response, body), retry_after
+
+	def close(self):
+		if self._conn is not None:
+			self._conn.close()
+			self._conn = None
+
+
+def wait_for_opening(poller, policy, timer=None):
+	"""
+		Description:
+
+			Poll with poller (ChangePoller) while policy (retry_policy.RetryPolicy) retries.
+
+		Output:
+
+			last page state: open - the registration opened, full - no places left,
+			otherwise the policy gave up
+	"""
+
+	timer = timer or PhaseTimer()
+
+	while True:
+		start = time.monotonic()
+		try:
+			state, retry_after = poller.poll()
+		except (OSError, http.client.HTTPException) as err:
+			logger.warning('Opening poll {} failed: {}'.format(len(policy.timeline), err))
+			state, retry_after = PAGE_ERROR, None
+
+		duration = time.monotonic() - start
+		timer.record(PHASE_DETECT_POLL, duration, state != PAGE_ERROR)
+
+		delay = policy.next_delay(state, duration, retry_after)
+		if delay is None:
+			return state
+
+		time.sleep(delay)
+
+
+def arm_dom_observer(browser, locators):
+	"""
+		Inject the observer clicking `reserve` (locators - browser_utils.reserve_button_locators())
+		into the page loaded in browser, it clicks at once if the button is there
+	"""
+	browser.execute_script(dom_observer_script, [list(locator) for locator in locators])
+
+
+def wait_for_dom_click(browser, timeout):
+	"""
+		Wait up to timeout (s) for the observer of browser to click `reserve`, disarm it otherwise
+
+		Output:
+			True if `reserve` was clicked
+	"""
+	deadline = time.monotonic() + timeout
+	while True:
+		if browser.execute_script(dom_clicked_script) is not None:
+			return True
+		if (time.monotonic() >= deadline):
+			browser.execute_script(dom_disarm_script)
+			return browser.execute_script(dom_clicked_script) is not None # clicked before the disarm
+		time.sleep(dom_check_t)
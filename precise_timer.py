@@ -0,0 +1,101 @@
+import time
+
+"""
+precise_timer - waiting for a wall-clock moment with sub-millisecond precision.
+
+	The target wall time (epoch) is converted once to a deadline on the monotonic
+	clock, so adjustments of the wall clock during the wait do not move it. The
+	deadline is re-anchored once more shortly before the target (reanchor_t) to
+	pick up slow corrections of the wall clock made during long waits. The wait
+	sleeps coarsely until the last spin_t seconds and spins for the rest; spin_t
+	is calibrated from the observed oversleep of time.sleep().
+
+"""
+
+reanchor_t = 1.0 # re-anchor the deadline this long (s) before the target
+min_spin_t = 0.001 # spin at least this long (s) before the target
+max_sleep_chunk_t = 60.0 # coarse sleeps are split in chunks not longer than this (s)
+
+_spin_t = None
+
+
+def calibrate_spin(samples=20, sleep_t=0.001):
+	"""
+		Description:
+
+			Measure the oversleep of time.sleep(sleep_t) and set the spin window to
+			twice the worst observed oversleep (at least min_spin_t).
+
+		Output:
+
+			spin window (s)
+	"""
+
+	global _spin_t
+
+	oversleep = 0.0
+	for i in range(samples):
+		start = time.monotonic()
+		time.sleep(sleep_t)
+		oversleep = max(oversleep, time.monotonic() - start - sleep_t)
+
+	_spin_t = max(2.0 * oversleep, min_spin_t)
+	return _spin_t
+
+
+def spin_t():
+	if _spin_t is None:
+		calibrate_spin()
+	return _spin_t
+
+
+def monotonic_deadline(target_timestamp):
+	"""
+		Monotonic clock value corresponding to the epoch target_timestamp
+	"""
+	return time.monotonic() + (target_timestamp - time.time())
+
+
+def seconds_until(target_timestamp):
+	"""
+		Time (s) left until the epoch target_timestamp, never negative
+	"""
+	return max(target_timestamp - time.time(), 0.0)
+
+
+def sleep_until(target_timestamp):
+	"""
+		Description:
+
+			Block until the epoch target_timestamp: coarse sleep, then spin.
+
+		Output:
+
+			firing error (s) - how late the wait returned w.r.t. the monotonic
+			deadline (never negative; for targets in the past it is the lateness)
+	"""
+
+	spin = spin_t()
+	deadline = monotonic_deadline(target_timestamp)
+	reanchored = False
+
+	while True:
+		remaining = deadline - time.monotonic()
+
+		if (not reanchored and remaining <= reanchor_t):
+			deadline = monotonic_deadline(target_timestamp)
+			remaining = deadline - time.monotonic()
+			reanchored = True
+
+		if (remaining <= spin):
+			break
+
+		if not reanchored:
+			time.sleep(min(remaining - reanchor_t, max_sleep_chunk_t))
+		else:
+			time.sleep(remaining - spin)
+
+	while (time.monotonic() < deadline):
+		pass
+
+	return time.monotonic() - deadline
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import logging
+
+"""
+racing - concurrent staggered reservation attempts.
+
+	At the opening moment race_attempts_n racers are started, racer i after
+	i * race_stagger_t (s). Each racer runs its own attempt loop over its own
+	connection or browser; the first confirmed success wins the race and the
+	other racers stop before their next attempt. A racer seeing no places left
+	stops the race without a winner.
+
+"""
+
+logger = logging.getLogger(name='racing')
+
+
+class Race:
+	"""
+		Shared state of the racers: the first one to finish() wins, stop() ends the race
+		without a winner, racers check over() between attempts
+	"""
+
+	def __init__(self):
+		self._over = threading.Event()
+		self._lock = threading.Lock()
+		self.winner = None
+		self.start = time.monotonic()
+
+	def over(self):
+		return self._over.is_set()
+
+	def stop(self):
+		self._over.set()
+
+	def finish(self, racer_id):
+		with self._lock:
+			if self.winner is None:
+				self.winner = racer_id
+				self._over.set()
+				return True
+		return False
+
+
+def run_race(racers, stagger):
+	"""
+		Description:
+
+			Start racers (functions racer(race) -> True on success) in threads,
+			racer i delayed by i * stagger (s), and wait for all of them.
+
+		Output:
+
+			index of the winning racer or None
+	"""
+
+	race = Race()
+
+	def run_racer(racer_id, racer):
+		delay = racer_id * stagger
+		if (delay > 0.0):
+			time.sleep(delay)
+		if race.over():
+			return
+		try:
+			if racer(race) and race.finish(racer_id):
+				logger.info('Racer {} won in {:.3f} s.'.format(racer_id, time.monotonic() - race.start))
+		except Exception as err:
+			logger.warning('Racer {} failed: {}'.format(racer_id, err))
+
+	if (len(racers) == 1):
+		run_racer(0, racers[0])
+		return race.winner
+
+	threads = [threading.Thread(target=run_racer, args=(racer_id, racer), name='racer-{}'.format(racer_id))
+		for racer_id, racer in enumerate(racers)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	return race.winner
@@ -0,0 +1,217 @@
+from urllib.parse import urlsplit
+import http.client
+import socket
+import time
+import selenium
+import browser_utils
+from browser_utils import locate_reserve_button, load_page
+from cookie_cache import check_cookies
+from clock_sync import ServerClock
+from http_engine import ENGINE_HTTP
+from opening_detector import DETECTOR_HTTP
+from retry_policy import text_page_state, PAGE_FULL
+from virtual_clock import get_clock
+from latency_stats import PhaseTimer, PHASE_REHEARSAL, PHASE_DNS, PHASE_CONNECT, PHASE_RTT, PHASE_FIRST_LOAD
+
+import logging
+
+"""
+rehearsal - dry run of a reservation before the opening.
+
+	Without it the first contact of a reservation subprocess with the booking
+	site is at the opening, under load. rehearse() makes it rehearsal_t (s)
+	before the opening with the logged in browser of the reservation:
+
+	* resolves the hosts of the clock synchronization, of the session, of the
+	  reservation request of the http engine and of the polls of the http
+	  opening detector (resolution time is measured and unresolvable hosts are
+	  reported; addresses are not pinned, the engines resolve the hosts again
+	  when they open their connections ahead of the opening),
+	  opens connections to them (TCP, TLS) and measures the rtt with
+	  rehearsal_samples_n HEAD requests; the connection of the clock
+	  synchronization is kept alive until the synchronization (keep_alive_until)
+	* loads the reservation page in the browser, checks the login (no redirect
+	  to the login page, cookie_check_url) and the page state, and resolves the
+	  locator of `reserve` button (cached for the clicks, see browser_utils)
+
+	The outcome feeds the reservation: the warm connection and the rtt go to the
+	clock synchronization (clock_sync.server_fire_timestamp), an unreachable
+	reservation request makes the http engine fall back to selenium. Problems
+	(expired login, changed page, unreachable site, ...) are sent in the
+	PHASE_REHEARSAL event, the service keeps them as alerts and the bot warns
+	the owner of the session while there is still time to fix them.
+
+"""
+
+logger = logging.getLogger(name='rehearsal')
+
+
+def url_origin(url):
+	"""
+		(scheme, host, port) of url
+	"""
+	parts = urlsplit(url)
+	return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+
+
+class Rehearsal:
+	"""
+		Description:
+
+			Outcome of the rehearsal of a reservation.
+
+		Fields:
+
+			problems    : list   : problems to fix before the opening (empty - none)
+			rtt         : float  : minimal round trip time (s) to the site of the session, None - not measured
+			page_t      : float  : load time (s) of the reservation page, None - not loaded
+			locator     : tuple  : locator of `reserve` button on the page, None - not found
+			unreachable : set    : origins (url_origin) which could not be resolved or connected
+			clock       : clock_sync.ServerClock kept alive for the clock synchronization or None
+	"""
+
+	def __init__(self):
+		self.problems = []
+		self.rtt = None
+		self.page_t = None
+		self.locator = None
+		self.unreachable = set()
+		self.clock = None
+
+	def reachable(self, url):
+		return url_origin(url) not in self.unreachable
+
+	def fire_args(self):
+		"""
+			Keyword arguments of clock_sync.server_fire_timestamp
+		"""
+		return {'clock' : self.clock, 'rtt' : self.rtt}
+
+	def keep_alive_until(self, timestamp, period):
+		"""
+			Wait until timestamp (epoch of the clock of the process) pinging the connection
+			of the clock synchronization every period (s)
+		"""
+		clock = get_clock()
+		if (self.clock is None or period <= 0):
+			clock.sleep_until(timestamp)
+			return
+
+		while (clock.time() < timestamp):
+			clock.sleep_until(min(timestamp, clock.time() + period))
+			try:
+				self.clock.ping()
+			except (OSError, http.client.HTTPException) as err:
+				logger.debug('Keep-alive of the clock connection failed, it is reopened: {}'.format(err))
+				self.clock.close() # the next request reconnects
+
+	def close(self):
+		if self.clock is not None:
+			self.clock.close()
+			self.clock = None
+
+
+def probe_origin(clock, samples_n, timer):
+	"""
+		Resolve the host of clock (ServerClock), connect it and measure the rtt,
+		raises OSError, http.client.HTTPException
+
+		Output:
+			minimal rtt (s)
+	"""
+	with timer.phase(PHASE_DNS):
+		socket.getaddrinfo(clock.host, clock.port, type=socket.SOCK_STREAM)
+	with timer.phase(PHASE_CONNECT):
+		clock.connect()
+
+	rtt = min(clock.ping() for i in range(max(1, samples_n)))
+	timer.record(PHASE_RTT, rtt)
+	return rtt
+
+
+def rehearse(browser, url_str, configuration, engine, timer=None, user=None):
+	"""
+		Description:
+
+			Rehearse the reservation of url_str with the logged in browser and the engine
+			of the reservation. Problems are logged and sent in the PHASE_REHEARSAL event
+			of timer (latency_stats.PhaseTimer) with the user to warn.
+
+		Output:
+
+			Rehearsal, close() it after the clock synchronization
+	"""
+
+	timer = timer or PhaseTimer()
+	start = time.monotonic()
+	rehearsal = Rehearsal()
+
+	# connections: clock synchronization first (kept alive), the session site, the reservation request
+	sync_mode = configuration['clock_sync_mode']
+	urls = [url_str]
+	if (sync_mode != 'none'):
+		urls.insert(0, configuration['clock_sync_url'] or url_str)
+	if (engine == ENGINE_HTTP):
+		urls.append(configuration['http_reserve_url'] or url_str)
+	if (configuration['detector_mode'] == DETECTOR_HTTP):
+		urls.append(configuration['detector_url'] or url_str)
+
+	origins = {}
+	for i, url in enumerate(urls):
+		origin = url_origin(url)
+		if origin in origins:
+			continue
+		keep = (i == 0 and sync_mode != 'none')
+		clock = ServerClock(url, sync_mode if keep else 'date')
+		try:
+			origins[origin] = probe_origin(clock, configuration['rehearsal_samples_n'], timer)
+			if keep:
+				clock.sample() # the server gives its time (Date header or epoch)
+				rehearsal.clock = clock
+		except (OSError, http.client.HTTPException) as err:
+			rehearsal.unreachable.add(origin)
+			rehearsal.problems.append('{} is not reachable: {}'.format(origin[1], err))
+		except ValueError as err:
+			rehearsal.problems.append('clock of {} cannot be synchronized: {}'.format(origin[1], err))
+		finally:
+			if rehearsal.clock is not clock:
+				clock.close()
+
+	rehearsal.rtt = origins.get(url_origin(url_str))
+
+	# reservation page: login, page state, `reserve` button
+	try:
+		page_start = time.monotonic()
+		with timer.phase(PHASE_FIRST_LOAD):
+			load_page(browser, url_str)
+		rehearsal.page_t = time.monotonic() - page_start
+
+		if (len(browser_utils.login_url) > 0 and browser.current_url.startswith(browser_utils.login_url)):
+			rehearsal.problems.append('the site asks to log in: the login expired or the credentials are wrong')
+		elif (len(configuration['cookie_check_url']) > 0 and not check_cookies(configuration['cookie_check_url'],
+				browser.get_cookies(), configuration['cookie_check_text'])):
+			rehearsal.problems.append('login check on {} failed'.format(configuration['cookie_check_url']))
+
+		if (text_page_state(browser.page_source, configuration['page_full_text']) == PAGE_FULL):
+			rehearsal.problems.append('the page says there are no places left')
+
+		rehearsal.locator = locate_reserve_button(browser)
+		if (rehearsal.locator is None and configuration['rehearsal_expect_button']):
+			rehearsal.problems.append('`reserve` button is not found, the page structure may have changed')
+
+	except selenium.common.exceptions.WebDriverException as err:
+		rehearsal.problems.append('reservation page does not load: {}'.format(err.msg or err))
+	except (OSError, http.client.HTTPException) as err:
+		rehearsal.problems.append('login check on {} failed: {}'.format(configuration['cookie_check_url'], err))
+
+	for problem in rehearsal.problems:
+		logger.warning('Rehearsal of {}: {}.'.format(url_str, problem))
+	logger.info('Rehearsal of {}: rtt {}, page load {}, `reserve` locator {}, {} problems.'.format(url_str,
+		'-' if rehearsal.rtt is None else '{:.1f} ms'.format(rehearsal.rtt * 1000.0),
+		'-' if rehearsal.page_t is None else '{:.3f} s'.format(rehearsal.page_t), rehearsal.locator,
+		len(rehearsal.problems)))
+
+	timer.record(PHASE_REHEARSAL, time.monotonic() - start, len(rehearsal.problems) == 0,
+		{'user' : user, 'problems' : rehearsal.problems} if len(rehearsal.problems) > 0 else None)
+
+	return rehearsal
@@ -3,10 +3,20 @@ from telegram.ext import Updater, ConversationHandler, CommandHandler, MessageHa
 from functools import wraps
 import tabulate # print sessions list as a table
 import json
+import time
+import re
 
 
 from check_new_session import check_new_datetime, check_new_url
-from sessions_utils import add_new_session, get_sessions_list, delete_all_sessions, delete_session
+from sessions_utils import get_sessions_list, assign_sessions_owner, ERR_CONFLICT
+from sessions_store import migrate_json_sessions
+from http_engine import engines
+from service_ipc import push_add_session, push_delete_session, push_delete_all_sessions, get_service_client, ServiceUnavailable
+from config_store import get_config_store, live_keys, without_comments
+from accounts import AccountStore, account_name, account_label, may_reserve
+from latency_stats import (latency_file, load_latency_events, latency_histograms, reservation_results, histogram_buckets_t, 
+	HandlerMetrics)
+from session import Session
 
 # global configuration
 token = ""
@@ -15,22 +25,27 @@ config_file_user = 'user.config'
 log_file_bot = 'reservation_bot.log'
 log_file_reservation = 'reservation_service.log'
 bot_activated = True
+bot_workers_n = 8 # handlers run in a pool of this many threads, slow I/O of one user does not stall the others
+alerts_poll_t = 15 # period (s) of polling the service for alerts of the reservations (problems found by rehearsals)
 
 import logging 
-logging.basicConfig(
-	filename=log_file_bot,
-	filemode='a',
-	level=logging.DEBUG, 
-	format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from log_store import setup_logging, query_log, parse_log_time, levels as log_levels
+setup_logging(log_file_bot) # rotated log, see log_store
 
 logger = logging.getLogger('reservation_bot') # store to reservation_bot.log 
 
 DATETIME, URL_LINK, PROCESS_NEW_SESSION = range(3)
 DEFAULT_NLINES_DUMP = 10
+max_message_len = 4000 # telegram messages are limited to 4096 characters
+account_name_re = re.compile(r'^[A-Za-z0-9_-]{1,32}$') # names of the additional accounts of a user
 
 restricted_user_list = []
 restricted_admin_list = []
 
+# latency of the handlers (/botstats)
+handler_metrics = HandlerMetrics()
+timed = handler_metrics.timed
+
 
 # restrction decorator - only restricted users can run user commands
 def restricted(func):
@@ -70,6 +85,7 @@ def activated(func):
 
 
 
+@timed
 @restricted 
 def start(update, context):
 	
@@ -94,10 +110,16 @@ def start(update, context):
 # help message with all commands and descriptions
 help_message = ['Basic user commands:\n\n',
 				'/start - activate the bot\n', 
-				'/addsession - add new swimming session\n',
+				'/addsession [engine] [accounts=me,name,...] - add new swimming session, optional engine: selenium or http, '
+				'optional accounts reserving it at once\n',
 				'/printsessions - print the indexed list of all swimming sessions\n',
 				'/deletesession [index] - delete session with (integer) index [n]\n',
 				'/deleteall - delete all existing sessions\n',
+				'/setlogin [login] [password] [name] - credentials of your account on the booking site, of your '
+				'additional account [name]\n',
+				'/deletelogin [name] - forget your credentials (the default account is used) or the account [name]\n',
+				'/accounts - list your accounts\n',
+				'/results - results of your reservations per account\n',
 				'\n',
 				'Advanced configuration commands:\n\n',
 				'/configprintuser - show user configuration\n',
@@ -110,10 +132,14 @@ help_message = ['Basic user commands:\n\n',
 				'/about - print contact information\n' 
 				'\n',
 				'Log-info (admin permission required):\n\n',
-				'/logdumpbot [value = 10] - dump lines from the bot-log\n'
-				'/logdumpres [value = 10] - dump lines from the reservation-log\n' 
+				'/logdumpbot [value = 10] [level] [since=] [until=] [grep=] - dump records from the bot-log\n'
+				'/logdumpres [value = 10] [level] [since=] [until=] [grep=] - dump records from the reservation-log\n' 
+				'/stats [phase] [account=] - latency percentiles of the reservation phases, histogram of [phase]\n'
+				'/botstats - latency percentiles of the bot handlers\n'
+				'/servicestate - running reservations of the service and their current phase\n'
 				]
 
+@timed
 @restricted
 @activated
 def help_command(update, context):
@@ -121,12 +147,44 @@ def help_command(update, context):
 	update.message.reply_text(''.join(help_message))
 	return
 
+@timed
 @restricted
 @activated
-def addsession(update, context):
+def addsession(update, context, accounts_file):
 	"""
 		Add new swimming session to the list. 
+		Optional arguments - reservation engine of the session, 
+		accounts=me,name,... - accounts reserving the session at once.
 	"""
+	# options of a previous input are not carried over
+	context.user_data.pop('accounts', None)
+	context.user_data.pop('engine', None)
+
+	accounts = None
+	engine = None
+	for arg in context.args:
+		if arg.startswith('accounts='):
+			accounts = parse_accounts(update, arg[len('accounts='):], accounts_file)
+			if accounts is None:
+				return ConversationHandler.END
+		elif arg in engines:
+			engine = arg
+		else:
+			update.message.reply_text('Unknown reservation engine {}, possible engines: {}.'.format(arg, 
+				', '.join(engines)))
+			return ConversationHandler.END
+
+	# sessions are reserved with the account of the user, only the operators may use the default one
+	if (not accounts and not may_reserve(update.effective_user.id, AccountStore(accounts_file))):
+		update.message.reply_text('You have no credentials of the booking site yet, set them first with\n'
+			'/setlogin login password')
+		return ConversationHandler.END
+
+	if accounts:
+		context.user_data['accounts'] = accounts
+	if engine is not None:
+		context.user_data['engine'] = engine
+
 	update.message.reply_text('Ok, for this I will need two items:\n\n'
 		'1. Date and time of the registration opening (your local time)\n' 
 		'2. URL-link to the session page\n\n' 
@@ -139,6 +197,27 @@ def addsession(update, context):
 
 	return DATETIME
 
+def parse_accounts(update, accounts_str, accounts_file):
+	"""
+		Account names of the comma separated list of accounts of the user ('me' - its own account),
+		None (the user is told why) if some account has no credentials
+	"""
+	user = update.effective_user.id
+	stored = AccountStore(accounts_file).names(user)
+
+	accounts = []
+	for label in accounts_str.split(','):
+		name = account_name(user) if label == 'me' else account_name(user, label)
+		if name not in stored:
+			update.message.reply_text('Account {} has no credentials, set them with /setlogin. Your accounts: {}.'.format(
+				label, ', '.join(account_label(name) for name in stored) or 'none'))
+			return None
+		if name not in accounts:
+			accounts.append(name)
+
+	return accounts
+
+@timed
 def addsession_datetime(update, context, sessions_file):
 	"""
 		Read datetime string, check that it has valid format.
@@ -149,7 +228,7 @@ def addsession_datetime(update, context, sessions_file):
 	datetime_str = update.message.text
 
 	# check that new datetime is a valid one
-	check_code, check_err_msg = check_new_datetime(datetime_str, sessions_file)
+	check_code, check_err_msg = check_new_datetime(datetime_str, sessions_file, update.effective_user.id)
 
 	# datetime of incorrect format
 	if (check_code > 0):
@@ -168,6 +247,7 @@ def addsession_datetime(update, context, sessions_file):
 
 	return URL_LINK
 
+@timed
 def addsession_url_link(update, context):
 	
 	"""
@@ -195,12 +275,15 @@ def addsession_url_link(update, context):
 	,]
 	reply_markup = InlineKeyboardMarkup(keyboard)
 
+	accounts = context.user_data.get('accounts')
 	update.message.reply_text('So, you want to add a session with the following parameters, right?\n\n'
-		'Date and time: {}\nURL-link: {}\n'.format(context.user_data['datetime-str'], context.user_data['url-str']),
+		'Date and time: {}\nURL-link: {}\n'.format(context.user_data['datetime-str'], context.user_data['url-str']) + 
+		('Accounts: {}\n'.format(', '.join(account_label(name) for name in accounts)) if accounts else ''),
 		reply_markup = reply_markup)
 	
 	return PROCESS_NEW_SESSION
 
+@timed
 def addsession_process(update, context, sessions_file):
 
 	query = update.callback_query
@@ -213,13 +296,20 @@ def addsession_process(update, context, sessions_file):
 		return ConversationHandler.END
 
 	elif (add_decision == 'Yes'): # if final decision is to add
-		err_code, err_msg = add_new_session(
+		err_code, err_msg = push_add_session(
 			context.user_data['datetime-str'], 
 			context.user_data['url-str'],
-			sessions_file=sessions_file
+			sessions_file=sessions_file,
+			engine=context.user_data.get('engine'),
+			user=update.effective_user.id,
+			accounts=context.user_data.get('accounts')
 		)
+		context.user_data.clear()
 
-		if (err_code > 0):
+		if (err_code == ERR_CONFLICT):
+			# another session was added meanwhile too close to this one
+			query.edit_message_text(text='New session was not added: {}'.format(err_msg))
+		elif (err_code > 0):
 			logger.error('Failed to add new session, error code %d, error message: %s', err_code, err_msg)
 			update.message.reply_text('New session was not added due to some error.\n'
 				'Please, contact the support at /about.')
@@ -228,6 +318,7 @@ def addsession_process(update, context, sessions_file):
 
 	return ConversationHandler.END
 
+@timed
 def addsession_cancel(update, context):
 	"""
 		User called - cancel current input of a new session
@@ -241,6 +332,7 @@ def addsession_cancel(update, context):
 
 	return ConversationHandler.END
 
+@timed
 def addsession_unkown(update, context):
 	"""
 
@@ -259,17 +351,18 @@ def addsession_unkown(update, context):
 	return ConversationHandler.END
 
 
+@timed
 @restricted
 @activated
 def printsessions(update, context, sessions_file, sessions_passed_file):
 	"""
 
-		Print all existing sessions (future and passed) as a Markdown table
+		Print all existing sessions (future and passed) of the user as a Markdown table
 
 	"""
 
-	sessions_list = get_sessions_list(sessions_file)
-	sessions_passed_list = get_sessions_list(sessions_passed_file)
+	sessions_list = get_sessions_list(sessions_file, update.effective_user.id)
+	sessions_passed_list = get_sessions_list(sessions_passed_file, update.effective_user.id)
 	sessions_all_list = sessions_list + sessions_passed_list
 
 	if (len(sessions_all_list) == 0):
@@ -277,13 +370,16 @@ def printsessions(update, context, sessions_file, sessions_passed_file):
 		return
 
 	else:
-		headers = ('Date/Time', 'URL', 'Passed')
-		rows = [session.values() for session in sessions_all_list]
+		headers = ('Date/Time', 'URL', 'Passed', 'Accounts')
+		rows = [(session.datetime_str, session.url, session.passed, 
+			', '.join(account_label(name) for name in session.accounts) if session.accounts else 'me') 
+			for session in sessions_all_list]
 		tab_all_sessions_list = "```" + tabulate.tabulate(rows, headers, tablefmt="simple", showindex="always") + "```"
 		update.effective_message.reply_text(tab_all_sessions_list, parse_mode="Markdown")
 
 	return
 
+@timed
 @restricted
 @activated
 def deletesession(update, context, sessions_file):
@@ -306,7 +402,7 @@ def deletesession(update, context, sessions_file):
 			'Type /help to see commands and /printsessions to see all your sessions.')
 		return
 
-	err_code, err_msg = delete_session(sessions_file, session_number)
+	err_code, err_msg = push_delete_session(sessions_file, session_number, update.effective_user.id)
 	if (err_code > 0):
 		logger.info('User %s tried to delete session with number %d: %s', update.effective_message.from_user, session_number, err_msg)
 		update.effective_message.reply_text('Session with such number does not exist.\n'
@@ -318,16 +414,118 @@ def deletesession(update, context, sessions_file):
 	return
 
 
+@timed
 @restricted
 @activated
 def deleteall(update, context, sessions_file):
 	"""
-		Delete all existing sessions from sessions_file
+		Delete all existing sessions of the user from sessions_file
 	"""
-	err_code, err_msg = delete_all_sessions(sessions_file)
+	err_code, err_msg = push_delete_all_sessions(sessions_file, update.effective_user.id)
+	if (err_code > 0):
+		logger.info('User %s tried to delete all sessions: %s', update.effective_message.from_user, err_msg)
+		update.effective_message.reply_text('Sessions were not deleted: {}'.format(err_msg))
+		return
 	update.effective_message.reply_text('All sessions were deleted.')
 	return
 
+@timed
+@restricted
+@activated
+def setlogin(update, context, accounts_file):
+	"""
+		Store (encrypted) credentials of the booking site for the sessions of the user, 
+		or of its additional account (third argument - its name)
+	"""
+
+	# the message with the password is not kept in the chat
+	try:
+		update.message.delete()
+	except Exception as err:
+		logger.warning('Message with credentials of user {} is not deleted: {}'.format(update.effective_user.id, err))
+
+	if (len(context.args) not in (2, 3)):
+		update.effective_message.reply_text('Two or three arguments are needed: /setlogin [login] [password] [name]')
+		return
+
+	name = context.args[2] if (len(context.args) == 3 and context.args[2] != 'me') else None
+	if (name is not None and not account_name_re.match(name)):
+		update.effective_message.reply_text('Account name may contain only latin letters, digits, _ and - '
+			'(at most 32 characters).')
+		return
+
+	try:
+		AccountStore(accounts_file).set(account_name(update.effective_user.id, name), context.args[0], context.args[1])
+	except RuntimeError as err:
+		logger.error('Credentials of user {} are not stored: {}'.format(update.effective_user.id, err))
+		update.effective_message.reply_text('Credentials cannot be stored, please contact the support at /about.')
+		return
+
+	if name is not None:
+		update.effective_message.reply_text('Credentials of account {} are saved, add it to a session with '
+			'/addsession accounts=me,{}.'.format(name, name))
+		return
+
+	update.effective_message.reply_text('Credentials are saved, your sessions will be reserved with login {}.'.format(
+		context.args[0]))
+
+
+@timed
+@restricted
+@activated
+def deletelogin(update, context, accounts_file):
+
+	if (len(context.args) > 0 and context.args[0] != 'me'):
+		AccountStore(accounts_file).delete(account_name(update.effective_user.id, context.args[0]))
+		update.effective_message.reply_text('Credentials of account {} are deleted.'.format(context.args[0]))
+		return
+
+	AccountStore(accounts_file).delete(account_name(update.effective_user.id))
+	update.effective_message.reply_text('Credentials are deleted, your sessions will be reserved with the default account.')
+
+
+@timed
+@restricted
+@activated
+def accounts(update, context, accounts_file):
+	"""
+		List the accounts of the user with credentials
+	"""
+
+	store = AccountStore(accounts_file)
+	rows = [(account_label(name), store.get(name).username) for name in store.names(update.effective_user.id)]
+	if (len(rows) == 0):
+		update.effective_message.reply_text('You have no accounts, your sessions are reserved with the default account.')
+		return
+
+	update.effective_message.reply_text('```\n' + tabulate.tabulate(rows, ('Account', 'Login'), tablefmt="simple") + 
+		'\n```', parse_mode="Markdown")
+
+
+@timed
+@restricted
+@activated
+def results(update, context, sessions_passed_file, accounts_file):
+	"""
+		Print the outcome of the reservations of the user per account, with the time (ms) 
+		from the firing moment to the outcome
+	"""
+
+	names = set(AccountStore(accounts_file).names(update.effective_user.id))
+	events = reservation_results(load_latency_events(latency_file(sessions_passed_file)), names)
+	if (len(events) == 0):
+		update.effective_message.reply_text('No reservation results of your accounts yet.')
+		return
+
+	headers = ('Date/Time', 'Account', 'Booked', 'ms')
+	rows = [(Session(event['session'], event['url']).datetime_str, account_label(event.get('account')), event['ok'], 
+		round(event['duration'] * 1000.0, 1)) for event in events]
+
+	text = tabulate.tabulate(rows, headers, tablefmt="simple")
+	update.effective_message.reply_text('```\n' + text[-max_message_len:] + '\n```', parse_mode="Markdown")
+
+
+@timed
 @restricted
 @activated
 def about(update, context):
@@ -338,18 +536,30 @@ def about(update, context):
 		'Telegram: @FGoncharov')
 
 
+def reply_configuration(update, configuration):
+	"""
+		Send configuration without the comments, in several messages if it is longer than max_message_len
+	"""
+	lines = json.dumps(without_comments(configuration), indent=4).split('\n')
+	chunks = [[]]
+	for line in lines:
+		if (sum(len(chunk_line) + 1 for chunk_line in chunks[-1]) + len(line) > max_message_len):
+			chunks.append([])
+		chunks[-1].append(line)
+
+	for chunk in chunks:
+		update.message.reply_text('```\n' + '\n'.join(chunk) + '\n```', parse_mode='MarkdownV2')
+
+
+@timed
 @restricted
 @activated
 def configprintuser(update, context, config_file_user):
 
-	f = open(config_file_user, 'r', encoding='utf-8')
-	configuration = json.load(f)
-	f.close()
-
-	pretty_config_str = '```\n' + json.dumps(configuration, indent=4) + '\n```'
-	update.message.reply_text(pretty_config_str, parse_mode='MarkdownV2')
+	reply_configuration(update, get_config_store(config_file_user, config_file_default).load())
 
 
+@timed
 @restricted
 @activated
 def configset(update, context, config_file_user):
@@ -362,138 +572,231 @@ def configset(update, context, config_file_user):
 	key = context.args[0]
 	value = context.args[1]
 
-	# open file to read current configuration
-	f = open(config_file_default, 'r', encoding='utf-8')
-	configuration = json.load(f)
-	f.close()
-
-	# set key-value and restore configuration in file
-	if key not in configuration.keys():
-		update.message.reply_text('The key ({}) does not exist in the configuration.'.format(key))
-		return
-		
+	# set key-value in the user configuration (atomic write, running reservations pick up live keys)
 	try:
 
-		configuration[key] = type(configuration[key])(value)
+		get_config_store(config_file_user, config_file_default).set_value(key, value)
 
+	except KeyError:
+		update.message.reply_text('The key ({}) does not exist in the configuration.'.format(key))
+		return
 	except ValueError:
 		update.message.reply_text('Second argument is of bad type. Configuration was not changed.')
 		return
 
-	# store new configuration in the user configuration
-	f = open(config_file_user, 'w', encoding='utf-8')
-	json.dump(configuration, f)
-	f.close()
-
 	# send au-revoir message
-	update.message.reply_text('Configuration was saved successfully.')
+	if key in live_keys:
+		update.message.reply_text('Configuration was saved successfully, running reservations use it now.')
+	else:
+		update.message.reply_text('Configuration was saved successfully.')
 
 
 
 
+@timed
 @restricted
 @activated
 def configreset(update, context, config_file_user, config_file_default):
 
-	f = open(config_file_default, 'r', encoding='utf-8')
-	configuration = json.load(f)
-	f.close()
-
-	f = open(config_file_user, 'w', encoding='utf-8')
-	json.dump(configuration, f)
-	f.close()
+	get_config_store(config_file_user, config_file_default).reset()
 
 	# send au-revoir message
 	update.message.reply_text('Configuration was to default.')
 
 
+@timed
 @restricted
 @activated
 def configprintdefault(update, context, config_file_default):
 	
-	f = open(config_file_default, 'r', encoding='utf-8')
-	configuration = json.load(f)
-	f.close()
+	reply_configuration(update, get_config_store(config_file_default, None).load())
 
-	pretty_config_str = '```\n' + json.dumps(configuration, indent=4) + '\n```'
-	update.message.reply_text(pretty_config_str, parse_mode='MarkdownV2')
 
 
+def logdump(update, context, log_file):
+	"""
 
-@admin
-@activated
-def logdumpbot(update, context, log_file_bot):
+		Dump the last records of log_file: /logdump... [n] [level] [since=] [until=] [grep=]
 
-	try:
-		f = open(log_file_bot, 'r', encoding='utf-8')
-	except OSError:
-		logger.info('Could not open/read file:', log_file_bot)
-		update.message.reply_text('INFO: Could not open bot log-records.')
-		return
-
-	lines = f. readlines()
-	num_lines_to_dump = int(0)
+	"""
 
+	num_lines_to_dump = DEFAULT_NLINES_DUMP
+	level, since, until, substring = None, None, None, None
 
-	# read number of lines to dump
-	if (len(context.args) == 0):
-		num_lines_to_dump = DEFAULT_NLINES_DUMP
-	else:
-		try:
-			num_lines_to_dump = int(context.args[0])
-		except ValueError:
-			update.effective_message.reply_text('The argument you \' provided is not an integer number.\n'
-				'Type /help to see how to use commands.')
-			return
+	# read number of records to dump and the filters
+	try:
+		for arg in context.args:
+			if arg.lstrip('-').isdigit():
+				num_lines_to_dump = int(arg)
+			elif arg.upper() in log_levels:
+				level = arg.upper()
+			elif arg.startswith('since='):
+				since = parse_log_time(arg[len('since='):])
+			elif arg.startswith('until='):
+				until = parse_log_time(arg[len('until='):])
+			elif arg.startswith('grep='):
+				substring = arg[len('grep='):]
+			else:
+				raise ValueError(arg)
+	except ValueError:
+		update.effective_message.reply_text('Bad argument. Usage: [n] [level] [since=time] [until=time] [grep=text], '
+			'time is dd/mm/yyyy-hh:mm or relative as 30m, 2h, 1d.\n'
+			'Type /help to see how to use commands.')
+		return
 
 	if (num_lines_to_dump <= 0):
 		update.effective_message.reply_text('You asked {} lines for the output. It is empty.'.format(num_lines_to_dump))
 		return
 
-	dump_lines = lines[-num_lines_to_dump:]
-	if len(dump_lines) > 0:
-		update.message.reply_text( '```\n' + ''.join(dump_lines) + '\n```', parse_mode='MarkdownV2')
+	try:
+		records = query_log(log_file, num_lines_to_dump, since, until, level, substring)
+	except OSError as err:
+		logger.info('Could not open/read file {}: {}'.format(log_file, err))
+		update.message.reply_text('INFO: Could not open log-records.')
+		return
+
+	if (len(records) > 0):
+		dump = '\n'.join(records)[-max_message_len:] # the latest records fit in one message
+		update.message.reply_text( '```\n' + dump + '\n```', parse_mode='MarkdownV2')
 	else:
-		update.message.reply_text('Log-file is empty.')
+		update.message.reply_text('No log records found.')
 
 
+@timed
+@admin
+@activated
+def logdumpbot(update, context, log_file_bot):
+
+	logdump(update, context, log_file_bot)
+
+
+@timed
 @admin
 @activated
 def logdumpres(update, context, log_file_reservation):
 
-	try:
-		f = open(log_file_reservation, 'r')
+	logdump(update, context, log_file_reservation)
 
-	except OSError:
-		logger.info('Could not open/read file:', log_file_reservation)
-		update.message.reply_text('INFO: Could not open reservation log-records.')
+
+@timed
+@admin
+@activated
+def stats(update, context, sessions_passed_file):
+	"""
+
+		Print latency percentiles (ms) of the reservation phases, or the histogram of one phase
+
+	"""
+
+	args = [arg for arg in context.args if not arg.startswith('account=')]
+	account = next((arg[len('account='):] for arg in context.args if arg.startswith('account=')), None)
+	histograms = latency_histograms(load_latency_events(latency_file(sessions_passed_file)), account)
+
+	if (len(histograms) == 0):
+		update.message.reply_text('No latency records yet.')
 		return
 
-	lines = f. readlines()
-	num_lines_to_dump = int(0)
+	if (len(args) > 0):
+		phase = args[0]
+		if phase not in histograms:
+			update.message.reply_text('No records of phase {}, recorded phases: {}.'.format(phase, 
+				', '.join(sorted(histograms))))
+			return
 
-	# read number of lines to dump
-	if (len(context.args) == 0):
-		num_lines_to_dump = DEFAULT_NLINES_DUMP
+		headers = ('<= ms', 'Count')
+		bounds = ['{:g}'.format(bound * 1000.0) for bound in histogram_buckets_t] + ['more']
+		rows = [(bound, count) for bound, count in zip(bounds, histograms[phase]['buckets']) if count > 0]
 	else:
-		try:
-			num_lines_to_dump = int(context.args[0])
-		except ValueError:
-			update.effective_message.reply_text('The argument you \' provided is not an integer number.\n'
-				'Type /help to see how to use commands.')
-			return
+		headers = ('Phase', 'N', 'p50', 'p95', 'p99', 'max')
+		rows = [(phase, histogram['n']) + tuple(round(histogram[key] * 1000.0, 1) for key in ('p50', 'p95', 'p99', 'max'))
+			for phase, histogram in sorted(histograms.items())]
 
-	if (num_lines_to_dump <= 0):
-		update.effective_message.reply_text('You asked {} lines for the output. It is empty.'.format(num_lines_to_dump))
+	update.message.reply_text('```\n' + tabulate.tabulate(rows, headers, tablefmt="simple") + '\n```', 
+		parse_mode="Markdown")
+
+
+@timed
+@admin
+@activated
+def botstats(update, context):
+	"""
+
+		Print latency percentiles (ms) of the bot handlers since the start of the bot
+
+	"""
+
+	histograms = handler_metrics.histograms()
+
+	headers = ('Handler', 'N', 'p50', 'p95', 'p99', 'max')
+	rows = [(name, histogram['n']) + tuple(round(histogram[key] * 1000.0, 1) for key in ('p50', 'p95', 'p99', 'max'))
+		for name, histogram in sorted(histograms.items())]
+
+	update.message.reply_text('```\n' + tabulate.tabulate(rows, headers, tablefmt="simple") + '\n```', 
+		parse_mode="Markdown")
+
+
+@timed
+@admin
+@activated
+def servicestate(update, context, sessions_file):
+	"""
+
+		Print the live state of the reservation service: running reservations and their last phase
+
+	"""
+
+	try:
+		state = get_service_client(sessions_file).call('state')
+	except (ServiceUnavailable, RuntimeError) as err:
+		logger.info('Service state is not available: {}'.format(err))
+		update.message.reply_text('Reservation service is not reachable.')
 		return
 
-	dump_lines = lines[-num_lines_to_dump:]
-	if (len(dump_lines) > 0):
-		update.message.reply_text( '```\n' + ''.join(dump_lines) + '\n```', parse_mode='MarkdownV2')
-	else:
-		update.message.reply_text('Log-file is empty.')
+	headers = ('Date/Time', 'User', 'Account', 'PID', 'Phase', 'Age, s')
+	rows = [(worker['date'], worker['user'], account_label(worker.get('account')), worker['pid'], (worker['phase'] or '-') + ('' if worker['phase_ok'] in (None, True) else ' (failed)'),
+		'-' if worker['phase_age'] is None else round(worker['phase_age'], 1)) for worker in state['workers']]
+
+	text = 'Uptime {:.1f} h, running reservations {}.\n'.format(state['uptime'] / 3600.0, 
+		len(set((worker['date'], worker['url'], worker['user']) for worker in state['workers'])))
+	if state['browser_pool'] is not None:
+		text += 'Browser pool: {}\n'.format(json.dumps(state['browser_pool']))
+	if (len(rows) > 0):
+		text += '\n' + tabulate.tabulate(rows, headers, tablefmt="simple")
+
+	update.message.reply_text('```\n' + text + '\n```', parse_mode="Markdown")
+
 
+@timed
+def forward_alerts(context, sessions_file, alerts_state):
+	"""
+
+		Send alerts of the service (problems of the reservations, e.g. found by their rehearsals) to the owners 
+		of the sessions, alerts of sessions without an owner to the admins
+
+	"""
+
+	try:
+		alerts = get_service_client(sessions_file).call('alerts', since=alerts_state['since'])
+	except (ServiceUnavailable, RuntimeError) as err:
+		logger.debug('Alerts are not available: {}'.format(err))
+		return
+
+	for alert in alerts:
+		alerts_state['since'] = max(alerts_state['since'], alert['time'])
+		user = alert['detail'].get('user')
+		text = ('Your reservation on {} ({}{}) has problems, {:.0f} min before the opening:\n\n{}\n\n'
+			'Please, fix them while there is time (e.g. /setlogin).'.format(Session(alert['session'], alert['url']).datetime_str,
+			alert['url'], '' if alert.get('account') is None else ', account ' + account_label(alert['account']),
+			max(0.0, alert['session'] - time.time()) / 60.0, '\n'.join('- ' + problem for problem in alert['detail']['problems'])))
+
+		for chat_id in ([user] if user is not None else restricted_admin_list):
+			try:
+				context.bot.send_message(chat_id=chat_id, text=text)
+			except Exception as err:
+				logger.error('Alert is not sent to {}: {}'.format(chat_id, err))
 
+
+@timed
 @restricted
 @activated
 def unknown_message(update, context):
@@ -501,6 +804,7 @@ def unknown_message(update, context):
 	update.message.reply_text('Sorry, I am a simple bot and I understand only commands.\n' + 
 		'Type /help to see them.')
 
+@timed
 @restricted
 @activated
 def unknown_command(update, context):
@@ -511,50 +815,53 @@ def unknown_command(update, context):
 
 # main function to call
 def run_reservation_bot(bot_token, 
-	sessions_file='sessions.lst', 
-	sessions_passed_file = 'sessions_passed.lst',
+	sessions_file='sessions.db', 
+	sessions_passed_file = 'sessions_passed.db',
 	config_file_user = 'user.config',
 	config_file_default = 'default.config', 
 	log_file_bot = 'reservation_bot.log', 
-	log_file_reservation = 'reservation_service.log'
+	log_file_reservation = 'reservation_service.log',
+	accounts_file = 'accounts.enc'
 	):
 
 	global bot_activated # flag variable for bot activation
 	
-	updater = Updater(bot_token, use_context=True)
+	# handlers run asynchronously (run_async) in a pool of bot_workers_n threads
+	updater = Updater(bot_token, use_context=True, workers=bot_workers_n)
 
 	# get the dispatcher to register handlers 
 	dp = updater.dispatcher
 
 	# conversation handler for the new session
 	addsession_handler = ConversationHandler(
-			entry_points = [CommandHandler('addsession', addsession)],
+			entry_points = [CommandHandler('addsession', lambda update, context: addsession(update, context, 
+				accounts_file=accounts_file), run_async=True)],
 			states = {
 				DATETIME: [
 					MessageHandler(
 						Filters.text & ~(Filters.command), lambda update, context: addsession_datetime(update, context, 
-							sessions_file=sessions_file)
+							sessions_file=sessions_file), run_async=True
 					)
 				], # get datetime of reservation
 				URL_LINK: [
 					MessageHandler(
-						Filters.text & ~(Filters.command), addsession_url_link
+						Filters.text & ~(Filters.command), addsession_url_link, run_async=True
 					)
 				], # get url-link
 				PROCESS_NEW_SESSION: [
 					CallbackQueryHandler(lambda update, context: addsession_process(update, context, 
-						sessions_file=sessions_file)
+						sessions_file=sessions_file), run_async=True
 					)
 				], # finalizing processing function - add session to the list, run process
 			},
 
 			fallbacks = [
-				CommandHandler('cancel', addsession_cancel), 
-				MessageHandler(Filters.command, addsession_unkown)
+				CommandHandler('cancel', addsession_cancel, run_async=True), 
+				MessageHandler(Filters.command, addsession_unkown, run_async=True)
 			],
 		)
 
-	dp.add_handler(CommandHandler('start', start))
+	dp.add_handler(CommandHandler('start', start, run_async=True))
 
 	# 1. basic commands
 	# addsession conversation 
@@ -562,43 +869,71 @@ def run_reservation_bot(bot_token,
 
 	# print all sessions from the database
 	dp.add_handler(CommandHandler('printsessions', lambda update, context: printsessions(update, context,
-		sessions_file=sessions_file, sessions_passed_file=sessions_passed_file)))
+		sessions_file=sessions_file, sessions_passed_file=sessions_passed_file), run_async=True))
 
 	# delete one session with number
 	dp.add_handler(CommandHandler('deletesession', lambda update, context: deletesession(update, context,
-		sessions_file=sessions_file)))
+		sessions_file=sessions_file), run_async=True))
 
 	# delete all sessions from the database
 	dp.add_handler(CommandHandler('deleteall', lambda update, context: deleteall(update, context, 
-		sessions_file=sessions_file)))
+		sessions_file=sessions_file), run_async=True))
+
+	# credentials of the account of the user
+	dp.add_handler(CommandHandler('setlogin', lambda update, context: setlogin(update, context, 
+		accounts_file=accounts_file), run_async=True))
+	dp.add_handler(CommandHandler('deletelogin', lambda update, context: deletelogin(update, context, 
+		accounts_file=accounts_file), run_async=True))
+	dp.add_handler(CommandHandler('accounts', lambda update, context: accounts(update, context, 
+		accounts_file=accounts_file), run_async=True))
+
+	# outcome of the reservations per account
+	dp.add_handler(CommandHandler('results', lambda update, context: results(update, context, 
+		sessions_passed_file=sessions_passed_file, accounts_file=accounts_file), run_async=True))
 
 	# 2. config commands
 	dp.add_handler(CommandHandler('configprintuser', lambda update, context: configprintuser(update, context, 
-		config_file_user = config_file_user)))
+		config_file_user = config_file_user), run_async=True))
 	dp.add_handler(CommandHandler('configset', lambda update, context: configset(update, context, 
-		config_file_user = config_file_user)))
+		config_file_user = config_file_user), run_async=True))
 	dp.add_handler(CommandHandler('configreset', lambda update, context: configreset(update, context, 
-		config_file_user = config_file_user, config_file_default = config_file_default)))
+		config_file_user = config_file_user, config_file_default = config_file_default), run_async=True))
 	dp.add_handler(CommandHandler('configprintdefault', lambda update, context: configprintdefault(update, context, 
-		config_file_default = config_file_default)))
+		config_file_default = config_file_default), run_async=True))
 
 	# 3. info commands 
 
 	# print help message
-	dp.add_handler(CommandHandler('help', help_command))
+	dp.add_handler(CommandHandler('help', help_command, run_async=True))
 	# print authors infromation
-	dp.add_handler(CommandHandler('about', about))
+	dp.add_handler(CommandHandler('about', about, run_async=True))
 	# dump bot-log
 	dp.add_handler(CommandHandler('logdumpbot', lambda update, context: logdumpbot(update, context, 
-		log_file_bot = log_file_bot)))
+		log_file_bot = log_file_bot), run_async=True))
 
 	# dump reservation-service-log
 	dp.add_handler(CommandHandler('logdumpres', lambda update, context: logdumpres(update, context, 
-		log_file_reservation = log_file_reservation)))
+		log_file_reservation = log_file_reservation), run_async=True))
+
+	# latency statistics of the reservation phases
+	dp.add_handler(CommandHandler('stats', lambda update, context: stats(update, context, 
+		sessions_passed_file = sessions_passed_file), run_async=True))
+
+	# latency statistics of the bot handlers
+	dp.add_handler(CommandHandler('botstats', botstats, run_async=True))
+
+	# live state of the reservation service
+	dp.add_handler(CommandHandler('servicestate', lambda update, context: servicestate(update, context, 
+		sessions_file = sessions_file), run_async=True))
+
+	# problems found by the reservations, forwarded to the users
+	alerts_state = {'since' : time.time()}
+	updater.job_queue.run_repeating(lambda context: forward_alerts(context, sessions_file, alerts_state), 
+		interval=alerts_poll_t, first=alerts_poll_t)
 
 	# uknown messages and commands
-	dp.add_handler(MessageHandler(Filters.all & ~(Filters.command), unknown_message)) # unknown messages
-	dp.add_handler(MessageHandler(Filters.command, unknown_command)) # unknown commands
+	dp.add_handler(MessageHandler(Filters.all & ~(Filters.command), unknown_message, run_async=True)) # unknown messages
+	dp.add_handler(MessageHandler(Filters.command, unknown_command, run_async=True)) # unknown commands
 
 
 	updater.start_polling()
@@ -611,12 +946,22 @@ def run_reservation_bot(bot_token,
 
 
 
+# import sessions from the legacy JSON files (only once)
+migrate_json_sessions('sessions.lst', 'sessions.db')
+migrate_json_sessions('sessions_passed.lst', 'sessions_passed.db')
+
+# sessions stored before multi-user support belong to the first admin
+if (len(restricted_admin_list) > 0):
+	assign_sessions_owner('sessions.db', restricted_admin_list[0])
+	assign_sessions_owner('sessions_passed.db', restricted_admin_list[0])
+
 # start the bot
 run_reservation_bot(bot_token=token, 
-	sessions_file='sessions.lst', 
-	sessions_passed_file = 'sessions_passed.lst',
+	sessions_file='sessions.db', 
+	sessions_passed_file = 'sessions_passed.db',
 	config_file_user = 'user.config', 
 	config_file_default = 'default.config', 
 	log_file_bot = log_file_bot, 
-	log_file_reservation = log_file_reservation
+	log_file_reservation = log_file_reservation,
+	accounts_file = 'accounts.enc'
 	)
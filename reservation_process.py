@@ -1,102 +1,378 @@
-from selenium import webdriver
 import selenium
 from pyvirtualdisplay import Display
+from browser_utils import attach_browser, launch_browser, load_page, find_reserve_button, reserve_button_locators
+from cookie_cache import cookie_login
+from clock_sync import server_fire_timestamp
+from http_engine import ENGINE_HTTP, ENGINE_SELENIUM, http_engine_from_configuration, http_reservation_attempts
+from rehearsal import rehearse
+from opening_detector import (DETECTOR_HTTP, DETECTOR_DOM, ChangePoller, wait_for_opening, arm_dom_observer, 
+	wait_for_dom_click)
+from virtual_clock import get_clock
+from racing import run_race
+from config_store import get_config_store
+from retry_policy import (RetryPolicy, PAGE_CONFIRMED, PAGE_ERROR, PAGE_FULL, PAGE_NOT_OPEN, PAGE_OPEN, text_page_state,
+	save_timelines)
+from latency_stats import (PhaseTimer, PHASE_DISPLAY_START, PHASE_CHROME_LAUNCH, PHASE_LOGIN, PHASE_LEASE, 
+	PHASE_CLOCK_SYNC, PHASE_FIRST_LOAD, PHASE_RELOAD, PHASE_FIND_ELEMENT, PHASE_CLICK, PHASE_SCREENSHOT, PHASE_FIRING_ERROR,
+	PHASE_RESULT, PHASE_DETECTED)
+from accounts import account_file_suffix
 
-from datetime import datetime
+import http.client
+import os
+import sys
 import time
 import signal
 
+import logging
+logger = logging.getLogger(name='reservation_process')
 
-def reservation_process(datetime_str, url_str, configuration):
+EXIT_NOT_BOOKED = 1 # exit code of a reservation which did not book the session
 
-	def reservation_process_signal_callback(signum, stack, datetime_str, url_str, browser, display):
-		
-		# on SIGINT, SIGTERM, SIGKILL 
-		if browser is not None:
-			browser.quit()
 
-		if display is not None:
-			display.stop()
+def reservation_process(registration_timestamp, url_str, configuration, browser_pool=None, engine=None, events=None, 
+	config_file=None, account=None, user=None):
+
+	def reservation_process_signal_callback(signum, stack, registration_timestamp, url_str, state):
+
+		# on SIGINT, SIGTERM, SIGKILL (state is cleared, the finally block does not free it again)
+		free_browsers(state, browser_pool, healthy=False)
+
+		sys.exit('Gracefully stopped the reservation subprocess PID {} the serivce with signal {}.'.format(os.getpid(), signum))
 
-		sys.exit('Gracefully stopped the reservation subprocess PID {} the serivce with signal {}.'.format(os.pid(), signum))
 
-	
-	page_reload = configuration['page_reload_n']
 	browser_delay = configuration['browser_delay_t']
-	reload_delay = configuration['reload_delay_t']
+	rehearsal_delay = configuration['rehearsal_t'] # the browser opens for the rehearsal, if it is earlier
+	race_attempts = max(1, configuration['race_attempts_n'])
+	engine = engine or configuration['reservation_engine']
+	timer = PhaseTimer(events, registration_timestamp, url_str, # latency events to the service
+		account.name if account is not None else None)
+	live = get_config_store(config_file).live if config_file is not None else None # /configset during the attempts
 
-	registration_datetime = datetime.strptime(datetime_str, '%d/%m/%Y %H:%M')
+	# resources to free on signals
+	state = {'browser' : None, 'display' : None, 'lease' : None, 'race_browsers' : []}
+	rehearsal = None
 	registration_done = False
-	browser = None
-	display = None
 
 	# init catch calls SIGINT, SIGTERM
 	# (signals from the parent process, unfortunately cannot be catched independently)
 
-	signal.signal(signal.SIGINT, lambda signum, stack: reservation_process_signal_callback(signum, stack, 
-		datetime_str=datetime_str, url_str=url_str, browser=browser, display=display))
-	signal.signal(signal.SIGTERM, lambda signum, stack: reservation_process_signal_callback(signum, stack, 
-		datetime_str=datetime_str, url_str=url_str, browser=browser, display=display))
-	
+	signal.signal(signal.SIGINT, lambda signum, stack: reservation_process_signal_callback(signum, stack,
+		registration_timestamp=registration_timestamp, url_str=url_str, state=state))
+	signal.signal(signal.SIGTERM, lambda signum, stack: reservation_process_signal_callback(signum, stack,
+		registration_timestamp=registration_timestamp, url_str=url_str, state=state))
+
 
 	# sleep before before registration opening
-	waiting_time = (registration_datetime - datetime.now()).total_seconds() - browser_delay
-	if (waiting_time < 0.0):
-		waiting_time = 0.0
-		
-	time.sleep(waiting_time)
+	get_clock().sleep_until(registration_timestamp - max(browser_delay, rehearsal_delay))
 
-	# open browser
-	chrome_options = webdriver.ChromeOptions()
-	chrome_options.add_argument('--headless')
-	chrome_options.add_argument('--no-sandbox')
-	display = Display(visible=0, size=(800, 600)) # start virtual display
-	display.start() 
+	try:
+		# lease a launched and logged in browser from the pool
+		if browser_pool is not None:
+			with timer.phase(PHASE_LEASE):
+				state['lease'] = browser_pool.lease(configuration['browser_lease_t'], url_str, os.getpid())
 
-	browser = webdriver.Chrome()
+		if state['lease'] is not None:
+			browser = attach_browser(state['lease'])
+			logger.info('Browser leased for {}: wait {:.3f} s, age {:.1f} s.'.format(url_str,
+				state['lease']['wait'], state['lease']['age']))
 
-	# input login and password in the fields
-	browser.get('') # loging page 
-	username = browser.find_element_by_id('') # find login / email
-	username.send_keys('') # type login / mail
-	passw = browser.find_element_by_id('') # find passwd
-	passw.send_keys('') # type passwd
+		else:
+			# open browser (browser_profile of the configuration)
+			with timer.phase(PHASE_DISPLAY_START):
+				display = Display(visible=0, size=(800, 600)) # start virtual display
+				display.start()
+			state['display'] = display
 
-	# click login button
-	loginButton = browser.find_element_by_name('') # find button
-	loginButton.click()
+			with timer.phase(PHASE_CHROME_LAUNCH):
+				browser = launch_browser(configuration, url_str)
+			state['browser'] = browser
 
-	# go to the reservation page and click reserve
-	browser.get(url_str) # load page
+			with timer.phase(PHASE_LOGIN):
+				cookie_login(browser, url_str, configuration, account=account) # cached cookies or full login
 
-	while True: 
+		state['browser'] = browser
 
-		date_now = datetime.now()
+		# dry run: connections, login, page, `reserve` locator (problems are sent to the user)
+		if (rehearsal_delay > 0):
+			rehearsal = rehearse(browser, url_str, configuration, engine, timer, user)
+			rehearsal.keep_alive_until(registration_timestamp - browser_delay, configuration['rehearsal_keepalive_t'])
+			if (engine == ENGINE_HTTP and not rehearsal.reachable(configuration['http_reserve_url'] or url_str)):
+				logger.warning('Reservation request of {} is not reachable, selenium engine is used.'.format(url_str))
+				engine = ENGINE_SELENIUM
 
-		if (date_now >= registration_datetime):
+		# more browsers for the racing attempts of the selenium engine
+		if (engine != ENGINE_HTTP and race_attempts > 1):
+			open_race_browsers(race_attempts - 1, browser_pool, state, timer, url_str, configuration, account)
 
-			# click reservation button (should be the only one on the page)
-			ntries = 0
-			while ((ntries < page_reload) and (registration_done == False)):
+		# fire at the opening moment of the booking server clock
+		with timer.phase(PHASE_CLOCK_SYNC):
+			fire_timestamp = server_fire_timestamp(registration_timestamp, url_str, configuration,
+				**(rehearsal.fire_args() if rehearsal is not None else {}))
+		logger.info('Reservation for {} fires {:.3f} s from the local opening time.'.format(url_str,
+			fire_timestamp - registration_timestamp))
 
-				browser.get(url_str) # load page
-				try:
-					reserveButton = browser.find_element_by_name('') # find `reserve` click
-					reserveButton.click() # click `reserve`
-					registration_done = True
-	
-				except selenium.common.exceptions.NoSuchElementException as e:
-					ntries += 1
-					
-				time.sleep(reload_delay)			
-			break
+		# direct HTTP request with the cookies of the browser, selenium is the fallback if the engine fails
+		winner_browser = None
+		fallback, budget_start = (engine != ENGINE_HTTP), None
+		if (engine == ENGINE_HTTP):
+			http_state, budget_start = http_reservation(browser, fire_timestamp, url_str, configuration, timer, live)
+			if (http_state == PAGE_CONFIRMED):
+				winner_browser = browser
+			elif (http_state == PAGE_ERROR):
+				budget = RetryPolicy.from_configuration(configuration, live, budget_start) # the budget is shared
+				fallback = not budget.exhausted()
+				logger.warning('HTTP reservation for {} failed, {}.'.format(url_str,
+					'fallback to selenium' if fallback else 'no retry budget left for selenium'))
+
+		if fallback:
+			browsers = [browser] + [race_browser['browser'] for race_browser in state['race_browsers']]
+			winner_browser = reservation_race(browsers, fire_timestamp, url_str, configuration, timer, live,
+				budget_start)
+
+		registration_done = winner_browser is not None
+		timer.record(PHASE_RESULT, get_clock().time() - fire_timestamp, registration_done)
+		logger.info('Reservation for {}{} done: {}.'.format(url_str,
+			' with account {}'.format(account.name) if account is not None else '', registration_done))
 
+		# TODO
+		# send screenshot to the user as a report
+		with timer.phase(PHASE_SCREENSHOT):
+			(winner_browser or browser).save_screenshot('res_scr{}.png'.format(account_file_suffix(account)))
+
+	finally:
+		if rehearsal is not None:
+			rehearsal.close()
+		free_browsers(state, browser_pool, healthy=sys.exc_info()[0] is None)
+
+	if not registration_done:
+		sys.exit(EXIT_NOT_BOOKED)
+
+
+def open_race_browsers(browsers_n, browser_pool, state, timer, url_str, configuration, account=None):
+	"""
+		Add browsers_n logged in browsers for racing to state['race_browsers']: idle browsers
+		of the pool (without waiting) if there is a pool, otherwise launched here
+	"""
+
+	for i in range(browsers_n):
+		lease = None
+		if browser_pool is not None:
+			lease = browser_pool.lease(0.0, url_str, os.getpid())
+			if lease is None:
+				logger.warning('Only {} racing browsers available in the pool.'.format(i + 1))
+				return
+			browser = attach_browser(lease)
 		else:
-			time.sleep(0.01)
-
-	# TODO
-	# send screenshot to the user as a report
-	browser.save_screenshot('res_scr.png')
-	
-	browser.quit()
-	display.stop()
+			with timer.phase(PHASE_CHROME_LAUNCH):
+				browser = launch_browser(configuration, url_str)
+
+		state['race_browsers'].append({'browser' : browser, 'lease' : lease})
+
+		if lease is None:
+			with timer.phase(PHASE_LOGIN):
+				cookie_login(browser, url_str, configuration, account=account)
+
+
+def free_browsers(state, browser_pool, healthy):
+	"""
+		Close the racing browsers, release the leased browser or quit the launched one and stop
+		its display; state is cleared first, so a second call (signal, then finally) frees nothing
+	"""
+	close_race_browsers(state, browser_pool, healthy)
+
+	lease, browser, display = state['lease'], state['browser'], state['display']
+	state['lease'], state['browser'], state['display'] = None, None, None
+
+	if lease is not None:
+		browser_pool.release(lease['lease_id'], healthy=healthy)
+	elif browser is not None:
+		browser.quit()
+	if display is not None:
+		display.stop()
+
+
+def close_race_browsers(state, browser_pool, healthy):
+
+	race_browsers, state['race_browsers'] = state['race_browsers'], []
+	for race_browser in race_browsers:
+		if race_browser['lease'] is not None:
+			browser_pool.release(race_browser['lease']['lease_id'], healthy=healthy)
+		else:
+			race_browser['browser'].quit()
+
+
+def http_reservation(browser, fire_timestamp, url_str, configuration, timer, live=None):
+	"""
+		Wait for the registration opening (local epoch fire_timestamp) and submit the 
+		reservation request directly with the cookies of the logged in browser,
+		race_attempts_n racing connections
+
+		Output:
+			final page state (confirmed, full, not_open - the retry budget is over; error - the engine
+			failed: no connection or only errors, selenium may take over), time.monotonic() the retry
+			budget started at (None - no attempt)
+	"""
+
+	cookies = browser.get_cookies()
+	engines = []
+	try:
+		# open connections before the opening
+		for i in range(max(1, configuration['race_attempts_n'])):
+			engine = http_engine_from_configuration(url_str, cookies, configuration)
+			try:
+				engine.connect()
+			except OSError as err:
+				logger.warning('HTTP connection {} for {} failed: {}'.format(i, url_str, err))
+				continue
+			engines.append(engine)
+
+		if (len(engines) == 0):
+			logger.warning('HTTP reservation for {} has no connection.'.format(url_str))
+			return PAGE_ERROR, None
+
+		firing_error = get_clock().sleep_until(fire_timestamp)
+		logger.info('HTTP reservation for {} fired with error {:.3f} ms.'.format(url_str, firing_error * 1000.0))
+		timer.record(PHASE_FIRING_ERROR, firing_error)
+
+		budget_start = time.monotonic()
+		policies = [RetryPolicy.from_configuration(configuration, live, budget_start) for engine in engines]
+		racers = [lambda race, engine=engine, policy=policy: http_reservation_attempts(engine, policy, race, timer)
+			for engine, policy in zip(engines, policies)]
+		winner = run_race(racers, configuration['race_stagger_t'])
+
+		save_timelines(url_str, fire_timestamp, policies)
+		if winner is not None:
+			return PAGE_CONFIRMED, budget_start
+		outcomes = [policy.outcome for policy in policies if policy.outcome is not None]
+		if (len(outcomes) > 0 and all(outcome == PAGE_ERROR for outcome in outcomes)):
+			return PAGE_ERROR, budget_start
+		return (PAGE_FULL if PAGE_FULL in outcomes else PAGE_NOT_OPEN), budget_start
+
+	finally:
+		for engine in engines:
+			engine.close()
+
+
+def reservation_race(browsers, fire_timestamp, url_str, configuration, timer, live=None, budget_start=None):
+	"""
+		Wait for the registration opening (local epoch fire_timestamp) and race to click `reserve`
+		on url_str in browsers, starts staggered by race_stagger_t (s). With an opening detector 
+		(detector_mode, see opening_detector) the race starts when the opening is detected, 
+		the dom detector clicks in the page of the first browser itself. The retry budget starts
+		at budget_start (time.monotonic(), shared with a failed http engine; None - at the firing).
+
+		Output:
+			browser that clicked the reservation button or None
+	"""
+
+	detector_mode = configuration['detector_mode']
+	poller = None
+
+	try:
+		# go to the reservation page
+		for browser in browsers:
+			with timer.phase(PHASE_FIRST_LOAD):
+				load_page(browser, url_str) # load page
+
+		# connection and reference response of the opening polls
+		if (detector_mode == DETECTOR_HTTP):
+			poller = ChangePoller(configuration['detector_url'] or url_str, browsers[0].get_cookies(),
+				configuration['detector_text'], configuration['page_full_text'])
+			try:
+				poller.connect()
+				if (poller.baseline() == PAGE_OPEN):
+					poller.close() # opened already
+					poller = None
+			except (OSError, http.client.HTTPException) as err:
+				logger.warning('Opening detector for {} failed, pages are reloaded: {}'.format(url_str, err))
+				poller.close()
+				poller = None
+
+		# wait for the registration opening
+		firing_error = get_clock().sleep_until(fire_timestamp)
+		logger.info('Reservation for {} fired with error {:.3f} ms, {} racing browsers.'.format(url_str,
+			firing_error * 1000.0, len(browsers)))
+		timer.record(PHASE_FIRING_ERROR, firing_error)
+
+		budget_start = budget_start if budget_start is not None else time.monotonic()
+		policies = [RetryPolicy.from_configuration(configuration, live, budget_start) for browser in browsers]
+
+		if poller is not None:
+			policy = RetryPolicy(configuration['retry_budget_t'], configuration['reload_delay_t'],
+				configuration['retry_backoff_t'], configuration['retry_backoff_max_t'], 0, live, budget_start) # not reloads
+			state = wait_for_opening(poller, policy, timer)
+			logger.info('Opening detector for {}: {} after {} polls, {:.3f} s.'.format(url_str, state,
+				len(policy.timeline), get_clock().time() - fire_timestamp))
+			if (state == PAGE_FULL):
+				return None
+			if (state == PAGE_OPEN):
+				timer.record(PHASE_DETECTED, get_clock().time() - fire_timestamp)
+
+		elif (detector_mode == DETECTOR_DOM):
+			try:
+				arm_dom_observer(browsers[0], reserve_button_locators())
+				clicked = wait_for_dom_click(browsers[0], configuration['detector_timeout_t'])
+			except selenium.common.exceptions.WebDriverException as err:
+				logger.warning('Opening observer for {} failed, pages are reloaded: {}'.format(url_str, err))
+				clicked = False
+			if clicked:
+				timer.record(PHASE_DETECTED, get_clock().time() - fire_timestamp)
+				logger.info('Reservation for {} clicked by the opening observer.'.format(url_str))
+				return browsers[0]
+
+	finally:
+		if poller is not None:
+			poller.close()
+
+	# reload and click, right after the detected opening
+	racers = [lambda race, browser=browser, policy=policy: reservation_attempts(browser, url_str, policy,
+		configuration['page_full_text'], configuration['page_error_text'], race, timer)
+		for browser, policy in zip(browsers, policies)]
+	winner = run_race(racers, configuration['race_stagger_t'])
+
+	save_timelines(url_str, fire_timestamp, policies)
+
+	return browsers[winner] if winner is not None else None
+
+
+def reservation_attempts(browser, url_str, policy, full_text='', error_text='', race=None, timer=None):
+	"""
+		Try to click `reserve` on url_str while policy (retry_policy.RetryPolicy) retries,
+		stops early when the race (racing.Race) is over
+
+		Output:
+			True if reservation button was clicked
+	"""
+
+	timer = timer or PhaseTimer()
+
+	while True:
+		if (race is not None and race.over()):
+			return False
+
+		start = time.monotonic()
+		try:
+			with timer.phase(PHASE_RELOAD):
+				load_page(browser, url_str) # load page
+			try:
+				# click reservation button (should be the only one on the page)
+				with timer.phase(PHASE_FIND_ELEMENT):
+					reserveButton = find_reserve_button(browser) # find `reserve` click
+				with timer.phase(PHASE_CLICK):
+					reserveButton.click() # click `reserve`
+				state = PAGE_CONFIRMED
+
+			except selenium.common.exceptions.NoSuchElementException:
+				state = text_page_state(browser.page_source, full_text, error_text)
+
+		except selenium.common.exceptions.WebDriverException as e:
+			logger.warning('Reservation attempt on {} failed: {}'.format(url_str, e))
+			state = PAGE_ERROR
+
+		delay = policy.next_delay(state, time.monotonic() - start)
+		if delay is None:
+			if (state == PAGE_FULL and race is not None):
+				race.stop()
+			return (state == PAGE_CONFIRMED)
+
+		time.sleep(delay)
@@ -0,0 +1,212 @@
+import signal
+import heapq
+import logging
+from sessions_utils import move_passed_sessions, get_io_stats
+from check_new_session import get_session_index, CHANGE_ADD
+
+"""
+reservation_scheduler - bounded pool of reservation workers.
+
+	One worker (reservation subprocess) is kept per upcoming session which opens
+	within the horizon (worker_horizon_t), at most max_workers_n workers at once.
+	Workers are spawned ahead of time, so each of them prepares its browser for its
+	own session. A worker is cancelled only when its session disappears from the
+	list (deleted by the user or moved to the passed ones); it is preempted only
+	if the pool is full and an earlier session needs a worker.
+
+	Sessions of all users wait for a worker in one priority queue (heap) ordered
+	by the registration time. The scheduler follows the changes of the session
+	index (check_new_session.SessionIndex), so an added or deleted session costs
+	O(log n); only a change of the sessions file by another process makes it
+	resynchronize with the whole list.
+
+	service_pass() is one pass of the reservation service over the sessions,
+	driven by the caller's clock (real or virtual_clock for simulations).
+
+"""
+
+logger = logging.getLogger(name='reservation_scheduler')
+
+
+class ReservationScheduler:
+	"""
+		Description:
+
+			Keeps the pool of workers consistent with the list of sessions.
+
+		Input:
+
+			spawn              : function(session, configuration) -> worker, starts a worker
+			kill               : function(worker, signum), stops a worker
+			load_configuration : function() -> configuration, called before each spawn
+	"""
+
+	def __init__(self, spawn, kill, load_configuration):
+		self._spawn = spawn
+		self._kill = kill
+		self._load_configuration = load_configuration
+		self.workers = {} # session -> worker
+		self._queue = [] # heap of sessions waiting for a worker
+		self._queued = set() # sessions of the heap, others in it were removed (lazy deletion)
+		self._finished = set() # sessions whose worker has already exited
+		self.version = None # version of the session index followed by the queue
+
+	def follow(self, index):
+		"""
+			Apply the changes of the session index since the last call
+		"""
+		self.version, changes, sessions_list = index.changes_since(self.version)
+		if changes is None:
+			self.sync(sessions_list)
+			return
+
+		for change, session in changes:
+			if (change == CHANGE_ADD):
+				self.add(session)
+			else:
+				self.remove(session)
+
+	def sync(self, sessions_list):
+		"""
+			Rebuild the queue from sessions_list (sorted by timestamp), cancel workers
+			of sessions which are not in the list anymore
+		"""
+		sessions_set = set(sessions_list)
+		for session in list(self.workers):
+			if session not in sessions_set:
+				self.cancel(session, 'session was removed')
+		self._finished &= sessions_set
+
+		self._queue = [session for session in sessions_list if (session not in self.workers and
+			session not in self._finished)] # sorted list is a heap
+		self._queued = set(self._queue)
+
+	def add(self, session):
+		if (session in self._queued or session in self.workers or session in self._finished):
+			return
+		heapq.heappush(self._queue, session)
+		self._queued.add(session)
+
+	def remove(self, session):
+		self._queued.discard(session)
+		self._finished.discard(session)
+		if session in self.workers:
+			self.cancel(session, 'session was removed')
+
+	def _head(self):
+		# earliest queued session, removed ones are dropped on the way
+		while (len(self._queue) > 0 and self._queue[0] not in self._queued):
+			heapq.heappop(self._queue)
+		return self._queue[0] if (len(self._queue) > 0) else None
+
+	def update(self, now, configuration, index=None):
+		"""
+			Description:
+
+				Dispatch queued sessions to workers at epoch now:
+
+				1. forget workers which exited by themselves
+				2. follow the changes of the session index (if given), cancel workers
+				   of removed sessions
+				3. spawn workers for sessions within the horizon, earliest first,
+				   preempting the latest worker (back to the queue) if the pool is full
+		"""
+
+		horizon = configuration['worker_horizon_t']
+		max_workers = configuration['max_workers_n']
+
+		# 1. finished workers
+		for session, worker in list(self.workers.items()):
+			if not worker.is_alive():
+				logger.info('Worker PID {} for date {}, url {} finished with exit code {}.'.format(worker.pid,
+					session.datetime_str, session.url, worker.exitcode))
+				del self.workers[session]
+				self._finished.add(session)
+
+		# 2. added and removed sessions
+		if index is not None:
+			self.follow(index)
+
+		# 3. upcoming sessions within the horizon
+		while True:
+			session = self._head()
+			if (session is None or session.timestamp - now > horizon):
+				break
+
+			if (len(self.workers) >= max_workers):
+				latest = max(self.workers)
+				if (latest < session):
+					break
+				self.cancel(latest, 'pool is full, preempted by earlier session on {}'.format(session.datetime_str))
+				self.add(latest)
+
+			heapq.heappop(self._queue)
+			self._queued.discard(session)
+			worker = self._spawn(session, self._load_configuration())
+			self.workers[session] = worker
+			logger.info('Worker spawned for date {}, url {}, user {} at PID: {} ({} workers).'.format(session.datetime_str,
+				session.url, session.user, worker.pid, len(self.workers)))
+
+	def next_spawn_timestamp(self, now, configuration):
+		"""
+			Epoch (after now) when the next queued session enters the horizon, None if there is no such session
+		"""
+		session = self._head()
+		if session is None:
+			return None
+
+		spawn_timestamp = session.timestamp - configuration['worker_horizon_t']
+		return spawn_timestamp if (spawn_timestamp > now) else None
+
+	def cancel(self, session, reason):
+		worker = self.workers.pop(session)
+		logger.info('Worker PID {} for date {}, url {} will recieve signal {}: {}.'.format(worker.pid,
+			session.datetime_str, session.url, signal.SIGTERM, reason))
+		self._kill(worker, signal.SIGTERM)
+
+	def cancel_all(self, reason):
+		for session in list(self.workers):
+			self.cancel(session, reason)
+
+
+def service_pass(scheduler, sessions_file, sessions_passed_file, configuration, now):
+	"""
+		Description:
+
+			One pass of the reservation service at epoch now:
+
+			1. get sessions (re-read only if sessions_file was changed) and move 
+			   passed sessions to sessions_passed_file (written only if there are any)
+			2. apply added and removed sessions to the queue of the scheduler (cancel
+			   workers of removed sessions), spawn workers for upcoming sessions
+
+		Output:
+
+			time (s) until the next pass is due: the next session enters the horizon
+			or update_delay_t passes (sessions may change earlier)
+	"""
+
+	sessions_index = get_session_index(sessions_file)
+	passed_timestamp = now - configuration['update_delay_t']
+
+	with sessions_index.lock: # sessions are also added by the IPC threads of the service
+		sessions_list = sessions_index.sessions()
+		passed = (len(sessions_list) > 0 and sessions_list[0].timestamp < passed_timestamp)
+		if passed:
+			move_passed_sessions(sessions_file, sessions_passed_file,
+				passed_timestamp=passed_timestamp,
+				max_passed_n=configuration['max_passed_n'])
+			sessions_index.pop_before(passed_timestamp)
+
+	if passed:
+		logger.debug('Passed sessions moved, I/O of {}: {}, of {}: {}'.format(sessions_file, 
+			get_io_stats(sessions_file), sessions_passed_file, get_io_stats(sessions_passed_file)))
+
+	scheduler.update(now, configuration, sessions_index)
+
+	timeout = configuration['update_delay_t']
+	next_spawn = scheduler.next_spawn_timestamp(now, configuration)
+	if next_spawn is not None:
+		timeout = min(timeout, max(next_spawn - now, 0.0))
+
+	return timeout
@@ -1,61 +1,62 @@
-from datetime import datetime
-import time
-import json
-from sessions_utils import get_sessions_list, put_sessions_list
-from reservation_process import reservation_process
+from sessions_store import migrate_json_sessions
+from session_events import SessionsWatcher
+from reservation_scheduler import ReservationScheduler, service_pass
+from browser_pool import start_browser_pool, stop_browser_pool
+from cookie_cache import CookieRefresher
+from virtual_clock import get_clock
+from latency_stats import LatencyRecorder, PhaseTimer, PHASE_SKIPPED, latency_file
+from reservation_process import reservation_process, EXIT_NOT_BOOKED
+from config_store import get_config_store
+from service_ipc import IpcServer, ipc_socket_path, service_handlers
+from accounts import session_accounts, MissingCredentials
 
 
 import signal
+import time
 import os
 import sys
 from multiprocessing import Process
 
 import logging
-logging.basicConfig(
-	filename='reservation_service.log',
-	filemode='a',
-	level=logging.DEBUG, 
-	format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from log_store import setup_logging
+setup_logging('reservation_service.log') # rotated log, see log_store
 
 logger = logging.getLogger(name='reservation_service')
 
-
-datetime_format = '%d/%m/%Y %H:%M'
+kill_grace_t = 5.0 # a terminated reservation subprocess has this long (s) to free its browsers before SIGKILL
 
 
 
-# write log to file and to console
 def get_configuration(config_file):
 	"""
 		Get configuration of the service from the JSON configuration file 
+		(cached, reparsed only when the file changes, see config_store)
 	"""
 
 	try:
-		read_file = open(config_file, 'r', encoding='utf-8')
+		return get_config_store(config_file).load()
 	except FileNotFoundError:
-		logger.error('No config file found in {}.',format(config_file))
+		logger.error('No config file found in {}.'.format(config_file))
 		sys.exit('Config file along {} is missing'.format(config_file))
 
-	configuration = json.load(read_file)
-	read_file.close()
-
-	return configuration
-
-def reservation_service_signal_callback(signum, stack, reservation_proc):
+def reservation_service_signal_callback(signum, stack, scheduler, browser_pool_manager, browser_pool, latency_recorder, 
+	cookie_refresher, ipc_server):
 	
 	# on recievng a stop signal in the main service process stop the work gently:
-	# 1.) kill the subprocess for next reservation with SIGTERM
-	# 2.) logs, etc.
+	# 1.) stop serving the bot, kill the subprocesses of all scheduled reservations with SIGTERM
+	# 2.) quit browsers of the browser pool
+	# 3.) write the remaining latency events, logs, etc.
 
-	logger.info('Main Service process PID {}, recieved signal {}'.format(pid, signum))
+	logger.info('Main Service process PID {}, recieved signal {}'.format(os.getpid(), signum))
 
-	if reservation_proc is not None:
-
-		pid = reservation_proc.pid
-
-		logger.info('Service subrocess PID {} will recieve signal SIGTERM.'.format(pid))
-		reservation_kill(reservation_proc, signal.SIGTERM)
-		logger.info('Service subrocess PID {} was killed.'.format(pid))
+	ipc_server.close()
+	scheduler.cancel_all('service is stopped')
+	if browser_pool is not None:
+		logger.info('Browser pool stats: {}'.format(browser_pool.stats()))
+	stop_browser_pool(browser_pool_manager, browser_pool)
+	latency_recorder.close()
+	cookie_refresher.stop()
+	sys.exit('Service stopped with signal {}.'.format(signum))
 
 
 def reservation_service(sessions_file, sessions_passed_file, config_file):
@@ -63,18 +64,24 @@ def reservation_service(sessions_file, sessions_passed_file, config_file):
 	"""
 		Description:
 
-			Service that continuosly checks file with sessions 
-			and runs a single subprocess to perform registrations. 
-			Session entries are sorted according date and for the 
-			earliest a reservation subprocess is spawned which will 
-			perform a reservation at a given time. When an earlier 
-			session entry appears - old process is killed and a new 
-			one is spawned.
+			Service that waits for changes of the file with sessions 
+			and runs a pool of subprocesses to perform registrations. 
+			Session entries are sorted according date and for each 
+			session opening within worker_horizon_t (s) a reservation 
+			subprocess is spawned in advance (at most max_workers_n), 
+			which will perform a reservation at a given time. A 
+			subprocess is killed only when its session is deleted 
+			(see reservation_scheduler). The service is woken up by change 
+			notifications (session_events), checking every update_delay_t (s) 
+			is a fallback. Latency events of the subprocesses are written 
+			next to sessions_passed_file (see latency_stats). The bot adds 
+			and deletes sessions and queries the live state through a Unix 
+			socket next to sessions_file (see service_ipc).
 
 			Service can be stopped on recieving SIGINT, SIGTERM or SIGKILL (Unix) signals, 
 			then for SIGINT, SIGTERM it will try to finalize itself gracefully
-			by killing spawned subprocess
-			(if there is one) and freeing used resources.
+			by killing spawned subprocesses
+			(if there are any) and freeing used resources.
 
 		Input:
 
@@ -89,113 +96,139 @@ def reservation_service(sessions_file, sessions_passed_file, config_file):
 
 	"""
 
-	cur_datetime_str = ''
-	cur_url_str = ''
-	proc = None # Process class for the recent reservation
-
 	# check configuration file exists
 	configuration = get_configuration(config_file) # initialize configuration
 
+	# launched and logged in browsers, leased by the reservation subprocesses
+	browser_pool_manager, browser_pool = start_browser_pool(configuration)
+
+	# keep the cached authentication cookies valid for the subprocesses
+	cookie_refresher = CookieRefresher(configuration).start()
+
+	# timings of the reservation phases sent by the subprocesses
+	latency_recorder = LatencyRecorder(latency_file(sessions_passed_file))
+
+	scheduler = ReservationScheduler(
+		spawn=lambda session, configuration: reservation_call(session, configuration, browser_pool, 
+			latency_recorder.events, config_file), 
+		kill=reservation_kill, 
+		load_configuration=lambda: get_configuration(config_file))
+	watcher = SessionsWatcher(sessions_file)
+
+	# add/delete commands and live state queries of the bot
+	ipc_server = IpcServer(ipc_socket_path(sessions_file), service_handlers(sessions_file, scheduler, 
+		latency_recorder.progress, browser_pool, latency_recorder.alerts))
+
 	logger.info('Service process started.')
 
 	signal.signal(signal.SIGINT, lambda signum, stack: reservation_service_signal_callback(signum, stack, 
-		reservation_proc = proc))
+		scheduler = scheduler, browser_pool_manager = browser_pool_manager, browser_pool = browser_pool, 
+		latency_recorder = latency_recorder, cookie_refresher = cookie_refresher, ipc_server = ipc_server))
 	signal.signal(signal.SIGTERM, lambda signum, stack: reservation_service_signal_callback(signum, stack, 
-		reservation_proc = proc))
+		scheduler = scheduler, browser_pool_manager = browser_pool_manager, browser_pool = browser_pool, 
+		latency_recorder = latency_recorder, cookie_refresher = cookie_refresher, ipc_server = ipc_server))
 	
 
+	clock = get_clock()
+
 	while True: # run forever (until (stop) signal is recieved)
 
-		# 1. read sessions_list and sort / clean the list on the passed elements
-		sessions_list = get_sessions_list(sessions_file)
-		sessions_passed_list = get_sessions_list(sessions_passed_file)
-		now = datetime.now()
-		sessions_passed = 0
-
-		for session in sessions_list:
-			session_datetime = datetime.strptime(session['datetime'], datetime_format)
-			delay = now - session_datetime
-			if (delay.total_seconds() > configuration['update_delay_t']):
-				session['passed'] = True
-				sessions_passed += 1
-				sessions_passed_list.append(session)
-			else:
-				break
-		
-		# remove passed sessions and write them to the file
-		sessions_list = sessions_list[sessions_passed:] # removed passed ones from the list
-
-		if (len(sessions_passed_list) > configuration['max_passed_n']): # keep only limited amount of passed sessions
-			sessions_passed_list = sessions_passed_list[-configuration['max_passed_n']:]
-		put_sessions_list(sessions_list, sessions_file)
-		put_sessions_list(sessions_passed_list, sessions_passed_file)
-
-		
-		# 2. Check on current reservation processes
-		if (len(sessions_list) == 0): #if no more reservations left
-			if proc is not None:
-				
-				# 2.1 kill the current reservation process since it runs too long 
-				# (more than update_delay_t)
-
-				logger.info('New session list is empty, max awaiting time exceeded, service subprocess PID {} will recieve signal {}.'.format(proc.pid, signal.SIGTERM))
-				reservation_kill(proc, signal.SIGTERM)
-				logger.info('Subprocess PID {} was terminated.'.format(proc.pid))
-
-				cur_datetime_str = ''
-				cur_url_str = ''
-				proc = None
-				
-		else:
-			next_datetime_str = sessions_list[0]['datetime']
-			next_url_str = sessions_list[0]['url']
-			if ((cur_datetime_str != next_datetime_str) or (cur_url_str != next_url_str)):
-				
-				# send signal to kill the the `older` process
-				if proc is not None:
-					
-					logger.info('Younger event found: date {}, url {}, older service subprocess PID {} will recieve signal {}.'.format(next_datetime_str, next_datetime_str, proc.pid, signal.SIGTERM))
-					reservation_kill(proc, signal.SIGTERM)
-					logger.info('Subprocess PID {} was terminated.'.format(proc.pid, signal.SIGTERM))
-
-					cur_datetime_str = ''
-					cur_url_str = ''
-					proc = None
-					
-
-				
-				# start new reservation process
-				configuration = get_configuration(config_file)
-				proc = reservation_call(next_datetime_str, next_url_str, configuration)
-				logger.info('Younger subprocess spawned for date {}, url {} at PID: {}'.format(next_datetime_str, \
-					next_datetime_str, proc.pid))
-
-				# save parameters of the new process in variables
-				cur_datetime_str = next_datetime_str
-				cur_url_str = next_url_str
-
-
-		# sleep between checks
-		time.sleep(configuration['update_delay_t'])
+		# move passed sessions, spawn workers for upcoming sessions, 
+		# cancel workers of removed sessions (with the current configuration)
+		configuration = get_configuration(config_file)
+		now = clock.time()
+		next_pass = now + service_pass(scheduler, sessions_file, sessions_passed_file, configuration, now)
+
+		# sleep until sessions change, until the next session enters the horizon 
+		# or until the next check (the time of the pass itself is not slept again)
+		if watcher.wait(clock.seconds_until(next_pass)):
+			logger.debug('Sessions change notified.')
 
 	# should never get here
 	return
 
 
-def reservation_call(datetime_str, url_str, configuration):
+class FanOutWorker:
+	"""
+		Description:
+
+			Reservation subprocesses of one session, one per account, which fire at 
+			the same opening. The scheduler sees them as a single worker: alive while 
+			any of them is alive, exit code 0 if all accounts booked the session.
+			Without processes (the session is not reserved) it has exited, not booked.
+	"""
+
+	def __init__(self, processes, accounts):
+		self.processes = processes
+		self.accounts = accounts
+
+	@property
+	def pid(self):
+		return self.processes[0].pid if (len(self.processes) > 0) else None
+
+	@property
+	def exitcode(self):
+		if (len(self.processes) == 0):
+			return EXIT_NOT_BOOKED
+		exitcodes = [proc.exitcode for proc in self.processes]
+		if None in exitcodes:
+			return None
+		return next((exitcode for exitcode in exitcodes if exitcode != 0), 0)
+
+	def is_alive(self):
+		return any(proc.is_alive() for proc in self.processes)
+
+	def start(self):
+		for proc in self.processes:
+			proc.start()
+
+
+def reservation_call(session, configuration, browser_pool=None, events=None, config_file=None):
 	"""
 		Description:
 			Function spawns a subprocess that waits for the good date 
-			and then runs the registration.
+			and then runs the registration (with a browser leased from 
+			browser_pool, if it is given), latency events are sent to 
+			the events queue. The subprocess rereads the live keys of 
+			config_file during its attempts. The session is reserved with 
+			the account of its owner; browsers of the pool are logged in 
+			with the default account, so they serve only its sessions.
+
+			A session with several accounts (Session.accounts) gets one 
+			subprocess per account (own browser, login and clock sync), 
+			all of them fire at the opening (fan-out).
 
 		Output: 
-			multiprocessing.Process class of the spawned subprocess
+			multiprocessing.Process class of the spawned subprocess, 
+			FanOutWorker of the subprocesses for several accounts 
+			(without subprocesses if the owner has no credentials, 
+			it is warned)
 	"""
 
-	proc = Process(target=reservation_process, args=(datetime_str, url_str, configuration,))
-	proc.start()
-
-	return proc
+	try:
+		accounts = session_accounts(session)
+	except MissingCredentials as err:
+		logger.warning('Session {} is not reserved: {}.'.format(session, err))
+		PhaseTimer(events, session.timestamp, session.url).record(PHASE_SKIPPED, 0.0, False, {'user' : session.user, 
+			'problems' : ['the session is not reserved: set the credentials of your account with /setlogin']})
+		return FanOutWorker([], [])
+	if (browser_pool is not None and None in accounts):
+		browser_pool.allow_hosts([session.url]) # lean browsers of the pool resolve the site of the session
+
+	processes = [Process(target=reservation_process, args=(session.timestamp, session.url, configuration, 
+		browser_pool if account is None else None, session.engine, events, config_file, account, session.user,)) 
+		for account in accounts]
+
+	if (len(processes) == 1):
+		processes[0].start()
+		return processes[0]
+
+	worker = FanOutWorker(processes, accounts)
+	worker.start()
+	logger.info('Session {} is reserved by {} accounts, subprocesses PID {}.'.format(session, len(accounts), 
+		', '.join(str(proc.pid) for proc in processes)))
+
+	return worker
 
 def reservation_kill(reservation_proc, signum):
 	"""
@@ -203,14 +236,15 @@ def reservation_kill(reservation_proc, signum):
 		Description:
 			
 			Function kills the reservaton subprocess related to 
-			reservation of the nearest session.
+			reservation of one of the sessions.
 	Input:
 
 		reservation_proc : multiprocessing.Process class for the spanwed
 		signal : signal with which the process is killed
 
-		If the subprocess is not killed via standard SIGTERM, bruteforce 
-		SIGKILL is applied.
+		If the subprocess does not exit within kill_grace_t after the standard 
+		SIGTERM (it frees its browsers and pool lease), bruteforce SIGKILL is 
+		applied. All subprocesses of a FanOutWorker are killed.
 
 	Output:
 
@@ -218,27 +252,45 @@ def reservation_kill(reservation_proc, signum):
 
 	"""
 
-	if reservation_proc is not None:
+	if reservation_proc is None:
+		return
+
+	processes = getattr(reservation_proc, 'processes', [reservation_proc])
+
+	# kill softly using multiprocessing lib, all at once so they share the grace period
+	for proc in processes:
+		proc.terminate()
 
-		# kill softly using multiprocessing lib
-		pid = reservation_proc.pid
-		reservation_proc.terminate()
+	deadline = time.monotonic() + kill_grace_t
+	for proc in processes:
+		kill_process(proc, deadline)
 
-		# check if process exists
+def kill_process(proc, deadline):
+	"""
+		Wait until the monotonic deadline for the terminated subprocess proc, SIGKILL if it survives
+	"""
+
+	pid = proc.pid
+	proc.join(max(deadline - time.monotonic(), 0.0)) # reaped if it exited
+
+	# check if process exists
+	if not proc.is_alive():
+		logger.warning('Subrocess {} was killed softly via proc.terminate()'.format(pid))
+		return
+	# process is still not killed
+	else:
 		try:
-			os.kill(pid, 0)
+			os.kill(pid, signal.SIGKILL)
+			proc.join()
+			logger.warning('Wasn\'t able to kill the process {} softly via proc.terminate(). Used SIGKILL.'.format(pid)) # if got here, process was not killed
 		except OSError:
-			logger.warning('Subrocess {} was killed softly via proc.terminate()'.format(pid))
-			return
-		# process is still not killed
-		else:
-			try:
-				os.kill(pid, signal.SIGKILL)
-				logger.warning('Wasn\'t able to kill the process {} softly via proc.terminate(). Used SIGKILL.'.format(pid)) # if got here, process was not killed
-			except OSError as ex:
-				logger.error('Received OSError when killing the subprocess {} via SIGKILL. Performing sys.exit()'.format(pid))
-				sys.exit('Could not kill child process, PID: '.format(pid))
-
-reservation_service(sessions_file='sessions.lst', 
-	sessions_passed_file = 'sessions_passed.lst', 
+			logger.error('Received OSError when killing the subprocess {} via SIGKILL. Performing sys.exit()'.format(pid))
+			sys.exit('Could not kill child process, PID: {}'.format(pid))
+
+# import sessions from the legacy JSON files (only once)
+migrate_json_sessions('sessions.lst', 'sessions.db')
+migrate_json_sessions('sessions_passed.lst', 'sessions_passed.db')
+
+reservation_service(sessions_file='sessions.db', 
+	sessions_passed_file = 'sessions_passed.db', 
 	config_file='user.config')
@@ -0,0 +1,170 @@
+import json
+import random
+import time
+
+"""
+retry_policy - adaptive retries of the reservation attempts.
+
+	Every attempt observes a state of the reservation page and the policy picks
+	the delay before the next attempt:
+
+	* not_open  - reservation is not open yet: fast retry after reload_delay_t
+	* error     - HTTP error or failed page load: exponential back off from
+	              retry_backoff_t up to retry_backoff_max_t (with jitter)
+	* throttled - server asks to slow down (429/503): back off, at least for its
+	              Retry-After
+	* full      - no places left: stop
+	* confirmed - reservation is done: stop
+	* open      - registration opened (polls of opening_detector): stop polling
+
+	The run is bounded by the time budget retry_budget_t (s) from the first
+	attempt (or from a start shared by the policies of several engines);
+	page_reload_n is an optional hard cap on the attempts (0 - none, the
+	default). The timeline of the attempts is appended to timeline_file
+	(JSON lines) to tune the policy.
+
+"""
+
+PAGE_NOT_OPEN, PAGE_ERROR, PAGE_THROTTLED, PAGE_FULL, PAGE_CONFIRMED = 'not_open', 'error', 'throttled', 'full', 'confirmed'
+PAGE_OPEN = 'open'
+final_states = (PAGE_FULL, PAGE_CONFIRMED, PAGE_OPEN)
+
+timeline_file = 'res_timeline.jsonl'
+
+
+def http_page_state(status, body, success_text='', full_text=''):
+	"""
+		State of the reservation page from the HTTP response
+	"""
+	if (status in (429, 503)):
+		return PAGE_THROTTLED
+	if (status >= 400):
+		return PAGE_ERROR
+	if (len(full_text) > 0 and full_text in body):
+		return PAGE_FULL
+	if (200 <= status < 300 and success_text in body):
+		return PAGE_CONFIRMED
+	return PAGE_NOT_OPEN
+
+
+def text_page_state(page_source, full_text='', error_text=''):
+	"""
+		State of the loaded reservation page without the reservation button
+	"""
+	if (len(full_text) > 0 and full_text in page_source):
+		return PAGE_FULL
+	if (len(error_text) > 0 and error_text in page_source):
+		return PAGE_THROTTLED
+	return PAGE_NOT_OPEN
+
+
+class RetryPolicy:
+	"""
+		Description:
+
+			Retry policy of one attempt loop, the budget starts at creation or at start.
+
+		Input:
+
+			budget      : total time (s) of the attempts
+			fast_delay  : delay (s) before the retry of a not yet open page
+			backoff     : first back off delay (s) after an error
+			backoff_max : maximal back off delay (s)
+			max_tries   : maximal number of attempts (0 - unbounded)
+			live        : function() -> live configuration keys (config_store.ConfigStore.live),
+			              reread before every retry decision, None - fixed parameters
+			start       : time.monotonic() the budget starts from (None - now)
+	"""
+
+	def __init__(self, budget, fast_delay, backoff, backoff_max, max_tries=0, live=None, start=None):
+		self.budget = budget
+		self.fast_delay = fast_delay
+		self.backoff = backoff
+		self.backoff_max = backoff_max
+		self.max_tries = max_tries
+		self.live = live
+
+		self.start = start if start is not None else time.monotonic()
+		self.timeline = [] # [elapsed (s), state, duration (s), delay (s) or None]
+		self._backoff = 0.0
+
+	@classmethod
+	def from_configuration(cls, configuration, live=None, start=None):
+		return cls(configuration['retry_budget_t'], configuration['reload_delay_t'],
+			configuration['retry_backoff_t'], configuration['retry_backoff_max_t'], configuration['page_reload_n'], live,
+			start)
+
+	def refresh(self):
+		"""
+			Apply the current live configuration (a failed read keeps the parameters)
+		"""
+		try:
+			configuration = self.live()
+		except (OSError, ValueError):
+			return
+		self.budget = configuration.get('retry_budget_t', self.budget)
+		self.fast_delay = configuration.get('reload_delay_t', self.fast_delay)
+		self.backoff = configuration.get('retry_backoff_t', self.backoff)
+		self.backoff_max = configuration.get('retry_backoff_max_t', self.backoff_max)
+		self.max_tries = configuration.get('page_reload_n', self.max_tries)
+
+	def elapsed(self):
+		return time.monotonic() - self.start
+
+	def exhausted(self):
+		if self.live is not None:
+			self.refresh()
+		return (self.elapsed() >= self.budget)
+
+	def next_delay(self, state, duration=0.0, retry_after=None):
+		"""
+			Description:
+
+				Record the attempt (its page state and duration) and pick the delay before the next one.
+
+			Output:
+
+				delay (s) or None - stop retrying
+		"""
+
+		entry = [round(self.elapsed() - duration, 4), state, round(duration, 4), None]
+		self.timeline.append(entry)
+
+		if (state in final_states):
+			return None
+		if self.live is not None:
+			self.refresh()
+		if (self.max_tries > 0 and len(self.timeline) >= self.max_tries):
+			return None
+
+		if (state == PAGE_NOT_OPEN):
+			self._backoff = 0.0
+			delay = self.fast_delay
+		else:
+			self._backoff = min(self.backoff_max, self._backoff * 2.0 if self._backoff > 0.0 else self.backoff)
+			delay = self._backoff * random.uniform(0.5, 1.0)
+			if retry_after is not None:
+				delay = max(delay, retry_after)
+
+		if (self.elapsed() + delay > self.budget):
+			return None
+
+		entry[3] = round(delay, 4)
+		return delay
+
+	@property
+	def outcome(self):
+		return self.timeline[-1][1] if (len(self.timeline) > 0) else None
+
+
+def save_timelines(url_str, fire_timestamp, policies, file=timeline_file):
+	"""
+		Append the attempt timelines of a reservation (one per racer) to file
+	"""
+	record = {
+		'url'       : url_str,
+		'fire'      : fire_timestamp,
+		'timelines' : [policy.timeline for policy in policies]
+	}
+	with open(file, 'a', encoding='utf-8') as f:
+		f.write(json.dumps(record) + '\n')
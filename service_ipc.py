@@ -0,0 +1,324 @@
+import socketserver
+import threading
+import socket
+import struct
+import json
+import time
+import os
+
+from sessions_utils import add_new_session, delete_session, delete_all_sessions, ERR_IO
+
+import logging
+
+"""
+service_ipc - request/response channel between the bot and the reservation service.
+
+	The service listens on a Unix stream socket next to the sessions file
+	(sessions.db -> sessions.db.sock, owner only). Every message is a frame:
+	4 bytes of big-endian length and a compact JSON object. A request is
+	{'command', 'args'}, the response is {'ok', 'result'} or {'ok': false, 'error'}.
+
+	Commands served by the service:
+
+	* add    - add a session of a user (sessions_utils.add_new_session) in the
+	           service, which reschedules right away
+	* delete - delete a session by its number in the queue of a user
+	           (sessions_utils.delete_session)
+	* delete_all - delete all sessions of a user (sessions_utils.delete_all_sessions)
+	* state  - live state: workers of the scheduler with the last phase of their
+	           reservation per account (latency events), browser pool, uptime
+	* alerts - events with problems found by the reservations (rehearsals) since
+	           a time, forwarded by the bot to the users
+	* ping
+
+	The sessions file stays the durable record: the service writes it before
+	answering, and if the service is not running the bot writes it directly
+	(push_add_session, push_delete_session, push_delete_all_sessions).
+
+"""
+
+logger = logging.getLogger(name='service_ipc')
+
+frame_header = struct.Struct('!I')
+max_frame_bytes = 1024 * 1024
+ipc_timeout_t = 2.0
+
+
+class ServiceUnavailable(Exception):
+	pass
+
+
+def ipc_socket_path(sessions_file):
+	return os.path.abspath(sessions_file) + '.sock'
+
+
+def send_frame(sock, message):
+	payload = json.dumps(message, separators=(',', ':')).encode('utf-8')
+	sock.sendall(frame_header.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+	chunks = []
+	while (size > 0):
+		chunk = sock.recv(size)
+		if not chunk:
+			return None
+		chunks.append(chunk)
+		size -= len(chunk)
+	return b''.join(chunks)
+
+
+def recv_frame(sock):
+	"""
+		Output:
+			next message, None if the peer closed the connection, raises ValueError on a bad frame
+	"""
+	header = _recv_exactly(sock, frame_header.size)
+	if header is None:
+		return None
+	size, = frame_header.unpack(header)
+	if (size > max_frame_bytes):
+		raise ValueError('frame of {} bytes'.format(size))
+	payload = _recv_exactly(sock, size)
+	if payload is None:
+		return None
+	return json.loads(payload.decode('utf-8'))
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+
+	def handle(self):
+		while True:
+			try:
+				request = recv_frame(self.request)
+			except (OSError, ValueError) as err:
+				logger.warning('Bad IPC request: {}'.format(err))
+				return
+			if request is None:
+				return
+
+			handler = self.server.handlers.get(request.get('command'))
+			if handler is None:
+				response = {'ok' : False, 'error' : 'unknown command {}'.format(request.get('command'))}
+			else:
+				try:
+					response = {'ok' : True, 'result' : handler(**request.get('args', {}))}
+				except Exception as err:
+					logger.error('IPC command {} failed: {!r}'.format(request.get('command'), err))
+					response = {'ok' : False, 'error' : repr(err)}
+
+			try:
+				send_frame(self.request, response)
+			except OSError:
+				return
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+class IpcServer:
+	"""
+		Description:
+
+			Service side: serves handlers (command -> function(**args) -> JSON result)
+			on socket_path in background threads.
+	"""
+
+	def __init__(self, socket_path, handlers):
+		self.socket_path = socket_path
+		try:
+			os.unlink(socket_path) # stale socket of the previous run
+		except FileNotFoundError:
+			pass
+
+		self._server = _UnixServer(socket_path, _RequestHandler)
+		os.chmod(socket_path, 0o600)
+		self._server.handlers = handlers
+		self._thread = threading.Thread(target=self._server.serve_forever, name='service-ipc', daemon=True)
+		self._thread.start()
+
+	def close(self):
+		self._server.shutdown()
+		self._server.server_close()
+		try:
+			os.unlink(self.socket_path)
+		except FileNotFoundError:
+			pass
+
+
+class ServiceClient:
+	"""
+		Description:
+
+			Bot side: persistent connection to the service of sessions_file, shared by threads.
+	"""
+
+	def __init__(self, sessions_file, timeout=ipc_timeout_t):
+		self.socket_path = ipc_socket_path(sessions_file)
+		self.timeout = timeout
+		self._sock = None
+		self._lock = threading.Lock()
+
+	def _connect(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.settimeout(self.timeout)
+		try:
+			sock.connect(self.socket_path)
+		except OSError:
+			sock.close()
+			raise
+		return sock
+
+	def _close(self):
+		if self._sock is not None:
+			self._sock.close()
+			self._sock = None
+
+	def _request(self, command, args):
+		fresh = self._sock is None
+		try:
+			if fresh:
+				self._sock = self._connect()
+			send_frame(self._sock, {'command' : command, 'args' : args})
+		except OSError as err:
+			self._close()
+			if fresh:
+				raise ServiceUnavailable(str(err))
+			return self._request(command, args) # connection of a restarted service, nothing was sent
+
+		try:
+			response = recv_frame(self._sock)
+		except (OSError, ValueError) as err:
+			response = None
+			logger.warning('IPC response to {} is lost: {}'.format(command, err))
+		if response is None:
+			self._close()
+			raise RuntimeError('no response to {}'.format(command)) # may have been executed, never resent
+
+		return response
+
+	def call(self, command, **args):
+		"""
+			Output:
+				result of command, raises ServiceUnavailable (request not sent) or RuntimeError (command failed
+				or its response is lost)
+		"""
+		with self._lock:
+			response = self._request(command, args)
+
+		if not response['ok']:
+			raise RuntimeError(response['error'])
+		return response['result']
+
+	def close(self):
+		with self._lock:
+			self._close()
+
+
+_clients = {}
+
+
+def get_service_client(sessions_file):
+	key = os.path.abspath(sessions_file)
+	client = _clients.get(key)
+	if client is None:
+		client = ServiceClient(sessions_file)
+		_clients[key] = client
+	return client
+
+
+def push_add_session(new_datetime_str, new_url_link_str, sessions_file, engine=None, user=None, accounts=None):
+	"""
+		add_new_session in the service (reschedules at once), directly in sessions_file if the
+		service is not running; returns exit_code, exit_msg as add_new_session
+	"""
+	try:
+		return tuple(get_service_client(sessions_file).call('add', new_datetime_str=new_datetime_str,
+			new_url_link_str=new_url_link_str, engine=engine, user=user, accounts=accounts))
+	except ServiceUnavailable as err:
+		logger.info('Service is not reachable ({}), session is added to {} directly.'.format(err, sessions_file))
+		return add_new_session(new_datetime_str, new_url_link_str, sessions_file, engine=engine, user=user,
+			accounts=accounts)
+	except RuntimeError as err:
+		return ERR_IO, str(err)
+
+
+def push_delete_session(sessions_file, session_number, user=None):
+	"""
+		delete_session in the service, directly in sessions_file if the service is not running
+	"""
+	try:
+		return tuple(get_service_client(sessions_file).call('delete', session_number=session_number, user=user))
+	except ServiceUnavailable as err:
+		logger.info('Service is not reachable ({}), session is deleted from {} directly.'.format(err, sessions_file))
+		return delete_session(sessions_file, session_number, user)
+	except RuntimeError as err:
+		return ERR_IO, str(err)
+
+
+def push_delete_all_sessions(sessions_file, user=None):
+	"""
+		delete_all_sessions in the service, directly in sessions_file if the service is not running
+	"""
+	try:
+		return tuple(get_service_client(sessions_file).call('delete_all', user=user))
+	except ServiceUnavailable as err:
+		logger.info('Service is not reachable ({}), sessions are deleted from {} directly.'.format(err, sessions_file))
+		return delete_all_sessions(sessions_file, user)
+	except RuntimeError as err:
+		return ERR_IO, str(err)
+
+
+def service_handlers(sessions_file, scheduler, progress=None, browser_pool=None, alerts=None):
+	"""
+		Description:
+
+			IPC commands of the reservation service.
+
+		Input:
+
+			scheduler    : reservation_scheduler.ReservationScheduler of the service
+			progress     : dict (timestamp, url, account) -> last latency event of the reservation
+			               (LatencyRecorder.progress)
+			browser_pool : browser pool proxy or None
+			alerts       : deque of latency events with problems (LatencyRecorder.alerts)
+	"""
+
+	started = time.time()
+	progress = progress if progress is not None else {}
+	alerts = alerts if alerts is not None else []
+
+	def state():
+		workers = []
+		progress_events = list(progress.items())
+		for session, worker in sorted(list(scheduler.workers.items()), key=lambda item: item[0].timestamp):
+			accounts = sorted(((key[2], event) for key, event in progress_events
+				if key[:2] == (session.timestamp, session.url)), key=lambda item: item[0] or '')
+			for account, last in accounts or [(None, None)]:
+				workers.append({
+					'date'      : session.datetime_str,
+					'url'       : session.url,
+					'user'      : session.user,
+					'account'   : account,
+					'pid'       : worker.pid,
+					'phase'     : last['phase'] if last is not None else None,
+					'phase_ok'  : last['ok'] if last is not None else None,
+					'phase_age' : (time.time() - last['time']) if last is not None else None
+				})
+
+		return {
+			'uptime'       : time.time() - started,
+			'workers'      : workers,
+			'browser_pool' : browser_pool.stats() if browser_pool is not None else None
+		}
+
+	return {
+		'ping'   : lambda: 'pong',
+		'add'    : lambda new_datetime_str, new_url_link_str, engine=None, user=None, accounts=None: add_new_session(
+			new_datetime_str, new_url_link_str, sessions_file, engine=engine, user=user, accounts=accounts),
+		'delete' : lambda session_number, user=None: delete_session(sessions_file, session_number, user),
+		'delete_all' : lambda user=None: delete_all_sessions(sessions_file, user),
+		'state'  : state,
+		'alerts' : lambda since=0.0: [alert for alert in list(alerts) if alert['time'] > since]
+	}
@@ -0,0 +1,96 @@
+from datetime import datetime
+
+"""
+session - compact record of a single reservation session.
+
+	Registration moment is kept as an epoch timestamp, parsed once from the
+	user input (datetime_format, local time) or loaded as is from the storage.
+
+"""
+
+datetime_format = '%d/%m/%Y %H:%M'
+
+
+class Session:
+	"""
+		Description:
+
+			Reservation session.
+
+		Fields:
+
+			timestamp : float  : epoch time of the registration opening
+			url       : string : url of the reservation page
+			passed    : bool   : session was moved to the passed ones
+			engine    : string : reservation engine of the session (http_engine.engines),
+			                     None - engine from the configuration
+			user      : int    : Telegram id of the user owning the session (its queue and
+			                     account, see accounts), None - the default account
+			accounts  : list   : names of the accounts reserving the session at once (fan-out),
+			                     None - the account of the user
+	"""
+
+	__slots__ = ('timestamp', 'url', 'passed', 'engine', 'user', 'accounts')
+
+	def __init__(self, timestamp, url, passed=False, engine=None, user=None, accounts=None):
+		self.timestamp = float(timestamp)
+		self.url = url
+		self.passed = bool(passed)
+		self.engine = engine
+		self.user = user
+		self.accounts = list(accounts) if accounts else None
+
+	@classmethod
+	def from_datetime_str(cls, datetime_str, url, passed=False, engine=None, user=None, accounts=None):
+		"""
+			Parse datetime_str in datetime_format (raises ValueError on bad format)
+		"""
+		return cls(datetime.strptime(datetime_str, datetime_format).timestamp(), url, passed, engine, user, accounts)
+
+	@classmethod
+	def from_dict(cls, record):
+		"""
+			Session from the stored record, old records have no timestamp and are parsed
+		"""
+		if 'timestamp' in record:
+			return cls(record['timestamp'], record['url'], record.get('passed', False), record.get('engine'),
+				record.get('user'), record.get('accounts'))
+		return cls.from_datetime_str(record['datetime'], record['url'], record.get('passed', False), record.get('engine'),
+			record.get('user'), record.get('accounts'))
+
+	def to_dict(self):
+		return {
+			'datetime'  : self.datetime_str,
+			'url'       : self.url,
+			'passed'    : self.passed,
+			'timestamp' : self.timestamp,
+			'engine'    : self.engine,
+			'user'      : self.user,
+			'accounts'  : self.accounts
+		}
+
+	@property
+	def datetime(self):
+		return datetime.fromtimestamp(self.timestamp)
+
+	@property
+	def datetime_str(self):
+		return self.datetime.strftime(datetime_format)
+
+	def key(self):
+		# sessions of different users on the same page are different sessions
+		return (self.timestamp, self.url, self.user if self.user is not None else 0)
+
+	def __eq__(self, other):
+		if not isinstance(other, Session):
+			return NotImplemented
+		return self.key() == other.key()
+
+	def __hash__(self):
+		return hash(self.key())
+
+	def __lt__(self, other):
+		return self.key() < other.key()
+
+	def __repr__(self):
+		return 'Session({}, {!r}, passed={}, user={})'.format(self.datetime_str, self.url, self.passed, self.user)
@@ -0,0 +1,172 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
+import time
+import logging
+
+"""
+session_events - change notifications for the sessions file.
+
+	Writers (the bot through sessions_utils) send a wake-up datagram to a Unix socket
+	next to the sessions file, the reservation service waits on that socket, so it
+	reschedules right after add_new_session / delete_session. Changes made by other
+	writers are caught by inotify on the directory of the sessions file (Linux),
+	waiting with a timeout keeps polling as the last fallback.
+
+"""
+
+logger = logging.getLogger(name='session_events')
+
+IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x002, 0x008, 0x080, 0x100, 0x200
+IN_NONBLOCK, IN_CLOEXEC = os.O_NONBLOCK, os.O_CLOEXEC
+inotify_event_header = struct.Struct('iIII')
+
+
+def wake_socket_path(sessions_file):
+	return os.path.abspath(sessions_file) + '.wake'
+
+
+def notify_sessions_changed(sessions_file):
+	"""
+		Description:
+
+			Wake up the service waiting on changes of sessions_file. Never blocks and
+			never fails: if the service is not running the notification is dropped.
+	"""
+
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+	try:
+		sock.setblocking(False)
+		sock.sendto(b'\x01', wake_socket_path(sessions_file))
+	except OSError:
+		pass
+	finally:
+		sock.close()
+
+
+def inotify_watch(directory):
+	"""
+		Open a non-blocking inotify descriptor watching directory, None if not supported
+	"""
+
+	libc_name = ctypes.util.find_library('c')
+	if libc_name is None:
+		return None
+
+	libc = ctypes.CDLL(libc_name, use_errno=True)
+	if not hasattr(libc, 'inotify_init1'):
+		return None
+
+	fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+	if (fd < 0):
+		return None
+
+	mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	if (libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0):
+		os.close(fd)
+		return None
+
+	return fd
+
+
+class SessionsWatcher:
+	"""
+		Description:
+
+			Waits for changes of sessions_file: wake-up datagrams from the writers,
+			inotify events on the file (and its SQLite journal) or a timeout.
+	"""
+
+	def __init__(self, sessions_file):
+		self.sessions_file = sessions_file
+		self._name = os.fsencode(os.path.basename(sessions_file))
+		self._socket_path = wake_socket_path(sessions_file)
+
+		# wake-up socket, stale socket of the previous run is removed
+		try:
+			os.unlink(self._socket_path)
+		except FileNotFoundError:
+			pass
+		self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		self._socket.bind(self._socket_path)
+		self._socket.setblocking(False)
+
+		self._inotify_fd = inotify_watch(os.path.dirname(os.path.abspath(sessions_file)))
+		if self._inotify_fd is None:
+			logger.warning('inotify is not available, changes are detected by wake-ups and polling only.')
+
+	def wait(self, timeout):
+		"""
+			Description:
+
+				Block until sessions_file changes or timeout (s) expires.
+
+			Output:
+
+				True if a change was notified, False on timeout
+		"""
+
+		fds = [self._socket.fileno()]
+		if self._inotify_fd is not None:
+			fds.append(self._inotify_fd)
+
+		deadline = time.monotonic() + max(timeout, 0.0) # a retried wait does not restart the timeout
+		while True:
+			try:
+				ready, _, _ = select.select(fds, [], [], max(deadline - time.monotonic(), 0.0))
+			except InterruptedError:
+				continue
+			break
+
+		changed = False
+		if self._socket.fileno() in ready:
+			changed = self._drain_socket() or changed
+		if (self._inotify_fd is not None and self._inotify_fd in ready):
+			changed = self._drain_inotify() or changed
+
+		return changed
+
+	def _drain_socket(self):
+		woken = False
+		while True:
+			try:
+				self._socket.recv(64)
+				woken = True
+			except BlockingIOError:
+				return woken
+
+	def _drain_inotify(self):
+		"""
+			Read pending inotify events, True if one of them is about sessions_file
+			or its SQLite journal (the shared memory file is ignored)
+		"""
+		changed = False
+		while True:
+			try:
+				data = os.read(self._inotify_fd, 4096)
+			except OSError as err:
+				if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return changed
+				raise
+
+			offset = 0
+			while (offset + inotify_event_header.size <= len(data)):
+				_, _, _, length = inotify_event_header.unpack_from(data, offset)
+				name = data[offset + inotify_event_header.size : offset + inotify_event_header.size + length].rstrip(b'\0')
+				offset += inotify_event_header.size + length
+				if name in (self._name, self._name + b'-wal', self._name + b'-journal'):
+					changed = True
+
+	def close(self):
+		self._socket.close()
+		try:
+			os.unlink(self._socket_path)
+		except FileNotFoundError:
+			pass
+		if self._inotify_fd is not None:
+			os.close(self._inotify_fd)
+			self._inotify_fd = None
@@ -0,0 +1,356 @@
+from datetime import datetime
+import bisect
+import json
+import os
+import sqlite3
+import threading
+from session import Session
+
+"""
+sessions_store - storage backends for the reservation sessions.
+
+	Two backends share the same interface:
+
+	* JsonSessionsStore   - legacy JSON list in a single file (sessions.lst), every
+	                        mutation rewrites the whole file.
+	* SqliteSessionsStore - SQLite database in WAL mode with an index on the
+	                        registration time: inserts, deletes and the lookup of the
+	                        next upcoming session are O(log n) and never rewrite the file.
+
+	The backend is chosen by the extension of the sessions file, see get_store().
+	Both backends load and store session.Session records and count their reads
+	and writes (io_stats()).
+
+"""
+
+datetime_format = '%d/%m/%Y %H:%M'
+sqlite_extensions = ('.db', '.sqlite', '.sqlite3')
+session_columns = 'timestamp, url, passed, engine, user, accounts' # in the order of the Session arguments
+
+
+class JsonSessionsStore:
+	"""
+		Sessions stored as a JSON list in a single file (legacy format).
+	"""
+
+	def __init__(self, sessions_file):
+		self.sessions_file = sessions_file
+		self.reads = 0
+		self.writes = 0
+
+	def io_stats(self):
+		return {'reads' : self.reads, 'writes' : self.writes}
+
+	def load(self, user=None):
+		self.reads += 1
+		sessions_list = []
+		with open(self.sessions_file, 'r', encoding='utf-8') as read_file:
+			try:
+				sessions_list = [Session.from_dict(record) for record in json.load(read_file)]
+			except ValueError:
+				sessions_list = []
+
+		if user is not None:
+			sessions_list = [session for session in sessions_list if session.user == user]
+		return sessions_list
+
+	def replace(self, sessions_list):
+		self.writes += 1
+		with open(self.sessions_file, 'w', encoding='utf-8') as output_file:
+			json.dump([session.to_dict() for session in sessions_list], output_file)
+
+	def insert(self, session):
+		sessions_list = self.load()
+		bisect.insort(sessions_list, session)
+		self.replace(sessions_list)
+
+	def delete_at(self, session_number, user=None):
+		sessions_list = self.load()
+		user_list = sessions_list if user is None else [session for session in sessions_list if session.user == user]
+		if (session_number < 0 or session_number >= len(user_list)):
+			return None
+		session = user_list[session_number]
+		sessions_list.remove(session)
+		self.replace(sessions_list)
+		return session
+
+	def clear(self, user=None):
+		if user is not None:
+			self.replace([session for session in self.load() if session.user != user])
+			return
+		self.writes += 1
+		open(self.sessions_file, 'w').close()
+
+	def assign_user(self, user):
+		sessions_list = self.load()
+		unowned = [session for session in sessions_list if session.user is None]
+		for session in unowned:
+			session.user = user
+		if (len(unowned) > 0):
+			self.replace(sessions_list)
+		return len(unowned)
+
+	def generation(self):
+		"""
+			Identity of the current file content: changes on every rewrite
+		"""
+		try:
+			stat = os.stat(self.sessions_file)
+		except FileNotFoundError:
+			return None
+		return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+	def own_write_generation(self, previous):
+		"""
+			Generation after a single own write following previous one: unknown for a plain file
+		"""
+		return None
+
+	def first(self):
+		sessions_list = self.load()
+		return sessions_list[0] if len(sessions_list) > 0 else None
+
+	def pop_before(self, timestamp):
+		sessions_list = self.load()
+		sessions_passed = 0
+		for session in sessions_list:
+			if (session.timestamp < timestamp):
+				sessions_passed += 1
+			else:
+				break
+
+		if (sessions_passed == 0):
+			return []
+
+		self.replace(sessions_list[sessions_passed:])
+		return sessions_list[:sessions_passed]
+
+	def append(self, sessions_list, max_n=None):
+		stored_list = self.load() + sessions_list
+		if max_n is not None: # latest max_n sessions of every user
+			counts, kept = {}, []
+			for session in reversed(stored_list):
+				counts[session.user] = counts.get(session.user, 0) + 1
+				if (counts[session.user] <= max_n):
+					kept.append(session)
+			stored_list = kept[::-1]
+		self.replace(stored_list)
+
+
+class SqliteSessionsStore:
+	"""
+		Sessions stored in a SQLite database (WAL mode) indexed on the registration time.
+	"""
+
+	def __init__(self, sessions_file):
+		self.sessions_file = sessions_file
+		self._lock = threading.Lock()
+		self._commits = 0 # number of own write transactions
+		self.reads = 0
+		self.writes = 0
+		self._conn = sqlite3.connect(sessions_file, timeout=10.0,
+			isolation_level=None, check_same_thread=False)
+		self._conn.execute('PRAGMA journal_mode=WAL')
+		self._conn.execute('PRAGMA synchronous=NORMAL')
+		self._conn.execute('CREATE TABLE IF NOT EXISTS sessions ('
+			'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+			'timestamp REAL NOT NULL, '
+			'datetime TEXT NOT NULL, '
+			'url TEXT NOT NULL, '
+			'passed INTEGER NOT NULL DEFAULT 0, '
+			'engine TEXT, '
+			'user INTEGER, '
+			'accounts TEXT)') # JSON list of account names
+		# databases created before the engine, user and accounts columns were added
+		columns = [row[1] for row in self._conn.execute('PRAGMA table_info(sessions)')]
+		if 'engine' not in columns:
+			self._conn.execute('ALTER TABLE sessions ADD COLUMN engine TEXT')
+		if 'user' not in columns:
+			self._conn.execute('ALTER TABLE sessions ADD COLUMN user INTEGER')
+		if 'accounts' not in columns:
+			self._conn.execute('ALTER TABLE sessions ADD COLUMN accounts TEXT')
+		self._conn.execute('CREATE INDEX IF NOT EXISTS sessions_timestamp_idx ON sessions (timestamp, id)')
+		self._conn.execute('CREATE INDEX IF NOT EXISTS sessions_user_idx ON sessions (user, timestamp, id)')
+		self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+	def _transaction(self, statements):
+		"""
+			Run statements(cursor) inside a single write transaction
+		"""
+		with self._lock:
+			self.writes += 1
+			cursor = self._conn.cursor()
+			cursor.execute('BEGIN IMMEDIATE')
+			try:
+				result = statements(cursor)
+			except BaseException:
+				cursor.execute('ROLLBACK')
+				raise
+			cursor.execute('COMMIT')
+			self._commits += 1
+			return result
+
+	def _query(self, sql, args=()):
+		with self._lock:
+			self.reads += 1
+			return self._conn.execute(sql, args).fetchall()
+
+	def generation(self):
+		"""
+			Identity of the current database content: data_version changes on commits
+			of other connections, own commits are counted separately
+		"""
+		with self._lock:
+			data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+			return (data_version, self._commits)
+
+	def own_write_generation(self, previous):
+		"""
+			Generation after a single own commit following previous one
+		"""
+		if previous is None:
+			return None
+		return (previous[0], previous[1] + 1)
+
+	def io_stats(self):
+		return {'reads' : self.reads, 'writes' : self.writes}
+
+	def load(self, user=None):
+		if user is not None:
+			rows = self._query('SELECT ' + session_columns + ' FROM sessions WHERE user = ? ORDER BY timestamp, id', (user,))
+		else:
+			rows = self._query('SELECT ' + session_columns + ' FROM sessions ORDER BY timestamp, id')
+		return [self._session(row) for row in rows]
+
+	@staticmethod
+	def _session(row):
+		# row of session_columns
+		return Session(*row[:-1], accounts=json.loads(row[-1]) if row[-1] else None)
+
+	def replace(self, sessions_list):
+		def statements(cursor):
+			cursor.execute('DELETE FROM sessions')
+			self._insert_many(cursor, sessions_list)
+		self._transaction(statements)
+
+	@staticmethod
+	def _insert_many(cursor, sessions_list):
+		cursor.executemany('INSERT INTO sessions (timestamp, datetime, url, passed, engine, user, accounts) '
+			'VALUES (?, ?, ?, ?, ?, ?, ?)',
+			[(session.timestamp, session.datetime_str, session.url, int(session.passed), session.engine, session.user,
+				json.dumps(session.accounts) if session.accounts else None) for session in sessions_list])
+
+	def insert(self, session):
+		self._transaction(lambda cursor: self._insert_many(cursor, [session]))
+
+	def delete_at(self, session_number, user=None):
+		if (session_number < 0):
+			return None
+
+		def statements(cursor):
+			if user is not None:
+				row = cursor.execute('SELECT id, ' + session_columns + ' FROM sessions WHERE user = ? '
+					'ORDER BY timestamp, id LIMIT 1 OFFSET ?', (user, session_number)).fetchone()
+			else:
+				row = cursor.execute('SELECT id, ' + session_columns + ' FROM sessions ORDER BY timestamp, id LIMIT 1 OFFSET ?',
+					(session_number,)).fetchone()
+			if row is None:
+				return None
+			cursor.execute('DELETE FROM sessions WHERE id = ?', row[:1])
+			return self._session(row[1:])
+		return self._transaction(statements)
+
+	def clear(self, user=None):
+		if user is not None:
+			self._transaction(lambda cursor: cursor.execute('DELETE FROM sessions WHERE user = ?', (user,)))
+		else:
+			self._transaction(lambda cursor: cursor.execute('DELETE FROM sessions'))
+
+	def assign_user(self, user):
+		"""
+			Give sessions without an owner (stored before multi-user support) to user
+		"""
+		return self._transaction(lambda cursor: cursor.execute('UPDATE sessions SET user = ? WHERE user IS NULL',
+			(user,)).rowcount)
+
+	def first(self):
+		rows = self._query('SELECT ' + session_columns + ' FROM sessions ORDER BY timestamp, id LIMIT 1')
+		return self._session(rows[0]) if len(rows) > 0 else None
+
+	def pop_before(self, timestamp):
+		def statements(cursor):
+			rows = cursor.execute('SELECT ' + session_columns + ' FROM sessions WHERE timestamp < ? '
+				'ORDER BY timestamp, id', (timestamp,)).fetchall()
+			if (len(rows) > 0):
+				cursor.execute('DELETE FROM sessions WHERE timestamp < ?', (timestamp,))
+			return [self._session(row) for row in rows]
+		return self._transaction(statements)
+
+	def append(self, sessions_list, max_n=None):
+		def statements(cursor):
+			self._insert_many(cursor, sessions_list)
+			if max_n is not None: # latest max_n sessions of every user
+				cursor.execute('DELETE FROM sessions WHERE id IN (SELECT id FROM (SELECT id, ROW_NUMBER() OVER '
+					'(PARTITION BY user ORDER BY timestamp DESC, id DESC) AS rank FROM sessions) WHERE rank > ?)', (max_n,))
+		self._transaction(statements)
+
+	def import_once(self, marker, sessions_list):
+		"""
+			Append sessions_list unless marker was already recorded, in one transaction
+		"""
+		def statements(cursor):
+			if cursor.execute('SELECT 1 FROM meta WHERE key = ?', (marker,)).fetchone() is not None:
+				return False
+			self._insert_many(cursor, sessions_list)
+			cursor.execute('INSERT INTO meta (key, value) VALUES (?, ?)',
+				(marker, datetime.now().strftime(datetime_format)))
+			return True
+		return self._transaction(statements)
+
+
+_stores = {}
+
+def get_store(sessions_file):
+	"""
+		Description:
+
+			Get (cached) storage backend for sessions_file. Files with extensions
+			from sqlite_extensions are SQLite databases, all other files are JSON lists.
+			Stores are cached per process, since SQLite connections must not be shared
+			with forked subprocesses.
+	"""
+
+	key = (os.getpid(), os.path.abspath(sessions_file))
+	store = _stores.get(key)
+	if store is None:
+		if sessions_file.endswith(sqlite_extensions):
+			store = SqliteSessionsStore(sessions_file)
+		else:
+			store = JsonSessionsStore(sessions_file)
+		_stores[key] = store
+
+	return store
+
+
+def migrate_json_sessions(json_file, sessions_file):
+	"""
+		Description:
+
+			Import sessions from the legacy JSON json_file into the SQLite sessions_file.
+			Import is done only once per json_file, the fact of the migration is recorded
+			in the database, so it is safe to call on every start.
+
+		Output:
+
+			number of imported sessions
+	"""
+
+	store = get_store(sessions_file)
+	if not isinstance(store, SqliteSessionsStore) or not os.path.exists(json_file):
+		return 0
+
+	sessions_list = JsonSessionsStore(json_file).load()
+	if not store.import_once('migrated:' + os.path.abspath(json_file), sessions_list):
+		return 0
+
+	return len(sessions_list)
@@ -1,89 +1,120 @@
-from datetime import datetime
-import json
+import sqlite3
+from session import Session
+from sessions_store import get_store
+from check_new_session import get_session_index
+from session_events import notify_sessions_changed
 
 """
 sessions_utils - manipulation with reserviations sessions through their files.
 
+	All functions work on top of the storage backend returned by
+	sessions_store.get_store(), so sessions_file can be either a legacy JSON
+	list (sessions.lst) or a SQLite database (sessions.db). Sessions are
+	session.Session records. Every change made by the functions below wakes up
+	the reservation service (session_events.notify_sessions_changed).
+
 """
 
 datetime_format = '%d/%m/%Y %H:%M'
-CORRECT, ERR_NO_FILE, ERR_FILE_BUSY, ERR_JSON, ERR_IO = range(5)
+CORRECT, ERR_NO_FILE, ERR_FILE_BUSY, ERR_JSON, ERR_IO, ERR_CONFLICT = range(6)
+
+def store_error(err):
+	"""
+		Convert exception raised by the storage backend to err_code, err_msg
+	"""
+	if isinstance(err, sqlite3.OperationalError) and 'locked' in str(err):
+		return ERR_FILE_BUSY, 'database is busy: ' + str(err)
+	if isinstance(err, FileNotFoundError):
+		return ERR_NO_FILE, str(err)
+	if isinstance(err, ValueError):
+		return ERR_JSON, 'json error: ' + str(err)
+
+	return ERR_IO, str(err)
 
-def add_new_session(new_datetime_str, new_url_link_str, sessions_file):
+def add_new_session(new_datetime_str, new_url_link_str, sessions_file, engine=None, user=None, accounts=None):
 	"""
 		Description:
 
-			1) Read sessions from sessions_file
-			2) Add new record to the list of sessions and sort the new list w.r.t. to datetime
-			3) Stores back new list in sessions_file
-		
+			1) Parse new_datetime_str and create a new Session record
+			2) Find the position of the new record in the session index, the same
+			   lookup checks that it is not too close to its neighbours
+			3) Add new record to the storage of sessions_file, the storage keeps
+			   records sorted w.r.t. to datetime
+
 		Input:
 			new_datetime_str : string : date and time in of the reservation datetime_format
 			new_url_link_str : string : url of the reservation page
 			sessions_file    : string : name of the file, where all sessions are stored
+			engine           : string : reservation engine of the session (None - from the configuration)
+			user             : int    : Telegram id of the owner of the session (None - the default account)
+			accounts         : list   : names of the accounts reserving the session at once (None - of the owner)
 
-		Output: 
-			exit_code, exit_msg 
+		Output:
+			exit_code, exit_msg
 			If exit_code > 0, then some error happened and no new element is added to the list.
 			Error message is returned in exit_msg, if no error was produced exit_msg = ''.
 
 		Returned errors:
-			TODO...
+			ERR_NO_FILE, ERR_FILE_BUSY, ERR_JSON, ERR_IO, ERR_CONFLICT
 
 	"""
-	# 1. read list of sessions from sessions_file
-	sessions_list = get_sessions_list(sessions_file)
 
 	# new element
-	new_session = {
-			'datetime' : new_datetime_str, 
-			'url'      : new_url_link_str,
-			'passed'   : False
-		}	
-
-	# 2. check that new record is correct, etc.
-
-
-	# append new element and resort the list by the date
-	sessions_list.append(new_session)
-	new_sessions_list = sorted(sessions_list, 
-		key=lambda k: datetime.strptime(k['datetime'], datetime_format))
+	try:
+		new_session = Session.from_datetime_str(new_datetime_str, new_url_link_str, engine=engine, user=user,
+			accounts=accounts)
+	except ValueError as err:
+		return ERR_IO, 'bad date format: ' + str(err)
 
-	# 3. write the new list back to sessions_file
-	err_code, err_msg = put_sessions_list(new_sessions_list, sessions_file)
+	return add_session(new_session, sessions_file)
 
-	return err_code, err_msg
-
-def get_sessions_list(sessions_file):
-	""" 
-		Get session_list from JSON sessions_file .
+def add_session(new_session, sessions_file):
+	"""
+		Add new Session record to sessions_file, returns exit_code, exit_msg as add_new_session
 	"""
 
-	sessions_list = []
-	with open(sessions_file, 'r', encoding='utf-8') as read_file:
-		try:
-			sessions_list = json.load(read_file)
-			read_file.close()
-		except ValueError:
-			sessions_list = []
-
+	try:
+		index = get_session_index(sessions_file)
+		with index.lock: # no other thread adds a session between the check and the insert
+			position, session = index.find_conflict(new_session.timestamp, new_session.user)
+			if session is not None:
+				err_code = ERR_CONFLICT
+				err_msg = 'Session is too close to already existing session on {}.'.format(session.datetime_str)
+				return err_code, err_msg
+
+			get_store(sessions_file).insert(new_session)
+			index.insert(new_session)
+	except (OSError, ValueError, sqlite3.Error) as err:
+		return store_error(err)
+
+	notify_sessions_changed(sessions_file)
+	return CORRECT, ''
+
+def get_sessions_list(sessions_file, user=None):
+	"""
+		Get session_list (Session records sorted by datetime) from sessions_file,
+		of the queue of user (None - all sessions).
+	"""
 
-	return sessions_list
+	return get_store(sessions_file).load(user)
 
+def get_next_session(sessions_file):
+	"""
+		Get the earliest session from sessions_file or None if there are no sessions.
+	"""
 
+	return get_store(sessions_file).first()
 
 def put_sessions_list(sessions_list, sessions_file):
 	"""
 		Write session_list to sessions_file
 	"""
-	with open(sessions_file, 'w', encoding='utf-8') as output_file:
-		try:
-			json.dump(sessions_list, output_file)
-			output_file.close()
-		except ValueError as err:
-			err_code = ERR_JSON
-			err_msg = 'json error: ' + str(err)
-			return err_code, err_msg
+	try:
+		get_store(sessions_file).replace(sessions_list)
+	except (OSError, ValueError, sqlite3.Error) as err:
+		return store_error(err)
+
+	notify_sessions_changed(sessions_file)
 
 	# no errors during writing of the new list
 	err_code = 0
@@ -91,37 +122,82 @@ def put_sessions_list(sessions_list, sessions_file):
 
 	return err_code, err_msg
 
+def move_passed_sessions(sessions_file, sessions_passed_file, passed_timestamp, max_passed_n):
+	"""
+		Description:
+
+			Move sessions registered before passed_timestamp (epoch) from sessions_file
+			to sessions_passed_file, keeping at most max_passed_n passed sessions.
+
+		Output:
+
+			list of moved sessions
+	"""
+
+	sessions_passed_list = get_store(sessions_file).pop_before(passed_timestamp)
+	for session in sessions_passed_list:
+		session.passed = True
+
+	if (len(sessions_passed_list) > 0):
+		get_store(sessions_passed_file).append(sessions_passed_list, max_n=max_passed_n)
+
+	return sessions_passed_list
+
 
-def delete_all_sessions(sessions_list):
+def get_io_stats(sessions_file):
 	"""
-		Make sessions_list empty
+		Number of reads and writes of sessions_file made by this process
+	"""
+	return get_store(sessions_file).io_stats()
+
+
+def delete_all_sessions(sessions_list, user=None):
+	"""
+		Make sessions_list (the queue of user, None - all sessions) empty
 	"""
 	try:
-		open(sessions_list, 'w').close()
+		get_store(sessions_list).clear(user)
 	except Exception as e:
 		err_code = ERR_IO
 		err_msg = str(e)
 		return err_code, err_msg
 
+	notify_sessions_changed(sessions_list)
 	return 0, ''
 
-def delete_session(sessions_file, session_number):
+def delete_session(sessions_file, session_number, user=None):
 	"""
-		Delete session with specific number"
+		Delete session with specific number (in the queue of user, None - of all sessions)
 	"""
 
-	# get list of all sessions
 	err_code = CORRECT
 	err_msg = ''
 
-	sessions_list = get_sessions_list(sessions_file)
-	if (session_number >= 0 and session_number < len(sessions_list)):
-		sessions_list.pop(session_number)
-		err_code, err_msg = put_sessions_list(sessions_list, sessions_file)
-	else:
+	try:
+		index = get_session_index(sessions_file)
+		with index.lock:
+			deleted = get_store(sessions_file).delete_at(session_number, user)
+			if deleted is not None:
+				index.remove(deleted)
+	except (OSError, ValueError, sqlite3.Error) as err:
+		return store_error(err)
+
+	if deleted is None:
 		err_code = ERR_IO
 		err_msg = 'Session number is out of bounds.'
+	else:
+		notify_sessions_changed(sessions_file)
 
 	return err_code, err_msg
 
+def assign_sessions_owner(sessions_file, user):
+	"""
+		Give sessions stored before multi-user support (without an owner) to user,
+		returns the number of such sessions
+	"""
+	assigned = get_store(sessions_file).assign_user(user)
+	if (assigned > 0):
+		notify_sessions_changed(sessions_file)
+	return assigned
+
 
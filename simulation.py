@@ -0,0 +1,195 @@
+import itertools
+import argparse
+import tempfile
+import random
+import json
+import time
+import os
+
+from session import Session
+from sessions_store import get_store
+from check_new_session import min_delay_time_sec
+from reservation_scheduler import ReservationScheduler, service_pass
+from virtual_clock import VirtualClock, set_clock
+
+import logging
+
+"""
+simulation - time-warp replay of the reservation service schedule.
+
+	The service passes (reservation_scheduler.service_pass) run on a
+	VirtualClock, so a week of sessions is replayed in seconds. Reservation
+	subprocesses are replaced by stub workers which only note when they were
+	spawned and stopped: a worker is alive from its spawn until attempt_t (s)
+	after the opening of its session.
+
+	Outcome of every session:
+
+	* served    - a worker was running browser_delay_t before the opening and at it
+	* late      - a worker was spawned less than browser_delay_t before the opening
+	* missed    - no worker was running at the opening (never spawned or preempted)
+
+	Scheduling decisions (spawns, preemptions, cancels) are counted and, with
+	--verbose, printed in the order of the simulated time.
+
+	Usage:
+		python simulation.py --sessions 2000 --days 7
+		python simulation.py --sessions-file sessions.db --days 7 --config user.config
+
+"""
+
+logger = logging.getLogger(name='simulation')
+
+SERVED, LATE, MISSED = 'served', 'late', 'missed'
+
+
+class StubWorker:
+	"""
+		Description:
+
+			Stand-in of a reservation subprocess on the virtual clock.
+	"""
+
+	_pids = itertools.count(1)
+
+	def __init__(self, session, clock, attempt_t, events):
+		self.session = session
+		self.clock = clock
+		self.pid = next(self._pids)
+		self.spawned = clock.time()
+		self.stopped = None
+		self.exitcode = None
+		self._end = session.timestamp + attempt_t
+		self._events = events
+		events.append((self.spawned, 'spawn', session))
+
+	def is_alive(self):
+		if (self.stopped is None and self.clock.time() >= self._end):
+			self.stopped, self.exitcode = self._end, 0
+		return self.stopped is None
+
+	def kill(self):
+		now = self.clock.time()
+		self.stopped, self.exitcode = now, -15
+		self._events.append((now, 'preempt' if now < self.session.timestamp else 'cancel', self.session))
+
+
+def random_sessions(sessions_n, start, days, seed=None):
+	"""
+		sessions_n sessions at distinct min_delay_time_sec slots within days from start
+	"""
+	slots_n = int(days * 86400 // min_delay_time_sec)
+	if (sessions_n > slots_n):
+		raise ValueError('at most {} sessions fit in {} days'.format(slots_n, days))
+
+	rng = random.Random(seed)
+	slots = sorted(rng.sample(range(1, slots_n + 1), sessions_n))
+	return [Session(start + slot * min_delay_time_sec, 'https://example.com/session/{}'.format(slot)) for slot in slots]
+
+
+def session_outcome(session, workers, browser_delay):
+	"""
+		Outcome of session from its stub workers (in the order of spawns)
+	"""
+	for worker in workers:
+		running_at_opening = (worker.spawned <= session.timestamp and
+			(worker.stopped is None or worker.stopped >= session.timestamp))
+		if running_at_opening:
+			return SERVED if (worker.spawned <= session.timestamp - browser_delay) else LATE
+	return MISSED
+
+
+def simulate(sessions, configuration, start, end, attempt_t=10.0):
+	"""
+		Description:
+
+			Replay the service passes over sessions from epoch start to end on a virtual clock.
+
+		Output:
+
+			report dict and the list of decisions (time, action, session)
+	"""
+
+	clock = VirtualClock(start)
+	previous_clock = set_clock(clock)
+
+	events = []
+	workers = {} # session -> list of its stub workers
+	max_workers = 0
+	passes = 0
+
+	def spawn(session, configuration):
+		worker = StubWorker(session, clock, attempt_t, events)
+		workers.setdefault(session, []).append(worker)
+		return worker
+
+	scheduler = ReservationScheduler(spawn=spawn, kill=lambda worker, signum: worker.kill(),
+		load_configuration=lambda: configuration)
+
+	wall_start = time.monotonic()
+	try:
+		with tempfile.TemporaryDirectory(prefix='simulation-') as workdir: # sessions files of the run are removed
+			sessions_file = os.path.join(workdir, 'sessions.db')
+			sessions_passed_file = os.path.join(workdir, 'sessions_passed.db')
+			get_store(sessions_file).replace(sessions)
+
+			while (clock.time() < end):
+				timeout = service_pass(scheduler, sessions_file, sessions_passed_file, configuration, clock.time())
+				passes += 1
+				max_workers = max(max_workers, len(scheduler.workers))
+				clock.sleep(min(timeout, end - clock.time()) if timeout > 0.0 else configuration['update_delay_t'])
+	finally:
+		set_clock(previous_clock)
+
+	outcomes = {SERVED : [], LATE : [], MISSED : []}
+	for session in sessions:
+		if (session.timestamp <= end):
+			outcomes[session_outcome(session, workers.get(session, []), configuration['browser_delay_t'])].append(session)
+
+	actions = [action for when, action, session in events]
+	report = {
+		'sessions'       : sum(len(listed) for listed in outcomes.values()),
+		'served'         : len(outcomes[SERVED]),
+		'late'           : len(outcomes[LATE]),
+		'missed'         : len(outcomes[MISSED]),
+		'spawns'         : actions.count('spawn'),
+		'preemptions'    : actions.count('preempt'),
+		'cancels'        : actions.count('cancel'),
+		'passes'         : passes,
+		'max_workers'    : max_workers,
+		'simulated_days' : (end - start) / 86400.0,
+		'wall_t'         : time.monotonic() - wall_start,
+		'missed_sessions': [session.datetime_str for session in outcomes[MISSED]]
+	}
+
+	return report, events
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Time-warp simulation of the reservation service schedule.')
+	parser.add_argument('--sessions', type=int, default=1000, help='number of random sessions')
+	parser.add_argument('--sessions-file', default=None, help='replay sessions of this file instead of random ones')
+	parser.add_argument('--days', type=float, default=7.0)
+	parser.add_argument('--config', default='default.config')
+	parser.add_argument('--attempt-t', type=float, default=10.0, help='stub worker runs this long (s) after the opening')
+	parser.add_argument('--seed', type=int, default=None)
+	parser.add_argument('--verbose', action='store_true', help='print every scheduling decision')
+	args = parser.parse_args()
+
+	with open(args.config, 'r', encoding='utf-8') as f:
+		configuration = json.load(f)
+
+	start = time.time()
+	if args.sessions_file is not None:
+		sessions = [session for session in get_store(args.sessions_file).load() if session.timestamp > start]
+	else:
+		sessions = random_sessions(args.sessions, start, args.days, args.seed)
+	end = start + args.days * 86400.0
+
+	report, events = simulate(sessions, configuration, start, end, args.attempt_t)
+
+	if args.verbose:
+		for when, action, session in events:
+			print('{:>10.1f} s  {:8} {} {}'.format(when - start, action, session.datetime_str, session.url))
+
+	print(json.dumps(report, indent=4))
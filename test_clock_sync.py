@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+from mock_booking_server import start_mock_server
+from clock_sync import estimate_clock_offset, server_fire_timestamp
+
+"""
+test_clock_sync - clock offset estimation against the mock booking site with a skewed clock.
+
+	The recovered offset has to be within the reported bound of the skew: the
+	intersection of the Date header bounds (mode date) or half the rtt of the
+	best sample of /time (mode epoch).
+
+"""
+
+skews = (-0.7, 0.0, 0.35)
+tolerance_t = 1e-3 # float rounding of the timestamps
+
+
+@pytest.fixture(params=skews)
+def skewed_server(request):
+	server = start_mock_server(skew=request.param)
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+def test_date_offset_within_bounds(skewed_server):
+	estimate = estimate_clock_offset(skewed_server.url + '/', samples_n=4, mode='date')
+
+	assert abs(estimate.offset - skewed_server.skew) <= estimate.uncertainty + tolerance_t
+	assert estimate.uncertainty < 0.5 # the samples timed at the second boundaries narrow the bounds
+
+
+def test_epoch_offset_within_rtt(skewed_server):
+	estimate = estimate_clock_offset(skewed_server.url + '/time', samples_n=4, mode='epoch')
+
+	assert abs(estimate.offset - skewed_server.skew) <= estimate.rtt / 2.0 + tolerance_t
+
+
+def test_server_fire_timestamp(skewed_server):
+	configuration = {'clock_sync_mode' : 'epoch', 'clock_sync_url' : skewed_server.url + '/time',
+		'clock_sync_samples_n' : 4}
+	opening = time.time() + skewed_server.skew + 60.0 # server epoch of the opening
+
+	fire_timestamp = server_fire_timestamp(opening, skewed_server.url + '/', configuration)
+
+	# sent at fire_timestamp, the request reaches the server at the opening (up to the rtt)
+	estimate = estimate_clock_offset(skewed_server.url + '/time', samples_n=4, mode='epoch')
+	assert abs(fire_timestamp - (opening - skewed_server.skew)) <= estimate.rtt + tolerance_t
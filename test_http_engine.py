@@ -0,0 +1,99 @@
+import time
+
+import pytest
+
+from mock_booking_server import start_mock_server, confirmed_text, sold_out_text
+from http_engine import HttpReservationEngine, http_reservation_attempts
+from retry_policy import RetryPolicy, PAGE_CONFIRMED, PAGE_FULL, PAGE_NOT_OPEN
+
+"""
+test_http_engine - HttpReservationEngine and http_reservation_attempts against the mock booking site.
+
+"""
+
+mock_cookies = [{'name' : 'session', 'value' : 'mock', 'path' : '/'}]
+
+
+@pytest.fixture
+def server():
+	server = start_mock_server()
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+def mock_engine(server):
+	engine = HttpReservationEngine(server.url + '/reserve', mock_cookies, method='POST',
+		success_text=confirmed_text, full_text=sold_out_text, check_url=server.url + '/')
+	engine.connect()
+	return engine
+
+
+def mock_policy(budget=2.0):
+	return RetryPolicy(budget, fast_delay=0.02, backoff=0.02, backoff_max=0.1)
+
+
+def states(policy):
+	return [entry[1] for entry in policy.timeline]
+
+
+def test_confirmed(server):
+	engine = mock_engine(server)
+	policy = mock_policy()
+	try:
+		assert http_reservation_attempts(engine, policy)
+	finally:
+		engine.close()
+
+	assert states(policy) == [PAGE_CONFIRMED]
+	assert len(server.reservations) == 1
+
+
+def test_sold_out(server):
+	server.script(opening=time.time() - 10.0, sold_out_after=0.0)
+	engine = mock_engine(server)
+	policy = mock_policy()
+	try:
+		assert not http_reservation_attempts(engine, policy)
+	finally:
+		engine.close()
+
+	assert states(policy) == [PAGE_FULL] # no places left stops the attempts
+	assert len(server.reservations) == 0
+
+
+def test_not_open_then_open_within_budget(server):
+	server.script(opening=time.time() + 0.3)
+	engine = mock_engine(server)
+	policy = mock_policy()
+	try:
+		assert http_reservation_attempts(engine, policy)
+	finally:
+		engine.close()
+
+	assert states(policy)[-1] == PAGE_CONFIRMED
+	assert set(states(policy)[:-1]) == {PAGE_NOT_OPEN}
+	assert len(server.reservations) == 1
+	assert policy.elapsed() < policy.budget
+
+
+def test_dropped_connection_between_attempts(server):
+	server.script(opening=time.time() + 0.3)
+	engine = mock_engine(server)
+	try:
+		assert engine.attempt()[0] == PAGE_NOT_OPEN
+		sock = engine._conn.sock
+
+		server.drop_connections() # server closes the idle keep-alive connection
+		time.sleep(0.05)
+
+		assert engine.attempt()[0] == PAGE_NOT_OPEN # reopened before the request, nothing is lost
+		assert engine._conn.sock is not sock
+
+		policy = mock_policy()
+		assert http_reservation_attempts(engine, policy)
+	finally:
+		engine.close()
+
+	assert len(server.reservations) == 1
+	assert len(server.requests) == 2 + len(policy.timeline) # one request per attempt, none resent
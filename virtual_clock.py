@@ -0,0 +1,78 @@
+import threading
+import time
+import precise_timer
+
+"""
+virtual_clock - source of the current time and of the waits.
+
+	The service, the reservation subprocesses and the checks of new sessions
+	read the time and wait through the current clock (get_clock()). SystemClock
+	is the wall clock (waits by precise_timer), VirtualClock moves only when
+	somebody sleeps on it, so a simulation (simulation.py) replays a long
+	schedule without real time passing.
+
+"""
+
+
+class SystemClock:
+
+	def time(self):
+		return time.time()
+
+	def sleep(self, seconds):
+		if (seconds > 0.0):
+			time.sleep(seconds)
+
+	def sleep_until(self, target_timestamp):
+		"""
+			Output:
+				firing error (s), see precise_timer.sleep_until
+		"""
+		return precise_timer.sleep_until(target_timestamp)
+
+	def seconds_until(self, target_timestamp):
+		return precise_timer.seconds_until(target_timestamp)
+
+
+class VirtualClock:
+	"""
+		Description:
+
+			Simulated clock starting at epoch start, sleeps advance it instantly.
+	"""
+
+	def __init__(self, start):
+		self._now = float(start)
+		self._lock = threading.Lock()
+
+	def time(self):
+		return self._now
+
+	def sleep(self, seconds):
+		with self._lock:
+			self._now += max(seconds, 0.0)
+
+	def sleep_until(self, target_timestamp):
+		with self._lock:
+			firing_error = max(self._now - target_timestamp, 0.0) # late if the target has already passed
+			self._now = max(self._now, target_timestamp)
+		return firing_error
+
+	def seconds_until(self, target_timestamp):
+		return max(target_timestamp - self._now, 0.0)
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+	return _clock
+
+
+def set_clock(clock):
+	"""
+		Make clock the current one (per process), returns the previous clock
+	"""
+	global _clock
+	previous, _clock = _clock, clock
+	return previous